@@ -0,0 +1,154 @@
+/*************************************************************************************************
+ * @info Bulk decoder of X742 (DT5742/V1742) readout buffers: all the events returned by a single
+ *       CAEN_DGTZ_ReadData are decoded in one foreign call into caller-provided arrays.
+ * @author   Pietro Grutta (pietro.grutta@pd.infn.it)
+ *
+ * Build:   gcc -O3 -shared -fPIC -o libX742DecodeBlock.so X742DecodeBlock.c
+ *
+ * Event layout (32-bit little endian words)
+ *   header[0]  [31:28] 0xA             [27:0] event size (words, header included)
+ *   header[1]  [31:27] board id        [23:8] pattern        [3:0] group mask
+ *   header[2]  [21:0]  event counter
+ *   header[3]  [31:0]  event trigger time tag
+ *   for every group present in the group mask
+ *     group[0]   [29:20] start index cell   [17:16] frequency   [12] TR present   [11:0] size (words)
+ *     size words of channel data: 3 words = 8 channels x 12 bit of the same time sample
+ *     size/8 words of trigger channel data if TR present: 3 words = 8 consecutive TR samples
+ *     group trigger time tag [29:0]
+ *************************************************************************************************/
+#include <stdint.h>
+#include <string.h>
+
+#define X742_SUCCESS          0
+#define X742_INVALID_BUFFER -19
+#define X742_INVALID_EVENT  -21
+
+#define X742_MAX_GROUPS       4
+#define X742_CHANNELS         9
+#define X742_INFO_FIELDS      6   /* EventSize, BoardId, Pattern, ChannelMask, EventCounter, TriggerTimeTag */
+
+/* Size in words of the event starting at ptr, 0 if the header is not valid */
+static uint32_t X742_EventWords(const uint32_t *ptr, uint32_t wordsLeft) {
+    uint32_t size;
+    if (wordsLeft < 4 || (ptr[0] >> 28) != 0xA) return 0;
+    size = ptr[0] & 0x0FFFFFFF;
+    if (size < 4 || size > wordsLeft) return 0;
+    return size;
+}
+
+/* Number of events in the readout buffer */
+int32_t X742_BlockNumEvents(const char *buffer, uint32_t bsize, uint32_t *numEvents) {
+    const uint32_t *ptr = (const uint32_t *)buffer;
+    uint32_t wordsLeft = bsize / 4, size;
+
+    *numEvents = 0;
+    while (wordsLeft > 0) {
+        size = X742_EventWords(ptr, wordsLeft);
+        if (size == 0) return X742_INVALID_BUFFER;
+        ptr += size;
+        wordsLeft -= size;
+        (*numEvents)++;
+    }
+    return X742_SUCCESS;
+}
+
+/* Unpack 8 12-bit values packed in 3 words */
+static inline void X742_Unpack8(const uint32_t *w, float *out, uint32_t stride) {
+    out[0 * stride] = (float)(w[0] & 0xFFF);
+    out[1 * stride] = (float)((w[0] >> 12) & 0xFFF);
+    out[2 * stride] = (float)(((w[0] >> 24) & 0xFF) | ((w[1] & 0xF) << 8));
+    out[3 * stride] = (float)((w[1] >> 4) & 0xFFF);
+    out[4 * stride] = (float)((w[1] >> 16) & 0xFFF);
+    out[5 * stride] = (float)(((w[1] >> 28) & 0xF) | ((w[2] & 0xFF) << 4));
+    out[6 * stride] = (float)((w[2] >> 8) & 0xFFF);
+    out[7 * stride] = (float)((w[2] >> 20) & 0xFFF);
+}
+
+/*
+ * Decode up to maxEvents events of the readout buffer. Only the groups of groupMask are stored, in
+ * ascending group order; a group of groupMask missing in an event has ChSize = 0.
+ *
+ *   info       [maxEvents][6]                                    CAEN_DGTZ_EventInfo_t fields (EventSize in bytes)
+ *   groupTTT   [maxEvents][groups]                               group trigger time tags
+ *   startCell  [maxEvents][groups]                               DRS4 start index cells
+ *   chSize     [maxEvents][groups][9]                            samples per channel
+ *   samples    [maxEvents][groups][9][recordLength]              samples
+ *   decoded    number of events decoded
+ */
+int32_t X742_DecodeBlock(const char *buffer, uint32_t bsize, uint32_t maxEvents, uint32_t groupMask, uint32_t recordLength,
+                         uint32_t *info, uint32_t *groupTTT, uint16_t *startCell, uint32_t *chSize, float *samples, uint32_t *decoded) {
+    const uint32_t *ptr = (const uint32_t *)buffer, *grp, *end;
+    uint32_t wordsLeft = bsize / 4, size, evtGroupMask, groups = 0, g, group, ch, s, nSamples, nTR, trPresent, grSize;
+    float *evtSamples, *chSamples;
+
+    for (group = 0; group < X742_MAX_GROUPS; group++) groups += (groupMask >> group) & 1;
+    *decoded = 0;
+
+    while (wordsLeft > 0 && *decoded < maxEvents) {
+        size = X742_EventWords(ptr, wordsLeft);
+        if (size == 0) return X742_INVALID_BUFFER;
+        end = ptr + size;
+
+        /* Event info */
+        info[0] = size * 4;
+        info[1] = (ptr[1] >> 27) & 0x1F;
+        info[2] = (ptr[1] >> 8) & 0xFFFF;
+        info[3] = ptr[1] & 0xF;
+        info[4] = ptr[2] & 0x3FFFFF;
+        info[5] = ptr[3];
+        evtGroupMask = ptr[1] & 0xF;
+
+        memset(chSize, 0, groups * X742_CHANNELS * sizeof(uint32_t));
+        evtSamples = samples;
+        grp = ptr + 4;
+        g = 0;
+        for (group = 0; group < X742_MAX_GROUPS; group++) {
+            if (!((evtGroupMask >> group) & 1)) {
+                if ((groupMask >> group) & 1) { groupTTT[g] = 0; startCell[g] = 0; g++; }
+                continue;
+            }
+            if (grp >= end) return X742_INVALID_EVENT;
+            grSize = grp[0] & 0xFFF;
+            trPresent = (grp[0] >> 12) & 0x1;
+            nTR = trPresent ? grSize / 8 : 0;
+            if (grp + 1 + grSize + nTR + 1 > end) return X742_INVALID_EVENT;
+
+            if ((groupMask >> group) & 1) {
+                nSamples = grSize / 3;
+                if (nSamples > recordLength) nSamples = recordLength;
+                startCell[g] = (uint16_t)((grp[0] >> 20) & 0x3FF);
+                /* 8 channels, one time sample every 3 words */
+                chSamples = evtSamples + (size_t)g * X742_CHANNELS * recordLength;
+                for (s = 0; s < nSamples; s++)
+                    X742_Unpack8(grp + 1 + 3 * s, chSamples + s, recordLength);
+                for (ch = 0; ch < 8; ch++) chSize[g * X742_CHANNELS + ch] = nSamples;
+                /* Trigger channel, 8 consecutive samples every 3 words */
+                if (trPresent) {
+                    float tr[8];
+                    uint32_t trSamples = nTR / 3 * 8, k;
+                    if (trSamples > recordLength) trSamples = recordLength;
+                    chSamples += 8 * (size_t)recordLength;
+                    for (s = 0; s < trSamples; s += 8) {
+                        X742_Unpack8(grp + 1 + grSize + 3 * (s / 8), tr, 1);
+                        for (k = 0; k < 8 && s + k < trSamples; k++) chSamples[s + k] = tr[k];
+                    }
+                    chSize[g * X742_CHANNELS + 8] = trSamples;
+                }
+                groupTTT[g] = grp[1 + grSize + nTR] & 0x3FFFFFFF;
+                g++;
+            }
+            grp += 1 + grSize + nTR + 1;
+        }
+
+        /* Next event */
+        info += X742_INFO_FIELDS;
+        groupTTT += groups;
+        startCell += groups;
+        chSize += groups * X742_CHANNELS;
+        samples += (size_t)groups * X742_CHANNELS * recordLength;
+        ptr = end;
+        wordsLeft -= size;
+        (*decoded)++;
+    }
+    return X742_SUCCESS;
+}
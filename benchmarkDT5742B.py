@@ -0,0 +1,452 @@
+#/ \file    CLEAR_March/DT5742/clear/benchmarkDT5742B.py
+#/ \brief   Throughput benchmarks of the DT5742B readout chain on the simulated digitizer (no hardware needed)
+#/ \author  Pietro Grutta (pietro.grutta@pd.infn.it)
+#/
+#/ Every stage of the chain is measured separately, in events/s and MB/s of raw digitizer data, across
+#/ record lengths, group masks and burst sizes (events per CAEN_DGTZ_ReadData). The results are written
+#/ as JSON to compare versions of the code:
+#/      python benchmarkDT5742B.py --output benchmark.json [--quick] [--stages decode packaging]
+from caendt5742b import CAENDT5742B, CAEN_DGTZ_X742_EVENT_t, CAEN_DGTZ_EventInfo_t, X742_eventBatch
+from x742decoder import X742_encodeBuffer, X742_parseBuffer, X742_blockDecoder, X742_groupsNb, X742_validateParser, X742_eventOffsets, _X742_uniformEvents
+from simdigitizer import simulatedDigitizer, bufferSource
+from dt5742bdsp import dt5742b_dtypes, processWaveforms
+import contextlib
+import subprocess
+import threading
+import argparse
+import platform
+import numpy as np
+import ctypes
+import queue
+import sys
+import os
+import json
+import time
+import io
+
+
+##############################################################
+######## Synthetic data ######################################
+##############################################################
+# Build a decoded X742 event with the given groups filled with random samples
+def makeSyntheticEvent(GroupEnableMask: int = 0b1, RecordLength: int = 1024):
+    Evt = CAEN_DGTZ_X742_EVENT_t()
+    buffers = []            # keep the sample buffers alive as long as the event
+    rng = np.random.default_rng(0)
+    for group in range(4):
+        if not (GroupEnableMask >> group) & 1: continue
+        Evt.GrPresent[group] = 1
+        for j in range(9):
+            chBuffer = (ctypes.c_float * RecordLength)(*rng.integers(0, 4096, RecordLength).astype(float))
+            buffers.append(chBuffer)
+            Evt.DataGroup[group].ChSize[j] = RecordLength
+            Evt.DataGroup[group].DataChannel[j] = ctypes.cast(chBuffer, ctypes.POINTER(ctypes.c_float))
+    return Evt, buffers
+
+# Synthetic raw readout buffer of eventsNb events
+def makeSyntheticBuffer(eventsNb: int, GroupEnableMask: int = 0b1, RecordLength: int = 1024) -> bytes:
+    rng = np.random.default_rng(0)
+    groups = X742_groupsNb(GroupEnableMask)
+    samples = rng.integers(0, 4096, (eventsNb, groups, 9, RecordLength))
+    return X742_encodeBuffer(samples, GroupEnableMask, StartIndexCell=rng.integers(0, 1024, (eventsNb, groups)), triggerChannel=True)
+
+# Queue discarding its items, to measure the producer side of a stage alone
+class nullQueue():
+    def put(self, item):
+        pass
+
+# Digitizer on the simulated backend, configured and acquiring, reading bursts of events of the given buffer
+def makeDigitizer(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, **kwargs) -> CAENDT5742B:
+    backend = simulatedDigitizer(bufferSource(buffer), triggerRate_Hz = 0, maxEventsPerRead = burst)
+    dgt = CAENDT5742B(usbLinkID = 0, evtReadoutQueue = nullQueue(), logLevel = 30, backend = backend, **kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        dgt.open()
+    dgt.setup_DT5742B(SWTriggerMode = 0, ExtTriggerInputMode = 1, RunSyncMode = 0, IOLevel = 1, TriggerPolarity = 0, DRS4Frequency = 3, OutputSignalMode = 0, AcqMode = 0,
+                      GroupEnableMask = GroupEnableMask, RecordLength = RecordLength, PostTriggerSizePercent = 100, ChannelDCOffset = 0x7FFF)
+    dgt.libCAENDigitizer.CAEN_DGTZ_MallocReadoutBuffer(dgt.handle, ctypes.byref(dgt.buffer), ctypes.byref(dgt.bufferSize))
+    dgt.libCAENDigitizer.CAEN_DGTZ_SWStartAcquisition(dgt.handle)
+    return dgt
+
+# Read one block into the readout buffer of the digitizer
+def readBlock(dgt: CAENDT5742B) -> tuple:
+    bsize, numEvents = ctypes.c_uint32(0), ctypes.c_uint32(0)
+    dgt.libCAENDigitizer.CAEN_DGTZ_ReadData(dgt.handle, ctypes.c_long(0), dgt.buffer, ctypes.byref(bsize))
+    dgt.libCAENDigitizer.CAEN_DGTZ_GetNumEvents(dgt.handle, dgt.buffer, bsize, ctypes.byref(numEvents))
+    return bsize, numEvents
+
+# Discard what native code writes on the standard output (e.g. the debug prints of libX742DecodeRoutines.so)
+@contextlib.contextmanager
+def nativeStdoutSilenced():
+    libc = ctypes.CDLL(None)
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            libc.fflush(None)
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+##############################################################
+######## Timing ##############################################
+##############################################################
+# Call function (eventsNb events, bytesNb raw bytes per call) repeatedly for at least minTime_s
+def measure(function, eventsNb: int, bytesNb: int, minTime_s: float) -> dict:
+    function()                                  # warm up
+    calls = 0
+    startTime = time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - startTime
+        if elapsed >= minTime_s: break
+    return {
+        'events'        : calls * eventsNb,
+        'seconds'       : elapsed,
+        'events_per_s'  : calls * eventsNb / elapsed,
+        'MB_per_s'      : calls * bytesNb / elapsed * 1e-6
+    }
+
+
+##############################################################
+######## Stages ##############################################
+##############################################################
+# Every stage receives a buffer of `burst` events and yields (variant, measure) pairs
+
+# Raw read: CAEN_DGTZ_ReadData + CAEN_DGTZ_GetNumEvents
+def stageRawRead(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    dgt = makeDigitizer(buffer, GroupEnableMask, RecordLength, burst)
+    yield 'simulated', measure(lambda: readBlock(dgt), burst, len(buffer), minTime_s)
+
+# Decode of the readout buffer: processBuffer per event / into a batch / native bulk, and the standalone decoders
+def stageDecode(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    variants = {'processBuffer-event': {}, 'processBuffer-batch': {'batchReadout': True}}
+    try:
+        blockDecoder = X742_blockDecoder()
+        variants['processBuffer-native'] = {'batchReadout': True, 'libX742DecodeBlock_path': './libX742DecodeBlock.so'}
+    except OSError:
+        blockDecoder = None
+    for variant, kwargs in variants.items():
+        dgt = makeDigitizer(buffer, GroupEnableMask, RecordLength, burst, **kwargs)
+        bsize, numEvents = readBlock(dgt)
+        yield variant, measure(lambda: dgt.processBuffer(bsize, numEvents), burst, len(buffer), minTime_s)
+    yield 'X742_parseBuffer', measure(lambda: X742_parseBuffer(buffer, GroupEnableMask, RecordLength), burst, len(buffer), minTime_s)
+    if blockDecoder is not None:
+        yield 'X742_blockDecoder', measure(lambda: blockDecoder.decode(buffer, GroupEnableMask = GroupEnableMask, RecordLength = RecordLength), burst, len(buffer), minTime_s)
+        out = X742_eventBatch(burst, X742_groupsNb(GroupEnableMask), RecordLength)
+        yield 'X742_blockDecoder-out', measure(lambda: blockDecoder.decode(buffer, GroupEnableMask = GroupEnableMask, RecordLength = RecordLength, out = out), burst, len(buffer), minTime_s)
+
+# Byte-for-byte check of X742_parseBuffer (vectorized path) against X742_DecodeEvent of libX742DecodeRoutines.so: a mismatch fails the run
+def stageValidateParser(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    # The synthetic events have random start index cells: they must still be decoded in a single vectorized pass
+    words = np.frombuffer(buffer, dtype=np.uint32)
+    if _X742_uniformEvents(words, *X742_eventOffsets(words)) is None: raise AssertionError(f"X742_parseBuffer falls back to the per-event decode (RecordLength={RecordLength}, GroupEnableMask={GroupEnableMask:#06b}, burst={burst})")
+    def validate():
+        with nativeStdoutSilenced():
+            match = X742_validateParser(buffer, './libX742DecodeRoutines.so')
+        if not match: raise AssertionError(f"X742_parseBuffer does not match X742_DecodeEvent (RecordLength={RecordLength}, GroupEnableMask={GroupEnableMask:#06b}, burst={burst})")
+    yield 'X742_DecodeEvent', measure(validate, burst, len(buffer), minTime_s)
+
+# Reference implementation of _processEvt through python lists (before the zero-copy views)
+def processEvtList(dgt: CAENDT5742B, Evt: CAEN_DGTZ_X742_EVENT_t):
+    eventReadoutItem = {'blockTimestamp': time.time(), 'TrgInfo': dgt.TrgInfo, 'data' : {}}
+    for group in range(4):
+        if Evt.GrPresent[group]:
+            EvtGroup = Evt.DataGroup[group]
+            eventReadoutItem['data'].update({'TriggerTimeTag': np.array(EvtGroup.TriggerTimeTag)})
+            for j in range(9):
+                ChSize_ch = EvtGroup.ChSize[j]
+                eventReadoutItem['data'].update({j : np.array(EvtGroup.DataChannel[j][0:ChSize_ch])})
+    dgt.eventReadout.put(eventReadoutItem)
+
+# Packaging of a decoded event by _processEvt
+def stageProcessEvt(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    dgt = makeDigitizer(buffer, GroupEnableMask, RecordLength, burst)
+    Evt, buffers = makeSyntheticEvent(GroupEnableMask, RecordLength)
+    eventBytes = len(buffer) // burst
+    yield 'list', measure(lambda: processEvtList(dgt, Evt), 1, eventBytes, minTime_s)
+    yield 'ndarray-view', measure(lambda: dgt._processEvt(Evt), 1, eventBytes, minTime_s)
+
+# Queue hand-off to a consumer thread, one put per event or one put per block
+def stageHandOff(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    groups = X742_groupsNb(GroupEnableMask)
+    for variant in ['per-event', 'per-block']:
+        evtQueue = queue.Queue()
+        def consumer():
+            while evtQueue.get() is not None: pass
+        consumerThread = threading.Thread(target=consumer)
+        consumerThread.start()
+        if variant == 'per-event':
+            item = {'data': {j: np.empty(RecordLength, dtype=np.float32) for j in range(9)}}
+            def handOff():
+                for i in range(burst): evtQueue.put(item)
+        else:
+            def handOff():
+                evtQueue.put(X742_eventBatch(burst, groups, RecordLength))
+        result = measure(handOff, burst, len(buffer), minTime_s)
+        evtQueue.put(None)
+        consumerThread.join()
+        yield variant, result
+
+# Reference implementation of the producer DSP, one event at a time (before processWaveforms)
+def processWaveformsLoop(waveforms: np.ndarray, calibration) -> np.ndarray:
+    out = np.zeros(len(waveforms), dtype=dt5742b_dtypes)
+    for i, waveformData in enumerate(waveforms):
+        out[i]['avg'] = np.mean(waveformData[:-100])
+        out[i]['std'] = np.std(waveformData[:-100])
+        out[i]['ptNb'] = 100
+        out[i]['avgV'] = calibration.toVolt(out[i]['avg'])
+        out[i]['stdV'] = calibration.toVoltSpread(out[i]['std'])
+        out[i]['avgQ'] = calibration.toCharge(out[i]['avgV'])
+    return out
+
+# Producer DSP of a block of waveforms, per event or vectorized
+def stageDSP(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    dgt = makeDigitizer(buffer, GroupEnableMask, RecordLength, burst)
+    waveforms = X742_parseBuffer(buffer, GroupEnableMask, RecordLength).samples[:, 0, 0]
+    yield 'per-event', measure(lambda: processWaveformsLoop(waveforms, dgt.calibration), burst, len(buffer), minTime_s)
+    yield 'processWaveforms', measure(lambda: processWaveforms(waveforms, dgt.calibration), burst, len(buffer), minTime_s)
+
+# Producer DSP: dt5742bEUDAQ.processEvent per event and processEventBatch per block (needs pyeudaq)
+def stageProcessEvent(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    from dt5742b import dt5742bEUDAQ
+    producer = dt5742bEUDAQ.__new__(dt5742bEUDAQ)
+    producer.dgt = makeDigitizer(buffer, GroupEnableMask, RecordLength, burst)
+    batch = X742_parseBuffer(buffer, GroupEnableMask, RecordLength)
+    TrgInfo = CAEN_DGTZ_EventInfo_t()
+    items = [{'TrgInfo': TrgInfo, 'data': {'TriggerTimeTag': batch.header['GroupTriggerTimeTag'][i, 0], 0: batch.samples[i, 0, 0]}} for i in range(len(batch))]
+    def processEvents():
+        for i, item in enumerate(items): producer.processEvent(i, item)
+    yield 'per-event', measure(processEvents, burst, len(buffer), minTime_s)
+    yield 'per-block', measure(lambda: producer.processEventBatch(0, batch), burst, len(buffer), minTime_s)
+
+# Offline DSP and storage: rootconverter per event (TNtuple.Fill), per event and per block in columnar mode (needs ROOT)
+def stageStoreEventROOT(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    import tempfile
+    from rootconverter import rootconverter
+    batch = X742_parseBuffer(buffer, GroupEnableMask, RecordLength)
+    waveforms = batch.samples[:, 0, 0]
+    TrgInfo = CAEN_DGTZ_EventInfo_t()
+    with tempfile.TemporaryDirectory() as path:
+        for variant, basketEvents in [('TNtuple-per-event', 0), ('columnar-per-event', 10000), ('columnar-per-block', 10000)]:
+            converter = rootconverter(path = path + '/', jobEvents = 1 << 30, basketEvents = basketEvents)
+            converter.prepareROOT(f"benchmark_{variant}.root")
+            if variant == 'columnar-per-block':
+                storeEvents = lambda: converter._dsp_storeBlockROOT(batch.header, waveforms, 0)
+            else:
+                def storeEvents():
+                    for i in range(len(batch)): converter._dsp_storeEventROOT(TrgInfo, waveforms[i], 0)
+            yield variant, measure(storeEvents, burst, len(buffer), minTime_s)
+            converter.closeROOT()
+
+# Offline DSP and storage: rootconverter on the Parquet backend, per event and per block (needs pyarrow)
+def stageStoreEventParquet(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    import tempfile
+    from rootconverter import rootconverter
+    batch = X742_parseBuffer(buffer, GroupEnableMask, RecordLength)
+    waveforms = batch.samples[:, 0, 0]
+    TrgInfo = CAEN_DGTZ_EventInfo_t()
+    with tempfile.TemporaryDirectory() as path:
+        for variant in ['parquet-per-event', 'parquet-per-block']:
+            converter = rootconverter(path = path + '/', jobEvents = 1 << 30, basketEvents = 65536, backend = 'parquet')
+            converter.prepareROOT(f"benchmark_{variant}.parquet")
+            if variant == 'parquet-per-block':
+                storeEvents = lambda: converter._dsp_storeBlockROOT(batch.header, waveforms, 0)
+            else:
+                def storeEvents():
+                    for i in range(len(batch)): converter._dsp_storeEventROOT(TrgInfo, waveforms[i], 0)
+            yield variant, measure(storeEvents, burst, len(buffer), minTime_s)
+            converter.closeROOT()
+
+# Storage of every waveform of every channel: HDF5 backend, one bulk write per block (needs h5py, hdf5plugin for blosc)
+def stageStoreWaveformsHDF5(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    import tempfile
+    from outputbackends import hdf5Backend, DT5730_RAW_dtype
+    batch = X742_parseBuffer(buffer, GroupEnableMask, RecordLength)
+    waveforms = batch.samples.reshape(len(batch), -1, RecordLength)
+    header = np.zeros(len(batch), dtype=DT5730_RAW_dtype)
+    with tempfile.TemporaryDirectory() as path:
+        for compression in ['none', 'lzf', 'blosc-lz4']:
+            backend = hdf5Backend(channels = waveforms.shape[1], chunkEvents = 16, compression = compression, waveformSamples = RecordLength)
+            backend.open(f"{path}/benchmark_{compression}.h5", {})
+            yield compression, measure(lambda: backend.fillRawBlock(header, waveforms), burst, len(buffer), minTime_s)
+            backend.close()
+
+# DRS4 corrections (cell, index, time, spikes) with the synthetic tables: one channel at a time per event, or the whole block.
+# The block is checked against the per-event drs4Corrector.applyEvent of the module, not against the CAEN library correction
+# (which needs the tables of a real board)
+def stageDRS4Correction(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    from drs4correction import drs4CorrectionTables, drs4Corrector
+    tables = drs4CorrectionTables.fromLibrary(simulatedDigitizer(), 1, 3)
+    corrector = drs4Corrector(tables, GroupEnableMask, RecordLength)
+    batch = X742_parseBuffer(buffer, GroupEnableMask, RecordLength)
+    reference = X742_parseBuffer(buffer, GroupEnableMask, RecordLength)
+    for i in range(len(reference)): corrector.applyEvent(reference.samples[i], reference.header['StartIndexCell'][i])
+    deviation = {'reference': 'applyEvent', 'maxDeviation': float(np.abs(corrector.apply(batch).samples - reference.samples).max())}
+    if deviation['maxDeviation'] > 1e-2: raise AssertionError(f"Block DRS4 correction differs from applyEvent by {deviation['maxDeviation']:.3f} ADC (RecordLength={RecordLength}, GroupEnableMask={GroupEnableMask:#06b})")
+    def correctEvents():
+        for i in range(len(batch)): corrector.applyEvent(batch.samples[i], batch.header['StartIndexCell'][i])
+    yield 'per-event', measure(correctEvents, burst, len(buffer), minTime_s)
+    yield 'block', {**measure(lambda: corrector.apply(batch), burst, len(buffer), minTime_s), **deviation}
+
+# Calibration of all the waveforms of a block to V: one channel at a time, in place in float32, into 16-bit fixed point
+def stageCalibration(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    dgt = makeDigitizer(buffer, GroupEnableMask, RecordLength, burst)
+    samples = X742_parseBuffer(buffer, GroupEnableMask, RecordLength).samples.reshape(burst, -1, RecordLength)
+    calibration = dgt.calibration
+    def calibrateChannels():
+        for i in range(burst):
+            for ch in range(samples.shape[1]): samples[i, ch] = calibration.toVolt(samples[i, ch])
+    yield 'per-channel', measure(calibrateChannels, burst, len(buffer), minTime_s)
+    yield 'block-float32', measure(lambda: calibration.apply(samples), burst, len(buffer), minTime_s)
+    out = np.empty(samples.shape, dtype=calibration.FIXED_POINT_dtype)
+    yield 'block-fixed16', measure(lambda: calibration.toFixedPoint(samples, out), burst, len(buffer), minTime_s)
+
+# Reference pulse features of a single waveform (negative pulse), one channel at a time
+def pulseFeaturesChannel(waveform: np.ndarray, out: np.ndarray, cfdFraction: float = 0.5):
+    out['baseline'] = baseline = waveform[:100].mean()
+    out['noise'] = waveform[:100].std()
+    signal = baseline - waveform
+    peak = int(signal.argmax())
+    out['amplitude'] = amplitude = signal[peak]
+    out['peakTime'] = peak
+    out['integral'] = signal.sum()
+    out['cfdTime'] = np.nan
+    for i in range(peak - 1, -1, -1):
+        if signal[i] < cfdFraction * amplitude:
+            out['cfdTime'] = i + (cfdFraction * amplitude - signal[i]) / (signal[i + 1] - signal[i])
+            break
+
+# Pulse features of every channel of a block: one channel at a time, or the whole block
+def stagePulseFeatures(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    from pulsefeatures import pulseFeatureExtractor, PULSE_FEATURES_dtype
+    samples = X742_parseBuffer(buffer, GroupEnableMask, RecordLength).samples.reshape(burst, -1, RecordLength)
+    out = np.zeros(samples.shape[:-1], dtype=PULSE_FEATURES_dtype)
+    def channelFeatures():
+        for i in range(burst):
+            for ch in range(samples.shape[1]): pulseFeaturesChannel(samples[i, ch], out[i, ch])
+    yield 'per-channel', measure(channelFeatures, burst, len(buffer), minTime_s)
+    extractor = pulseFeatureExtractor()
+    yield 'block', measure(lambda: extractor.extract(samples, out), burst, len(buffer), minTime_s)
+
+# Software zero suppression of a decoded block (the counters of the header are modified in place, the timing is not)
+def stageZeroSuppression(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    from zerosuppression import zeroSuppressor
+    batch = X742_parseBuffer(buffer, GroupEnableMask, RecordLength)
+    for variant, suppressor in [('threshold', zeroSuppressor(threshold=20)), ('roi', zeroSuppressor(roi=(32, 96))), ('decimation', zeroSuppressor(decimation=4))]:
+        yield variant, measure(lambda: suppressor(batch), burst, len(buffer), minTime_s)
+
+# Lossless waveform codec: encode/decode of the uniform random synthetic samples (worst case) and of DRS4-like waveforms
+def stageWaveformCodec(buffer: bytes, GroupEnableMask: int, RecordLength: int, burst: int, minTime_s: float):
+    from waveformcodec import waveformCodec
+    batch = X742_parseBuffer(buffer, GroupEnableMask, RecordLength)
+    rng = np.random.default_rng(0)
+    pulse = -800 * np.exp(-0.5 * ((np.arange(RecordLength) - RecordLength // 2) / 8.0) ** 2)
+    drs4 = np.rint(np.clip(3000 + pulse + rng.normal(0, 3, batch.samples.shape), 0, 4095)).astype(np.float32)
+    codec = waveformCodec()
+    for name, samples in [('uniform', batch.samples), ('drs4', drs4)]:
+        data = codec.encode(samples)
+        ratio = {'ratio': samples.nbytes / len(data)}
+        yield f'encode-{name}', {**measure(lambda: codec.encode(samples), burst, len(buffer), minTime_s), **ratio}
+        yield f'decode-{name}', {**measure(lambda: codec.decode(data), burst, len(buffer), minTime_s), **ratio}
+
+STAGES = {
+    'raw-read'          : stageRawRead,
+    'decode'            : stageDecode,
+    'validateParser'    : stageValidateParser,
+    'packaging'         : stageProcessEvt,
+    'hand-off'          : stageHandOff,
+    'dsp'               : stageDSP,
+    'processEvent'      : stageProcessEvent,
+    'storeEventROOT'    : stageStoreEventROOT,
+    'storeEventParquet' : stageStoreEventParquet,
+    'storeWaveformsHDF5': stageStoreWaveformsHDF5,
+    'drs4Correction'    : stageDRS4Correction,
+    'calibration'       : stageCalibration,
+    'pulseFeatures'     : stagePulseFeatures,
+    'zeroSuppression'   : stageZeroSuppression,
+    'waveformCodec'     : stageWaveformCodec,
+}
+
+
+##############################################################
+######## Harness #############################################
+##############################################################
+# Optional dependencies: a stage that needs a missing one is skipped, any other ImportError is a failure of the stage
+OPTIONAL_DEPENDENCIES = ('ROOT', 'pyeudaq', 'pyarrow', 'h5py', 'hdf5plugin')
+
+# Version of the code under test
+def codeVersion() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# Run the stages over the grid of parameters
+def runBenchmarks(recordLengths: list, groupMasks: list, bursts: list, stages: list = None, minTime_s: float = 0.2) -> dict:
+    """
+    Measure the throughput of every stage of the readout chain for every combination of the parameters
+
+    Parameters
+    ----------
+        recordLengths (list) : samples per channel (multiples of 8)
+        groupMasks (list) : GroupEnableMask values
+        bursts (list) : events per readout block
+        stages (list) : names of the stages in STAGES (all if None)
+        minTime_s (float) : minimum measuring time of every point [s]
+
+    Returns
+    -------
+        report (dict) : environment of the run, 'results' (one record per point) and 'skipped' stages (missing optional dependency)
+    """
+    report = {
+        'version'   : codeVersion(),
+        'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python'    : platform.python_version(),
+        'numpy'     : np.__version__,
+        'machine'   : platform.machine(),
+        'results'   : [],
+        'skipped'   : []
+    }
+    for stage in (stages or list(STAGES)):
+        grid = [(RecordLength, GroupEnableMask, burst) for RecordLength in recordLengths for GroupEnableMask in groupMasks for burst in bursts]
+        for RecordLength, GroupEnableMask, burst in grid:
+            buffer = makeSyntheticBuffer(burst, GroupEnableMask, RecordLength)
+            point = {'stage': stage, 'RecordLength': RecordLength, 'GroupEnableMask': GroupEnableMask, 'burst': burst}
+            try:
+                for variant, result in STAGES[stage](buffer, GroupEnableMask, RecordLength, burst, minTime_s):
+                    report['results'].append({**point, 'variant': variant, **result})
+                    print(f"{stage:14s} {variant:22s} RL={RecordLength:4d} mask={GroupEnableMask:#06b} burst={burst:4d}: {result['events_per_s']:12.1f} evt/s {result['MB_per_s']:9.2f} MB/s" + (f" ratio {result['ratio']:5.2f}" if 'ratio' in result else '') +
+                          (f" max deviation from {result['reference']} {result['maxDeviation']:.2e}" if 'reference' in result else ''), flush=True)
+            except ImportError as e:
+                if (e.name or '').split('.')[0] not in OPTIONAL_DEPENDENCIES: raise
+                # Optional dependency of the stage not available
+                report['skipped'].append({'stage': stage, 'reason': str(e)})
+                print(f"{stage:14s} SKIPPED: {e}", flush=True)
+                break
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput benchmarks of the DT5742B readout chain")
+    parser.add_argument('--output', default='benchmark.json', help="JSON output file")
+    parser.add_argument('--quick', action='store_true', help="reduced grid of parameters")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help="stages to run (all if omitted)")
+    parser.add_argument('--minTime', type=float, default=0.2, help="minimum measuring time of every point [s]")
+    parser.add_argument('--allowSkip', action='store_true', help="exit with success even if stages are skipped for a missing optional dependency")
+    args = parser.parse_args()
+
+    if args.quick:
+        grid = {'recordLengths': [1024], 'groupMasks': [0b1], 'bursts': [1, 64]}
+    else:
+        grid = {'recordLengths': [136, 520, 1024], 'groupMasks': [0b1, 0b11], 'bursts': [1, 16, 128]}
+    report = runBenchmarks(**grid, stages=args.stages, minTime_s=args.minTime)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if report['skipped']:
+        print(f"Skipped stages: {', '.join(item['stage'] for item in report['skipped'])}")
+        if not args.allowSkip: raise SystemExit(1)
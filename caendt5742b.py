@@ -1,4 +1,11 @@
 from logger import create_logger
+from x742decoder import X742_headerDtype, X742_eventBatch, X742_groupsNb, X742_blockDecoder, X742_parseBuffer
+from eventring import eventRing
+from rawrecorder import rawRecorder
+from decodepool import decodePool
+from sharedring import sharedRingWriter
+from drs4correction import drs4Corrector, getCorrectionTables
+from calibration import waveformCalibration
 import numpy as np
 import threading
 import ctypes
@@ -30,6 +37,26 @@ class CAEN_DGTZ_X742_GROUP_t(ctypes.Structure):
             #       using indexing or similar depending on how the data is stored.
             print(f"TriggerTimeTag: {self.TriggerTimeTag}")
             print(f"StartIndexCell: {self.StartIndexCell}")     
+# Zero-copy view over the float32 samples of a decoded X742 channel
+def X742_channelView(EvtGroup: CAEN_DGTZ_X742_GROUP_t, ch: int) -> np.ndarray:
+    """
+    Expose the DataChannel[ch] buffer of a decoded X742 group as a float32 numpy array
+    without materializing the samples as python floats. The returned array shares the
+    memory of the event buffer, which is reused by the library at every decode: copy it
+    before the next CAEN_DGTZ_DecodeEvent call if it has to be kept.
+    
+    Parameters
+    ----------
+        EvtGroup (CAEN_DGTZ_X742_GROUP_t) : decoded group structure
+        ch (int) : channel index within the group (0-7, 8 is the trigger channel)
+    
+    Returns
+    -------
+        samples (np.ndarray) : float32 view of ChSize[ch] samples
+    """
+    ChSize_ch = EvtGroup.ChSize[ch]
+    if ChSize_ch == 0: return np.empty(0, dtype=np.float32)
+    return np.ctypeslib.as_array(EvtGroup.DataChannel[ch], shape=(ChSize_ch,))
 # Container for the waveform digitized data for DT5742B
 class CAEN_DGTZ_X742_EVENT_t(ctypes.Structure):
     _fields_ = [
@@ -130,6 +157,20 @@ class CAEN_DGTZ_EventInfo_t(ctypes.Structure):
             "TriggerTimeTag"    : self.TriggerTimeTag
         }
         return result
+# Ring buffer sized for the given group mask and record length
+def X742_eventRing(capacity: int, GroupEnableMask: int, RecordLength: int, overflowPolicy: str = 'drop_newest') -> eventRing:
+    """
+    Allocate an eventRing for X742 events: X742_headerDtype header and (groups, 9, RecordLength) float32 samples
+    
+    Parameters
+    ----------
+        capacity (int) : number of event slots
+        GroupEnableMask (int) : group enable mask of the digitizer
+        RecordLength (int) : number of samples per channel
+        overflowPolicy (str) : block, drop_newest or drop_oldest
+    """
+    groups = X742_groupsNb(GroupEnableMask)
+    return eventRing(capacity, X742_headerDtype(groups), (groups, 9, RecordLength), overflowPolicy)
 # Container for the waveform digitized data
 class CAEN_DGTZ_UINT16_EVENT_t(ctypes.Structure):
     _fields_ = [
@@ -239,9 +280,11 @@ class CAENDT5742B():
         # Variables
         totBufferSize = 0
         totEventNb = 0
+        totPollNb = 0
         startTime = 0
         dataThro = -1
         eventRate = -1  
+        pollRate = -1
         closed = False
         
         def __init__(self) -> None:
@@ -261,7 +304,12 @@ class CAENDT5742B():
             #
             # Print option
             if display > 0 and self.totEventNb % display == 0:
-                self.printINFO(f"Event rate {self.eventRate:.2f} evt/s ({self.dataThro*1e-6:.3f} MB/s)")
+                self.printINFO(f"Event rate {self.eventRate:.2f} evt/s ({self.dataThro*1e-6:.3f} MB/s) | poll rate {self.pollRate:.1f} Hz")
+        
+        # Count a readout attempt (CAEN_DGTZ_ReadData call)
+        def poll(self):
+            self.totPollNb += 1
+            self.pollRate = self.totPollNb / ((time.time_ns() - self.startTime)*1e-9)
         
         def printINFO(self, message):
             green = "\x1b[32;1m"
@@ -280,15 +328,64 @@ class CAENDT5742B():
         # Return the total number of events acquired so far
         def getTotalEvents(self):
             return self.totEventNb
+        
+        # Return the achieved polling rate of the digitizer
+        def getPollRate(self):
+            return self.pollRate
+    
+    # Class for the polling strategy of the readout loop
+    class pollingPolicy():
+        """
+        Polling strategy of the readout loop
+        
+        Parameters
+        ----------
+            mode (str) : fixed (constant sleep of maxSleep_s after every read), adaptive (immediate re-read while the
+                         last read returned events, exponential backoff up to maxSleep_s when idle) or irq (wait for
+                         the digitizer interrupt with CAEN_DGTZ_IRQWait, if the IRQ cannot be configured adaptive is used)
+            minSleep_s (float) : first backoff step of the adaptive mode [s]
+            maxSleep_s (float) : ceiling of the sleep time [s]
+            backoff (float) : multiplicative factor of the backoff
+            irqTimeout_ms (int) : timeout of CAEN_DGTZ_IRQWait [ms]
+        """
+        FIXED = 'fixed'
+        ADAPTIVE = 'adaptive'
+        IRQ = 'irq'
+        
+        def __init__(self, mode: str = 'fixed', minSleep_s: float = 0.0005, maxSleep_s: float = 0.040, backoff: float = 2.0, irqTimeout_ms: int = 100) -> None:
+            if mode not in (self.FIXED, self.ADAPTIVE, self.IRQ): raise ValueError(f"Unknown polling mode {mode}")
+            self.mode = mode
+            self.minSleep_s = minSleep_s
+            self.maxSleep_s = maxSleep_s
+            self.backoff = backoff
+            self.irqTimeout_ms = irqTimeout_ms
+            self.sleep_s = 0
+        
+        # Time to wait before the next read, given the number of events returned by the last one
+        def nextSleep(self, eventsNb: int) -> float:
+            if self.mode == self.FIXED:
+                return self.maxSleep_s
+            if eventsNb > 0:
+                self.sleep_s = 0
+            else:
+                self.sleep_s = min(self.maxSleep_s, max(self.minSleep_s, self.sleep_s * self.backoff))
+            return self.sleep_s
   
-    def __init__(self, usbLinkID: int, evtReadoutQueue: queue.Queue, libCAENDigitizer_path = 'libCAENDigitizer.so', libCAENX742DecodeRoutines_path = './libX742DecodeRoutines.so', eventCutoff=-1, logLevel: int = 20) -> None:
+    def __init__(self, usbLinkID: int, evtReadoutQueue: queue.Queue | eventRing, libCAENDigitizer_path = 'libCAENDigitizer.so', libCAENX742DecodeRoutines_path = './libX742DecodeRoutines.so', eventCutoff=-1, logLevel: int = 20, batchReadout: bool = False, polling: pollingPolicy = None, libX742DecodeBlock_path: str = None, recorder: rawRecorder = None, decodeOnline: bool = True, backend = None, decodeWorkers: int = 0) -> None:
         # Create the class logger instante
         self.logging = create_logger("CAENDT5742B")
         self.logging.setLevel(logLevel)      
         
-        # Load CAENDigitizer library
-        self.libCAENDigitizer = ctypes.cdll.LoadLibrary(libCAENDigitizer_path)
-        self.libCAENX742DecodeRoutines = ctypes.cdll.LoadLibrary(libCAENX742DecodeRoutines_path)
+        # Load CAENDigitizer library, or use the given backend exposing the same CAEN_DGTZ_* functions (e.g. simdigitizer.simulatedDigitizer)
+        if backend is None:
+            self.libCAENDigitizer = ctypes.cdll.LoadLibrary(libCAENDigitizer_path)
+            self.libCAENX742DecodeRoutines = ctypes.cdll.LoadLibrary(libCAENX742DecodeRoutines_path)
+        else:
+            self.libCAENDigitizer = backend
+            self.libCAENX742DecodeRoutines = None
+        # Optional bulk decoder of the readout buffers (used in batch readout)
+        self.blockDecoder = X742_blockDecoder(libX742DecodeBlock_path) if libX742DecodeBlock_path is not None else None
+        self.libX742DecodeBlock_path = libX742DecodeBlock_path
         
         # Parameters for the digitizer
         self.handle = ctypes.c_int()                                        # Digitizer unique handler ID for the session
@@ -308,9 +405,30 @@ class CAENDT5742B():
         # Event readout variables
         self.daqLoop = False
         self.acquisitionMode = True 
-        ## Queue for events readout
+        ## Queue for events readout (dict per event), or ring buffer written in place
         self.eventReadout = evtReadoutQueue
+        self.eventRingMode = isinstance(evtReadoutQueue, eventRing)
+        ## Hand over one X742_eventBatch per readout block instead of one dict per event
+        self.batchReadout = batchReadout and not self.eventRingMode
         self.lock = threading.Lock()
+        ## Polling strategy of the readout loop (default: fixed 40 ms sleep)
+        self.polling = polling if polling is not None else self.pollingPolicy()
+        ## Raw recording of the readout blocks, optionally without online decoding
+        self.rawRecorder = recorder
+        self.decodeOnline = decodeOnline
+        ## Fan-out of the decoded events to local readers (sharedring.sharedRingWriter)
+        self.sharedRing = None
+        ## Decoding in a pool of worker processes (0: in the acquisition thread). The workers apply
+        ## decodeReducer (picklable, e.g. dt5742bdsp.batchReducer) to every block if set
+        self.decodeWorkers = decodeWorkers if not self.eventRingMode else 0
+        self.decodeReducer = None
+        self.decodePool = None
+        ## DRS4 corrections of the decoded blocks (drs4correction.drs4Corrector, see loadDRS4Correction), batch readout only
+        self.drs4Correction = None
+        ## Software zero suppression of the decoded blocks, after the corrections (zerosuppression.zeroSuppressor), batch readout only:
+        ## the hand-off gets the whole records of the selected events, the shared ring also the region of interest and the decimation
+        self.zeroSuppression = None
+        if decodeWorkers > 0 and self.eventRingMode: (self.logging).warning("Decode workers are not available with the ring buffer readout, decoding in the acquisition thread")
         ### Close digitizer after cutoff is reached (mainly for debugging)
         self.eventCutoff = eventCutoff
         if self.eventCutoff>0: (self.logging).warning(f"Event cutoff set. The readout will stop after {self.eventCutoff} events!")
@@ -422,6 +540,7 @@ class CAENDT5742B():
         ret['CAEN_DGTZ_SetAcquisitionMode']             = self.libCAENDigitizer.CAEN_DGTZ_SetAcquisitionMode(self.handle, AcqMode)
         ret['CAEN_DGTZ_SetChannelDCOffset']             = self.libCAENDigitizer.CAEN_DGTZ_SetChannelDCOffset(self.handle, 0, ChannelDCOffset)
         # ret['CAEN_DGTZ_SetDESMode']                     = self.libCAENDigitizer.CAEN_DGTZ_SetDESMode(self.handle)
+        # Not available on the X742 family: software zero suppression and decimation in zerosuppression.zeroSuppressor (self.zeroSuppression)
         # ret['CAEN_DGTZ_SetDecimationFactor']            = self.libCAENDigitizer.CAEN_DGTZ_SetDecimationFactor(self.handle)
         # ret['CAEN_DGTZ_SetZeroSuppressionMode']         = self.libCAENDigitizer.CAEN_DGTZ_SetZeroSuppressionMode(self.handle)
         # ret['CAEN_DGTZ_SetChannelZSParams']             = self.libCAENDigitizer.CAEN_DGTZ_SetChannelZSParams(self.handle)
@@ -444,10 +563,13 @@ class CAENDT5742B():
             3 : 750.e6, # 'CAEN_DGTZ_DRS4_750MHz',
         }
         self.SamplingPeriod_s = 1/CAEN_DGTZ_DRS4Frequency_t[DRS4Frequency]
+        self.DRS4Frequency = int(DRS4Frequency)
         # print("self.SamplingPeriod_s", self.SamplingPeriod_s)
         self.ChannelDCOffset_ADC = ChannelDCOffset
         self.ChannelDCOffset_V = float(ChannelDCOffset - 0x7FFF)/0x7FFF
+        self.calibration = waveformCalibration.fromDT5742B(self.dacFSR, self.ChannelDCOffset_V)
         self.RecordLength = int(RecordLength)
+        self.GroupEnableMask = int(GroupEnableMask)
         self.waveformtime = np.linspace(0, self.RecordLength*self.SamplingPeriod_s, self.RecordLength)
 
     # Default setup for the CAEN DT5742B digitizer.
@@ -660,6 +782,39 @@ class CAENDT5742B():
                 return usbLinkID
         raise Exception(f"Digitizer not found in the linkID range {start}-{stop}")
     
+    # Set (or remove with None) the raw recorder of the readout blocks. Returns the previous one
+    def setRawRecorder(self, recorder: rawRecorder) -> rawRecorder:
+        self.lock.acquire()
+        previous = self.rawRecorder
+        self.rawRecorder = recorder
+        self.lock.release()
+        return previous
+    
+    # Set (or remove with None) the shared ring of the decoded events. Returns the previous one
+    def setSharedRing(self, sharedRing: sharedRingWriter) -> sharedRingWriter:
+        with self.lock:
+            previous = self.sharedRing
+            self.sharedRing = sharedRing
+        return previous
+    
+    # Load the DRS4 correction tables of the board (cached) and correct the decoded blocks. Call after the setup
+    def loadDRS4Correction(self, corrections: int = drs4Corrector.CORRECTION_ALL, fname: str = None) -> drs4Corrector:
+        """
+        Enable the DRS4 corrections of the decoded blocks (batch readout and decode workers)
+
+        Parameters
+        ----------
+            corrections (int) : drs4Corrector.CORRECTION_* bits, 0 disables the corrections
+            fname (str) : tables saved with drs4CorrectionTables.save, read from the board if None
+        """
+        if corrections == 0:
+            self.drs4Correction = None
+            return None
+        if not self.batchReadout and self.decodeWorkers == 0: (self.logging).warning("DRS4 corrections are applied only with the batch readout or the decode workers")
+        tables = getCorrectionTables(self.libCAENDigitizer, self.handle, self.boardInfo.SerialNumber, self.DRS4Frequency, fname)
+        self.drs4Correction = drs4Corrector(tables, self.GroupEnableMask, self.RecordLength, corrections)
+        return self.drs4Correction
+
     def setDaqLoop(self, value:bool):
         self.lock.acquire()
         self.daqLoop = value
@@ -686,6 +841,7 @@ class CAENDT5742B():
         
         # Class handling the statistics of event/rate etc.
         stats = self.statsManager()  # Event/rate statistics manager
+        self.stats = stats
                         
         # Allocate the readout buffer
         # NOTE1: The mallocs must be done AFTER digitizer's configuration!
@@ -699,6 +855,22 @@ class CAENDT5742B():
         # (self.logging).trace("CAEN_DGTZ_SWStartAcquisition OK")
         self.acquisitionMode = True
         
+        # Pool of decode workers, one shared memory slot per readout buffer in flight
+        if self.decodeWorkers > 0 and self.decodeOnline:
+            self.decodePool = decodePool(self.eventReadout, self.GroupEnableMask, self.RecordLength, self.bufferSize.value, self.decodeWorkers, libX742DecodeBlock_path = self.libX742DecodeBlock_path, reducer = self.decodeReducer, correction = self.drs4Correction, suppression = self.zeroSuppression)
+            (self.logging).info(f"Decoding in {self.decodeWorkers} worker processes")
+        
+        # Interrupt-driven polling: raise the IRQ as soon as one event is ready (RORA mode)
+        polling = self.polling
+        irqMode = False
+        if polling.mode == polling.IRQ:
+            ret = self.libCAENDigitizer.CAEN_DGTZ_SetInterruptConfig(self.handle, 1, 1, 0, 1, 0)
+            if ret == 0:
+                irqMode = True
+            else:
+                (self.logging).warning(f"CAEN_DGTZ_SetInterruptConfig failed ({ret}). Falling back to adaptive polling")
+                polling.mode = polling.ADAPTIVE
+        
         # Variables for the event readout
         ## for the digitizer
         bsize = ctypes.c_uint32(0)
@@ -711,6 +883,8 @@ class CAENDT5742B():
                 # print("Send a SW Trigger:", self.libCAENDigitizer.CAEN_DGTZ_SendSWtrigger(self.handle)) # Send a SW Trigger
                
                 # Read data payload from the digitizer
+                stats.poll()
+                numEvents.value = 0
                 ret = self.libCAENDigitizer.CAEN_DGTZ_ReadData(self.handle, ctypes.c_long(0), self.buffer, ctypes.byref(bsize))
                 if ret==0:
                     # (self.logging).trace(f"CAEN_DGTZ_ReadData OK | {bsize.value} bytes")
@@ -742,8 +916,17 @@ class CAENDT5742B():
                     # Update data thoughput statistics
                     stats.update(bsize.value, numEvents.value, 1)
                     
+                    # Append the raw block to the recording
+                    if self.rawRecorder is not None:
+                        with self.lock:
+                            if self.rawRecorder is not None: self.rawRecorder.writeBlock(self.buffer, bsize.value, numEvents.value)
+                    
                     # Process the buffer containing a certain number 'eventNb' of events 
-                    self.processBuffer(bsize, numEvents)
+                    if self.decodeOnline:
+                        if self.decodePool is not None:
+                            self.decodePool.submit(self.buffer, bsize.value, numEvents.value)
+                        else:
+                            self.processBuffer(bsize, numEvents)
             
                 # If a limit on event number is set, the acquisition will be stopped after this number of events
                 if (self.eventCutoff > 0) and (stats.getTotalEvents() >= self.eventCutoff):
@@ -755,9 +938,27 @@ class CAENDT5742B():
             #     self.eventReadout.put(None)
             #     break
             
-            # Reduce CPU overhead
-            time.sleep(0.040)
+            # Reduce CPU overhead according to the polling strategy
+            if not self.daqLoop:
+                time.sleep(polling.maxSleep_s)
+            elif irqMode:
+                # Returns on the interrupt or on timeout (CAEN_DGTZ_Timeout), the next ReadData tells which one
+                if numEvents.value == 0: self.libCAENDigitizer.CAEN_DGTZ_IRQWait(self.handle, polling.irqTimeout_ms)
+            else:
+                sleep_s = polling.nextSleep(numEvents.value)
+                if sleep_s > 0: time.sleep(sleep_s)
             
+        # Disable the interrupts
+        if irqMode:
+            self.libCAENDigitizer.CAEN_DGTZ_SetInterruptConfig(self.handle, 0, 1, 0, 1, 0)
+        
+        # Drain the blocks in flight and stop the decode workers
+        if self.decodePool is not None:
+            self.decodePool.close()
+            (self.logging).info(f"Decode pool stats: {self.decodePool.getStats()}")
+        elif self.zeroSuppression is not None:
+            (self.logging).info(f"Zero suppression stats: {self.zeroSuppression.getStats()}")
+        
         # Close the acquisition
         ret = self.libCAENDigitizer.CAEN_DGTZ_SWStopAcquisition(self.handle)
         CAEN_DGTZ_ErrorHandler(ret)
@@ -769,23 +970,70 @@ class CAENDT5742B():
         # (self.logging).trace("CAEN_DGTZ_FreeReadoutBuffer OK")
 
     # Process the Event object
-    def _processEvt(self, Evt: CAEN_DGTZ_X742_EVENT_t):
+    def _processEvt(self, Evt: CAEN_DGTZ_X742_EVENT_t, samples: np.ndarray = None):
+        """
+        Hand over the event as a dict of channel views
+
+        Parameters
+        ----------
+            Evt (CAEN_DGTZ_X742_EVENT_t) : decoded event
+            samples (np.ndarray) : (groups, 9, RecordLength) row of the block preallocated for the readout buffer,
+                                   where the channels are copied (the Evt buffers are reused by the next decode); allocated if None
+        """
+        if self.eventRingMode:
+            self._processEvtRing(Evt)
+            return
         eventReadoutItem = {'blockTimestamp': time.time(), 'TrgInfo': copy.copy(self.TrgInfo), 'data' : {}}
+        if samples is None: samples = np.empty((X742_groupsNb(self.GroupEnableMask), 9, self.RecordLength), dtype=np.float32)
         
+        g = 0
         for group in range(4):
+            if g == len(samples): break
             if Evt.GrPresent[group]:
                 EvtGroup = Evt.DataGroup[group] 
                 TriggerTimeTag = EvtGroup.TriggerTimeTag
                 eventReadoutItem['data'].update({'TriggerTimeTag': np.array(TriggerTimeTag)})
                 for j in range(9):
-                    ChSize_ch = EvtGroup.ChSize[j]
-                    DataChannel_ch = EvtGroup.DataChannel[j][0:ChSize_ch]
-                    eventReadoutItem['data'].update({j : np.array(DataChannel_ch)})
+                    ChSize_ch = min(EvtGroup.ChSize[j], samples.shape[-1])
+                    samples[g, j, :ChSize_ch] = X742_channelView(EvtGroup, j)[:ChSize_ch]
+                    eventReadoutItem['data'].update({j : samples[g, j, :ChSize_ch]})
+                g += 1
         
         # Put the event object in the eventReadout queue
         (self.eventReadout).put(eventReadoutItem)        
         
 
+    # Write the Event object in the next slot of the eventRing
+    def _processEvtRing(self, Evt: CAEN_DGTZ_X742_EVENT_t):
+        ring = self.eventReadout
+        slot = ring.reserve()
+        if slot is None: return                 # ring full, event dropped (counted by the ring)
+        self._unpackEvt(Evt, ring.header, ring.samples, slot, time.time())
+        ring.commit()
+
+    # Unpack the Event object into the row of preallocated header/samples arrays
+    def _unpackEvt(self, Evt: CAEN_DGTZ_X742_EVENT_t, header: np.ndarray, samples: np.ndarray, row: int, blockTimestamp: float):
+        for name, _ in CAEN_DGTZ_EventInfo_t._fields_:
+            header[name][row] = getattr(self.TrgInfo, name)
+        header['blockTimestamp'][row] = blockTimestamp
+        
+        samples = samples[row]
+        groups, _, RecordLength = samples.shape
+        header['ChSize'][row] = 0
+        g = 0
+        for group in range(4):
+            if g == groups: break
+            if Evt.GrPresent[group]:
+                EvtGroup = Evt.DataGroup[group]
+                header['GroupTriggerTimeTag'][row, g] = EvtGroup.TriggerTimeTag
+                header['StartIndexCell'][row, g] = EvtGroup.StartIndexCell
+                for j in range(9):
+                    ChSize_ch = min(EvtGroup.ChSize[j], RecordLength)
+                    header['ChSize'][row, g, j] = ChSize_ch
+                    samples[g, j, :ChSize_ch] = X742_channelView(EvtGroup, j)[:ChSize_ch]
+                g += 1
+
+
     # Process the buffer and the events within   
     def processBuffer(self, bsize: ctypes.c_uint32, eventsNb: ctypes.c_uint32):
         """
@@ -795,12 +1043,32 @@ class CAENDT5742B():
         # Get the values for the bsize, eventsNb
         bsize = bsize.value
         eventsNb = eventsNb.value
+        
+        # Batch readout: the whole buffer is decoded at once, in a single foreign call or with the vectorized numpy decoder
+        sharedRing = self.sharedRing
+        if self.batchReadout:
+            if self.blockDecoder is not None:
+                batch = self.blockDecoder.decode(self.buffer, bsize, self.GroupEnableMask, self.RecordLength, eventsNb)
+            else:
+                batch = X742_parseBuffer(np.ctypeslib.as_array(ctypes.cast(self.buffer, ctypes.POINTER(ctypes.c_uint8)), (bsize,)), self.GroupEnableMask, self.RecordLength)
+            if self.drs4Correction is not None: self.drs4Correction(batch)
+            if self.zeroSuppression is not None:
+                batch = self.zeroSuppression.select(batch)
+                if len(batch) == 0: return
+                if sharedRing is not None: sharedRing.writeBatch(self.zeroSuppression.reduce(batch))
+            elif sharedRing is not None: sharedRing.writeBatch(batch)
+            # Single hand-off for the whole block
+            (self.eventReadout).put(batch)
+            return
 
         # Allocate the Event pointer
         ret = self.libCAENDigitizer.CAEN_DGTZ_AllocateEvent(self.handle, ctypes.byref(self.Evt))
         CAEN_DGTZ_ErrorHandler(ret)
         # (self.logging).trace("CAEN_DGTZ_AllocateEvent OK")
 
+        blockTimestamp = time.time()
+        # Samples of all the events of the buffer, allocated once (the queued events keep views of their rows)
+        eventBlock = None if self.eventRingMode else np.empty((eventsNb, X742_groupsNb(self.GroupEnableMask), 9, self.RecordLength), dtype=np.float32)
         # Unpack the events
         for i in range(0, eventsNb):
             # Get the event info
@@ -823,7 +1091,12 @@ class CAENDT5742B():
             ########################################
             # Event elaboration
             Evt = self.Evt.contents
-            self._processEvt(Evt)
+            self._processEvt(Evt, eventBlock[i] if eventBlock is not None else None)
+            # Copy for the local readers of the shared ring
+            if sharedRing is not None:
+                slot = sharedRing.reserve()
+                self._unpackEvt(Evt, sharedRing.header, sharedRing.samples, slot, blockTimestamp)
+                sharedRing.commit()
             # self.eventContainer.append(myEvent)
             ########################################
             ########## /Event elaboration ##########
@@ -861,7 +1134,7 @@ class CAENDT5742B():
     # Get the waveform with absolute units (timestamp, value) [s, V]
     def calibrated(self, waveform: np.ndarray) -> np.ndarray:
         #timestamps = np.linspace(0, 327.66e-6, 163830)
-        return waveform/self.dacFSR*1.0 - 0.5 + self.ChannelDCOffset_V
+        return self.calibration.toVolt(waveform)
     
     
     def findCalibration(self, wave, levels = (1.52e-3, 506.0e-3)):
@@ -923,7 +1196,7 @@ class CAENDT5742B():
                 waveformData = eventReadoutItem['data'][ch]
                 if len(waveformData) == 0: continue
                 ax.plot(waveformtime, waveformData, label=f"channel {ch}")
-                axx.plot(waveformtime, waveformData/self.dacFSR*1.0 - 0.5 + self.ChannelDCOffset_V)
+                axx.plot(waveformtime, self.calibrated(waveformData))
                 # axx.plot(waveformtime, (waveformData-self.dacFSR/2)/(self.dacFSR) - self.ChannelDCOffset_V)
             
         ax.legend(loc="upper right")
@@ -0,0 +1,143 @@
+#################################################################################################
+# @info Calibration of the digitizer samples: ADC counts -> V -> charge                         #
+#       A single set of per-channel tables shared by the DT5742B producer (online payload) and  #
+#       by rootconverter (offline ntuples), so the two give the same numbers:                   #
+#           V = m * ADC + q                  (digitizer, per channel)                           #
+#           Q = V / sensitivity              (Bergoz charge monitor, V/nC at the set gain)      #
+#       Whole blocks (N, channels, samples) are converted with a single multiply-add per block, #
+#       in place in float32 or into 16-bit fixed point (half the memory traffic downstream).    #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+import numpy as np
+
+# Bergoz calibration at CLEAR: gain [dB] -> sensitivity [V/nC]
+# Only the 32 dB entry is validated: the other gains of the original table are kept disabled
+BERGOZ_CLEAR_CAL = {
+   #6  : 2.085,
+   #12 : 4.180,
+   #18 : 8.350,
+   #20 : 10.42,
+   #26 : 20.95,
+    32 : 4.190,
+   #40 : 105.0
+}
+BERGOZ_DEFAULT_GAIN = 32
+
+# Sensitivity of the Bergoz charge monitor at a gain [V/nC]
+def bergozSensitivity(gain: int = BERGOZ_DEFAULT_GAIN) -> float:
+    if gain not in BERGOZ_CLEAR_CAL: raise ValueError(f"No Bergoz calibration for the gain {gain} dB (available {sorted(BERGOZ_CLEAR_CAL)})")
+    return BERGOZ_CLEAR_CAL[gain]
+
+
+class waveformCalibration():
+    # 16-bit fixed point output: V = value / 2**FIXED_POINT_BITS (range +-4 V, resolution 122 uV)
+    FIXED_POINT_BITS = 13
+    FIXED_POINT_dtype = np.int16
+
+    def __init__(self, m, q, sensitivity = BERGOZ_CLEAR_CAL[BERGOZ_DEFAULT_GAIN], adcRange: tuple = None) -> None:
+        """
+        Linear calibration of every channel, V = m * ADC + q, and charge Q = V / sensitivity
+
+        Parameters
+        ----------
+            m (float | np.ndarray) : (channels,) slope [V/ADC], a scalar for all the channels
+            q (float | np.ndarray) : (channels,) offset [V]
+            sensitivity (float | np.ndarray) : (channels,) charge monitor sensitivity [V/nC]
+            adcRange (tuple) : (min, max) ADC counts of the digitizer: the fixed point output is not saturated
+                               if the whole range fits (unknown range if None: always saturated)
+        """
+        self.m, self.q, self.sensitivity = (np.atleast_1d(np.asarray(value, dtype=np.float64)) for value in (m, q, sensitivity))
+        self.channels = max(len(self.m), len(self.q), len(self.sensitivity))
+        for name, value in [('m', self.m), ('q', self.q), ('sensitivity', self.sensitivity)]:
+            if len(value) not in (1, self.channels): raise ValueError(f"{name} has {len(value)} channels instead of {self.channels}")
+        # Block coefficients (channels, 1): float32 and scaled to the fixed point unit
+        self._m32, self._q32 = self.m[:, None].astype(np.float32), self.q[:, None].astype(np.float32)
+        scale = float(1 << self.FIXED_POINT_BITS)
+        self._mFixed, self._qFixed = (self.m[:, None] * scale).astype(np.float32), (self.q[:, None] * scale).astype(np.float32)
+        info = np.iinfo(self.FIXED_POINT_dtype)
+        self._saturate = True
+        if adcRange is not None:
+            limits = np.concatenate([self._mFixed * adcRange[0] + self._qFixed, self._mFixed * adcRange[1] + self._qFixed])
+            self._saturate = bool(limits.min() < info.min or limits.max() > info.max)
+
+    # DT5742B: full scale of 1 Vpp centred on the DC offset of the channels
+    @classmethod
+    def fromDT5742B(cls, dacFSR: float, ChannelDCOffset_V, bergozGain: int = BERGOZ_DEFAULT_GAIN):
+        return cls(1.0 / dacFSR, np.asarray(ChannelDCOffset_V, dtype=np.float64) - 0.5, bergozSensitivity(bergozGain), (0, dacFSR))
+
+    # Digitizer calibration measured as a line (e.g. CAENDT5742B.findCalibration, DT5730 dgtCalibration)
+    @classmethod
+    def fromLinear(cls, dgtCalibration, bergozGain: int = BERGOZ_DEFAULT_GAIN, adcRange: tuple = None):
+        return cls(dgtCalibration[0], dgtCalibration[1], bergozSensitivity(bergozGain), adcRange)
+
+    # Coefficient of a channel (or all of them if channel is None), broadcastable on values of that channel
+    @staticmethod
+    def _coefficient(table: np.ndarray, channel):
+        if channel is None: return table if len(table) > 1 else table[0]
+        return table[channel if len(table) > 1 else 0]
+
+    ### Element-wise conversions (statistics of the waveforms)
+    # ADC counts -> V
+    def toVolt(self, adc, channel = 0):
+        return adc * self._coefficient(self.m, channel) + self._coefficient(self.q, channel)
+
+    # Spread (std, amplitude) in ADC counts -> V: the offset does not apply
+    def toVoltSpread(self, adc, channel = 0):
+        return adc * np.abs(self._coefficient(self.m, channel))
+
+    # V -> nC
+    def toCharge(self, volt, channel = 0):
+        return volt / self._coefficient(self.sensitivity, channel)
+
+    ### Block conversions
+    def _checkBlock(self, samples: np.ndarray):
+        if self.channels > 1 and (samples.ndim < 2 or samples.shape[-2] != self.channels):
+            raise ValueError(f"Block of shape {samples.shape} does not have {self.channels} channels on the axis -2")
+
+    # Waveforms in V, in place
+    def apply(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Convert a block of waveforms from ADC counts to V in place
+
+        Parameters
+        ----------
+            samples (np.ndarray) : (N, channels, samples) float32 waveforms (e.g. X742_eventBatch.samples reshaped to (N, -1, RecordLength))
+
+        Returns
+        -------
+            samples (np.ndarray) : the same array, in V
+        """
+        self._checkBlock(samples)
+        samples *= self._m32
+        samples += self._q32
+        return samples
+
+    # Waveforms in V as 16-bit fixed point (value / 2**FIXED_POINT_BITS)
+    def toFixedPoint(self, samples: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Convert a block of waveforms from ADC counts to V in fixed point, saturating at the int16 range
+        (unless the ADC range of the digitizer cannot exceed it)
+
+        Parameters
+        ----------
+            samples (np.ndarray) : (N, channels, samples) waveforms [ADC counts], left untouched
+            out (np.ndarray) : int16 array of the same shape, allocated if None
+
+        Returns
+        -------
+            out (np.ndarray) : waveforms [2**-FIXED_POINT_BITS V]
+        """
+        self._checkBlock(samples)
+        scaled = np.multiply(samples, self._mFixed, dtype=np.float32)
+        scaled += self._qFixed
+        if self._saturate:
+            info = np.iinfo(self.FIXED_POINT_dtype)
+            np.clip(scaled, info.min, info.max, out=scaled)
+        np.rint(scaled, out=scaled)
+        if out is None: out = np.empty(samples.shape, dtype=self.FIXED_POINT_dtype)
+        out[...] = scaled
+        return out
+
+    # Fixed point waveforms back to V (float32)
+    def fromFixedPoint(self, values: np.ndarray) -> np.ndarray:
+        return values.astype(np.float32) * np.float32(1.0 / (1 << self.FIXED_POINT_BITS))
@@ -0,0 +1,192 @@
+#################################################################################################
+# @info Multi-process decoding of the DT5742B readout blocks                                    #
+#       The acquisition thread only copies every raw block into a free slot of a shared memory  #
+#       area; a pool of worker processes decode (and optionally reduce) the blocks outside the  #
+#       GIL of the producer, and a collector thread hands the results over in readout order     #
+#       through a reorder buffer.                                                               #
+#                                                                                               #
+#   acquireLoop --submit()--> [slot] --tasks--> worker 1..n --results--> collector --> queue    #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+from multiprocessing import shared_memory
+from x742decoder import X742_blockDecoder, X742_parseBuffer, X742_eventBatch, X742_groupsNb
+from logger import create_logger
+import multiprocessing
+import threading
+import traceback
+import numpy as np
+import ctypes
+import queue
+import time
+import os
+
+
+# Failure of a block in a worker process, with the traceback of the worker
+class decodeWorkerError(Exception):
+    pass
+
+
+# Worker process: decode the blocks of the shared memory slots
+def _decodeWorker(shmName: str, slotSize: int, GroupEnableMask: int, RecordLength: int, libX742DecodeBlock_path: str, reducer, correction, suppression, tasks, results):
+    shm = shared_memory.SharedMemory(name=shmName)
+    raw = np.ndarray((shm.size,), dtype=np.uint8, buffer=shm.buf)
+    blockDecoder = X742_blockDecoder(libX742DecodeBlock_path) if libX742DecodeBlock_path is not None else None
+    # Reduced batches do not leave the worker: they are decoded into the same preallocated batch (grown to the largest block)
+    out = None
+    try:
+        while True:
+            task = tasks.get()
+            if task is None: break
+            seq, slot, bsize, eventsNb, blockTimestamp = task
+            try:
+                block = raw[slot * slotSize : slot * slotSize + bsize]
+                if blockDecoder is not None:
+                    if reducer is not None and (out is None or len(out) < eventsNb): out = X742_eventBatch(eventsNb, X742_groupsNb(GroupEnableMask), RecordLength)
+                    batch = blockDecoder.decode(block, bsize, GroupEnableMask, RecordLength, eventsNb, out if reducer is not None else None)
+                else:
+                    batch = X742_parseBuffer(block, GroupEnableMask, RecordLength)
+                batch.header['blockTimestamp'] = blockTimestamp
+                if correction is not None: correction(batch)
+                if suppression is not None: batch = suppression.select(batch)
+                results.put((seq, slot, reducer(batch) if reducer is not None else batch))
+            except Exception:
+                results.put((seq, slot, decodeWorkerError(traceback.format_exc())))
+    finally:
+        del raw
+        shm.close()
+
+
+class decodePool():
+    # Interval of the checks of the workers while waiting for a free slot [s]
+    SLOT_WAIT_TIMEOUT_s = 1.0
+
+    def __init__(self, outputQueue, GroupEnableMask: int, RecordLength: int, slotSize: int, workers: int = None, slots: int = None, libX742DecodeBlock_path: str = None, reducer = None, correction = None, suppression = None) -> None:
+        """
+        Start the worker processes and the collector thread
+
+        Parameters
+        ----------
+            outputQueue (queue.Queue | eventQueue) : destination of the results, in readout order
+            GroupEnableMask (int) : groups to be decoded
+            RecordLength (int) : number of samples per channel
+            slotSize (int) : size of a slot, i.e. the largest readout block [bytes] (size of the readout buffer)
+            workers (int) : number of worker processes (number of cores if None)
+            slots (int) : number of shared memory slots, i.e. blocks in flight (2 per worker if None)
+            libX742DecodeBlock_path (str) : bulk decoder library, the numpy decoder is used if None
+            reducer (callable) : picklable function applied by the workers to every X742_eventBatch
+                                 (e.g. dt5742bdsp.batchReducer); the batches are returned if None. With the bulk decoder
+                                 the batch is reused for the next block: the result must not hold views of it
+            correction (callable) : picklable in-place correction of every X742_eventBatch, applied before
+                                    the reducer (e.g. drs4correction.drs4Corrector)
+            suppression (zeroSuppressor) : picklable zerosuppression.zeroSuppressor, its select (quiet channels and events)
+                                           is applied after the correction; its counters stay in the workers
+        """
+        self.logging = create_logger("decodePool")
+        self.outputQueue = outputQueue
+        self.slotSize = slotSize
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.slots = slots if slots is not None else 2 * self.workers
+
+        # Shared memory slots of the raw blocks
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots * slotSize)
+        self._shmAddress = ctypes.addressof(ctypes.c_char.from_buffer(self._shm.buf))
+        self._freeSlots = queue.Queue()
+        for slot in range(self.slots): self._freeSlots.put(slot)
+
+        # Worker processes (spawned: the producer runs several threads)
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._processes = [context.Process(target=_decodeWorker, args=(self._shm.name, slotSize, GroupEnableMask, RecordLength, libX742DecodeBlock_path, reducer, correction, suppression, self._tasks, self._results), daemon=True) for i in range(self.workers)]
+        for process in self._processes: process.start()
+
+        # Reorder buffer: results are handed over by sequence number
+        self._nextSubmit = 0
+        self._nextOutput = 0
+        self._pending = {}
+        self._collectorThread = threading.Thread(target=self._collect, daemon=True)
+        self._collectorThread.start()
+
+        # Counters
+        self.blocksNb = 0
+        self.errorsNb = 0
+        self.reorderHighWater = 0
+        self.slotWait_s = 0.0
+
+    # Queue a readout block for decoding (acquisition thread)
+    def submit(self, buffer, bsize: int, eventsNb: int, blockTimestamp: float = None):
+        """
+        Copy the readout block into a free slot and queue it to the workers. Blocks while all the
+        slots are in flight (back-pressure on the acquisition)
+
+        Parameters
+        ----------
+            buffer (ctypes.POINTER(ctypes.c_char) | bytes-like) : readout buffer (CAEN_DGTZ_ReadData)
+            bsize (int) : size of the block [bytes]
+            eventsNb (int) : number of events in the block
+            blockTimestamp (float) : posix time of the readout (time.time() if None)
+        """
+        if bsize > self.slotSize: raise ValueError(f"Readout block larger than the slots ({bsize} > {self.slotSize} bytes)")
+        blockTimestamp = time.time() if blockTimestamp is None else blockTimestamp
+        startTime = time.perf_counter()
+        while True:
+            try:
+                slot = self._freeSlots.get(timeout=self.SLOT_WAIT_TIMEOUT_s)
+                break
+            except queue.Empty:
+                # A dead worker never gives its slot back
+                self._checkWorkers()
+        self.slotWait_s += time.perf_counter() - startTime
+        if isinstance(buffer, (bytes, bytearray, memoryview, np.ndarray)):
+            self._shm.buf[slot * self.slotSize : slot * self.slotSize + bsize] = memoryview(buffer).cast('B')[:bsize]
+        else:
+            ctypes.memmove(self._shmAddress + slot * self.slotSize, buffer, bsize)
+        self._tasks.put((self._nextSubmit, slot, bsize, eventsNb, blockTimestamp))
+        self._nextSubmit += 1
+        self.blocksNb += 1
+
+    # Collector thread: free the slots and hand over the results in readout order
+    def _collect(self):
+        while True:
+            result = self._results.get()
+            if result is None: break
+            seq, slot, item = result
+            self._pending[seq] = (slot, item)
+            self.reorderHighWater = max(self.reorderHighWater, len(self._pending))
+            while self._nextOutput in self._pending:
+                slot, item = self._pending.pop(self._nextOutput)
+                self._nextOutput += 1
+                # Slots are recycled in readout order: blocks in flight and reorder buffer are bounded by the slots
+                self._freeSlots.put(slot)
+                if isinstance(item, Exception):
+                    self.errorsNb += 1
+                    self.logging.error(f"Block {self._nextOutput - 1} discarded, decoding failed in a worker:\n{item}")
+                    continue
+                self.outputQueue.put(item)
+
+    # Raise if a worker process has died (its blocks in flight are lost)
+    def _checkWorkers(self):
+        dead = [process for process in self._processes if not process.is_alive()]
+        if dead: raise RuntimeError(f"{len(dead)} decode worker(s) died (exit codes {[process.exitcode for process in dead]}), blocks in flight are lost")
+
+    # Counters of the pool
+    def getStats(self) -> dict:
+        return {
+            'workers'           : self.workers,
+            'slots'             : self.slots,
+            'blocks'            : self.blocksNb,
+            'errors'            : self.errorsNb,
+            'inFlight'          : self._nextSubmit - self._nextOutput,
+            'reorderHighWater'  : self.reorderHighWater,
+            'slotWait_s'        : self.slotWait_s
+        }
+
+    # Wait for the blocks in flight, stop the workers and release the shared memory
+    def close(self):
+        for process in self._processes: self._tasks.put(None)
+        for process in self._processes: process.join()
+        self._results.put(None)
+        self._collectorThread.join()
+        self._shmAddress = None
+        self._shm.close()
+        self._shm.unlink()
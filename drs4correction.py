@@ -0,0 +1,266 @@
+#################################################################################################
+# @info DRS4 corrections of the DT5742B samples, applied to whole blocks of events              #
+#       The DRS4 chip of every group samples on a ring of 1024 cells and the readout starts at  #
+#       StartIndexCell, so the offset and time corrections of a sample depend on its cell.      #
+#       The correction tables of the board (CAEN_DGTZ_GetCorrectionTables) are loaded once,     #
+#       cached by serial number and DRS4 frequency, and turned into lookup tables doubled over  #
+#       two turns of the ring: the offsets of a record are a contiguous window starting at its  #
+#       cell, and the time interpolation of every start cell is precomputed, so a whole block   #
+#       is corrected with row gathers, without any modulo or per-event loop.                    #
+#                                                                                               #
+#   corrections: cell offset, index (nsample) offset, spikes (peak), cell time (resampling)     #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+import numpy as np
+import ctypes
+
+DRS4_CELLS = 1024
+DRS4_CHANNELS = 9                           # 8 channels + trigger channel per group
+DRS4_GROUPS = 4
+# Sampling frequency of the CAEN_DGTZ_DRS4Frequency_t values [Hz]
+DRS4_FREQUENCY_Hz = {0: 5.0e9, 1: 2.5e9, 2: 1.0e9, 3: 750.e6}
+
+
+# Correction table of a group (CAENDigitizerType.h)
+class CAEN_DGTZ_DRS4Correction_t(ctypes.Structure):
+    _fields_ = [
+        ("cell",    (ctypes.c_int16 * DRS4_CELLS) * DRS4_CHANNELS),     # offset of every cell [ADC]
+        ("nsample", (ctypes.c_int8 * DRS4_CELLS) * DRS4_CHANNELS),      # offset of every sample index [ADC]
+        ("time",    ctypes.c_float * DRS4_CELLS)]                       # time of every cell in the ring [ns]
+
+
+class drs4CorrectionTables():
+    def __init__(self, cell: np.ndarray, nsample: np.ndarray, time: np.ndarray, frequency: int, serialNumber: int = 0) -> None:
+        """
+        Correction tables of the 4 groups of a board at a DRS4 frequency
+
+        Parameters
+        ----------
+            cell (np.ndarray) : (4, 9, 1024) offset of every cell [ADC]
+            nsample (np.ndarray) : (4, 9, 1024) offset of every sample index [ADC]
+            time (np.ndarray) : (4, 1024) time of every cell in the ring [ns]
+            frequency (int) : CAEN_DGTZ_DRS4Frequency_t of the tables
+            serialNumber (int) : serial number of the board
+        """
+        self.cell = np.asarray(cell, dtype=np.float32)
+        self.nsample = np.asarray(nsample, dtype=np.float32)
+        self.time = np.asarray(time, dtype=np.float64)
+        self.frequency = int(frequency)
+        self.serialNumber = int(serialNumber)
+        self.SamplingPeriod_ns = 1e9 / DRS4_FREQUENCY_Hz[self.frequency]
+
+        # Lookup tables over two turns of the ring, indexed by StartIndexCell + sample
+        self.cell2 = np.concatenate([self.cell, self.cell], axis=-1)
+        ## Time step from every cell to the next one, the last cell steps to the first one a turn of the ring later
+        step = np.roll(self.time, -1, axis=-1) - self.time
+        step[:, -1] += self.SamplingPeriod_ns * DRS4_CELLS
+        # Tables not increasing around the ring would give a non-monotonic time axis to the time correction
+        if np.any(step <= 0): raise ValueError(f"Cell times not increasing around the ring (smallest step {step.min():.3f} ns)")
+        self.cellTime2 = np.zeros((len(self.time), 2 * DRS4_CELLS + 1))
+        self.cellTime2[:, 1:] = np.cumsum(np.concatenate([step, step], axis=-1), axis=-1)
+
+    # Tables read from the board by the CAEN library
+    @classmethod
+    def fromLibrary(cls, libCAENDigitizer, handle, frequency: int, serialNumber: int = 0):
+        tables = (CAEN_DGTZ_DRS4Correction_t * DRS4_GROUPS)()
+        ret = libCAENDigitizer.CAEN_DGTZ_GetCorrectionTables(handle, frequency, ctypes.byref(tables))
+        if ret != 0: raise RuntimeError(f"CAEN_DGTZ_GetCorrectionTables failed ({ret})")
+        cell = np.array([np.ctypeslib.as_array(table.cell) for table in tables])
+        nsample = np.array([np.ctypeslib.as_array(table.nsample) for table in tables])
+        time = np.array([np.ctypeslib.as_array(table.time) for table in tables])
+        return cls(cell, nsample, time, frequency, serialNumber)
+
+    # Tables saved with save()
+    @classmethod
+    def load(cls, fname: str):
+        with np.load(fname) as data:
+            return cls(data['cell'], data['nsample'], data['time'], int(data['frequency']), int(data['serialNumber']))
+
+    def save(self, fname: str):
+        np.savez(fname, cell=self.cell, nsample=self.nsample, time=self.time, frequency=self.frequency, serialNumber=self.serialNumber)
+
+
+# Tables already loaded, by (serial number, DRS4 frequency)
+_correctionTablesCache = {}
+
+# Correction tables of a board, read from the board (or from fname if given) only the first time
+def getCorrectionTables(libCAENDigitizer, handle, serialNumber: int, frequency: int, fname: str = None) -> drs4CorrectionTables:
+    key = (int(serialNumber), int(frequency))
+    if key not in _correctionTablesCache:
+        if fname is not None:
+            tables = drs4CorrectionTables.load(fname)
+            if (tables.serialNumber, tables.frequency) != key: raise ValueError(f"{fname} holds the tables of board {tables.serialNumber} at frequency {tables.frequency}, not {key}")
+        else:
+            tables = drs4CorrectionTables.fromLibrary(libCAENDigitizer, handle, frequency, serialNumber)
+        _correctionTablesCache[key] = tables
+    return _correctionTablesCache[key]
+
+
+class drs4Corrector():
+    # Corrections (CorrectionLevelMask bits of the CAEN X742 correction routines, plus the spike removal)
+    CORRECTION_CELL = 0x1           # offset of the cell of every sample
+    CORRECTION_NSAMPLE = 0x2        # offset of the sample index
+    CORRECTION_TIME = 0x4           # resampling on a uniform time grid from the cell times
+    CORRECTION_PEAK = 0x8           # spikes common to the 8 channels of a group
+    CORRECTION_ALL = 0xF
+
+    def __init__(self, tables: drs4CorrectionTables, GroupEnableMask: int, RecordLength: int, corrections: int = 0xF, peakThreshold: float = 30.0) -> None:
+        """
+        In-place corrections of the X742_eventBatch blocks of a digitizer configuration
+
+        Parameters
+        ----------
+            tables (drs4CorrectionTables) : tables of the board at the acquisition frequency
+            GroupEnableMask (int) : enabled groups (the groups of the batches, in ascending order)
+            RecordLength (int) : samples per channel
+            corrections (int) : CORRECTION_* bits
+            peakThreshold (float) : minimum depth of a spike [ADC]
+        """
+        if RecordLength > DRS4_CELLS: raise ValueError(f"Record length larger than the DRS4 ring ({RecordLength})")
+        self.tables = tables
+        self.corrections = corrections
+        self.peakThreshold = peakThreshold
+        self.RecordLength = RecordLength
+        self.groups = np.array([g for g in range(DRS4_GROUPS) if (GroupEnableMask >> g) & 1])
+        self._prepare()
+        # Events processed
+        self.eventsNb = 0
+
+    # Lookup tables of the configuration (rebuilt instead of pickled, e.g. when sent to the decodepool workers)
+    def _prepare(self):
+        RecordLength, tables = self.RecordLength, self.tables
+        self._sample = np.arange(RecordLength)
+        self._nsample = tables.nsample[self.groups][:, :, :RecordLength]
+        self._uniformTime = self._sample * tables.SamplingPeriod_ns
+        # Cell offsets of the records starting at every cell: (groups, 9, start cell, RecordLength) view of the doubled table
+        self._cellWindows = np.lib.stride_tricks.sliding_window_view(tables.cell2[self.groups], RecordLength, axis=-1)
+        # Interpolation of the time correction for every start cell: lower sample and weight, (groups, start cell, RecordLength)
+        if self.corrections & self.CORRECTION_TIME:
+            self._timeIndex, self._timeWeight = self._interpolationTables()
+
+    def __getstate__(self) -> dict:
+        return {key: value for key, value in self.__dict__.items() if key in ('tables', 'corrections', 'peakThreshold', 'RecordLength', 'groups', 'eventsNb')}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._prepare()
+
+    # Cells of the samples of every event and group: (N, groups, RecordLength) indices in the doubled tables
+    def cellIndex(self, StartIndexCell: np.ndarray) -> np.ndarray:
+        return StartIndexCell.astype(np.intp)[:, :, None] + self._sample
+
+    # Time of every sample from the start cell [ns]: (N, groups, RecordLength)
+    def sampleTime(self, StartIndexCell: np.ndarray) -> np.ndarray:
+        cellTime2 = self.tables.cellTime2[self.groups]
+        index = self.cellIndex(StartIndexCell)
+        groupIndex = np.arange(len(self.groups))[None, :, None]
+        return cellTime2[groupIndex, index] - cellTime2[groupIndex, index[:, :, :1]]
+
+    # Linear interpolation on the uniform time grid of the records starting at every cell
+    def _interpolationTables(self) -> tuple:
+        groups, RL = len(self.groups), self.RecordLength
+        StartIndexCell = np.broadcast_to(np.arange(DRS4_CELLS)[:, None], (DRS4_CELLS, groups))
+        times = self.sampleTime(StartIndexCell).transpose(1, 0, 2).reshape(-1, RL)
+        rows = len(times)
+        # A single search over all the rows, shifted apart by more than a turn of the ring
+        shift = (np.arange(rows) * (2 * DRS4_CELLS * self.tables.SamplingPeriod_ns))[:, None]
+        k = np.searchsorted((times + shift).ravel(), (self._uniformTime + shift).ravel()).reshape(rows, RL)
+        k -= (np.arange(rows) * RL)[:, None]
+        np.clip(k, 1, RL - 1, out=k)
+        t0, t1 = np.take_along_axis(times, k - 1, axis=1), np.take_along_axis(times, k, axis=1)
+        weight = (self._uniformTime - t0) / (t1 - t0)
+        return (k - 1).astype(np.int32).reshape(groups, DRS4_CELLS, RL), weight.astype(np.float32).reshape(groups, DRS4_CELLS, RL)
+
+    # Replace the spikes seen by all the 8 channels of a group with the neighbouring samples
+    def _peakCorrection(self, samples: np.ndarray):
+        samples[..., 0] = samples[..., 1]
+        data = samples[:, :, :8]
+        before = data[..., :-3] - data[..., 1:-2] > self.peakThreshold
+        # Single sample spikes (samples 1 .. RL-3)
+        single = (before & (data[..., 2:-1] - data[..., 1:-2] > self.peakThreshold)).all(axis=2)
+        # Two samples spikes (samples 1,2 .. RL-3,RL-2)
+        double = (before & (data[..., 3:] - data[..., 1:-2] > self.peakThreshold)).all(axis=2) & ~single
+        event, group, i = np.nonzero(single)
+        samples[event, group, :, i + 1] = (samples[event, group, :, i] + samples[event, group, :, i + 2]) / 2
+        event, group, i = np.nonzero(double)
+        samples[event, group, :, i + 1] = samples[event, group, :, i + 2] = (samples[event, group, :, i] + samples[event, group, :, i + 3]) / 2
+
+    # Resample every channel on the uniform time grid, interpolating between the cell times
+    def _timeCorrection(self, samples: np.ndarray, StartIndexCell: np.ndarray):
+        N, G, C, RL = samples.shape
+        group = np.arange(G)[None, :]
+        lower = self._timeIndex[group, StartIndexCell][:, :, None, :]
+        weight = self._timeWeight[group, StartIndexCell][:, :, None, :]
+        # Flat indices of the lower samples in the whole block: a single 1D gather per interpolation node
+        row = np.arange(N * G * C).reshape(N, G, C, 1) * RL
+        index = row + lower
+        flat = samples.reshape(-1)
+        v0 = flat[index]
+        v1 = flat[index + 1]
+        v1 -= v0
+        v1 *= weight
+        v1 += v0
+        samples[...] = v1
+
+    # Correct a block of events in place
+    def apply(self, batch):
+        """
+        Apply the corrections to all the events of a X742_eventBatch, in place
+
+        Parameters
+        ----------
+            batch (X742_eventBatch) : decoded events, samples (N, groups, 9, RecordLength)
+
+        Returns
+        -------
+            batch (X742_eventBatch) : the same batch, corrected
+        """
+        if len(batch) == 0: return batch
+        samples = batch.samples
+        StartIndexCell = batch.header['StartIndexCell']
+        # Channels without samples (e.g. trigger channel not digitized) are left untouched
+        present = (batch.header['ChSize'] > 0)[..., None]
+        allPresent = present.all()
+        if self.corrections & self.CORRECTION_CELL:
+            for g in range(len(self.groups)):
+                offset = self._cellWindows[g][:, StartIndexCell[:, g]].swapaxes(0, 1)
+                samples[:, g] -= offset if allPresent else offset * present[:, g]
+        if self.corrections & self.CORRECTION_NSAMPLE:
+            samples -= self._nsample if allPresent else self._nsample * present
+        if self.corrections & self.CORRECTION_PEAK:
+            self._peakCorrection(samples)
+        if self.corrections & self.CORRECTION_TIME:
+            self._timeCorrection(samples, StartIndexCell)
+        self.eventsNb += len(batch)
+        return batch
+
+    __call__ = apply
+
+    # Reference correction of a single event, one channel at a time (np.roll of the cell tables)
+    def applyEvent(self, samples: np.ndarray, StartIndexCell: np.ndarray) -> np.ndarray:
+        """
+        Correct one event channel by channel, as done by the CAEN X742 correction routines
+        (reference of apply() and baseline of the benchmark)
+
+        Parameters
+        ----------
+            samples (np.ndarray) : (groups, 9, RecordLength) samples of the event, corrected in place
+            StartIndexCell (np.ndarray) : (groups,) start cells of the event
+        """
+        for g, group in enumerate(self.groups):
+            for ch in range(DRS4_CHANNELS):
+                if self.corrections & self.CORRECTION_CELL:
+                    samples[g, ch] -= np.roll(self.tables.cell[group, ch], -int(StartIndexCell[g]))[:self.RecordLength]
+                if self.corrections & self.CORRECTION_NSAMPLE:
+                    samples[g, ch] -= self._nsample[g, ch]
+        if self.corrections & self.CORRECTION_PEAK:
+            self._peakCorrection(samples[None])
+        if self.corrections & self.CORRECTION_TIME:
+            for g, group in enumerate(self.groups):
+                step = np.roll(np.diff(self.tables.cellTime2[group, :DRS4_CELLS + 1]), -int(StartIndexCell[g]))[:self.RecordLength - 1]
+                times = np.concatenate([[0.0], np.cumsum(step)])
+                k = np.clip(np.searchsorted(times, self._uniformTime), 1, self.RecordLength - 1)
+                weight = (self._uniformTime - times[k - 1]) / (times[k] - times[k - 1])
+                for ch in range(DRS4_CHANNELS):
+                    samples[g, ch] = samples[g, ch, k - 1] + (samples[g, ch, k] - samples[g, ch, k - 1]) * weight
+        return samples
@@ -8,7 +8,17 @@
 #                                               more text here eventually                       #
 #                                               more text here eventually                       #
 #################################################################################################
-from caendt5742b import CAENDT5742B
+from caendt5742b import CAENDT5742B, X742_eventRing, X742_eventBatch
+from eventring import eventRing
+from eventqueue import eventQueue
+from rawrecorder import rawRecorder
+from simdigitizer import simulatedDigitizer, syntheticSource, replaySource
+from sharedring import sharedRingWriter
+from dt5742bdsp import dt5742b_dtypes, processWaveforms, processBatch, batchReducer, payloadBuilder
+from calibration import waveformCalibration
+from pulsefeatures import pulseFeatureExtractor
+from x742decoder import X742_groupsNb
+from zerosuppression import zeroSuppressor
 import threading
 import queue
 
@@ -18,7 +28,6 @@ import pyeudaq
 import time
 
 ## DT5742B datatype
-dt5742b_dtypes = [('run',np.uint32),('runTime',np.float64),('event',np.uint32),('timestamp',np.float64),('dgt_evt',np.uint32),('dgt_trgtime',np.uint64),('dgt_evtsize',np.uint32),('avg',np.float64),('std',np.float64),('ptNb',np.uint32),('avgV',np.float64),('stdV',np.float64),('avgQ',np.float64)]
 dt5742bStruct = np.zeros(1, dtype=dt5742b_dtypes)
 
 
@@ -42,6 +51,10 @@ class dt5742bEUDAQ(pyeudaq.Producer):
 
         # Event readout queue buffer
         self.eventsReadout = queue.Queue()
+        # Aggregation of the processed events in the EUDAQ payloads
+        self.payload = payloadBuilder()
+        # Pulse features of all the channels (batch readout or decode workers)
+        self.pulseFeatures = None
 
     @exception_handler
     def DoInitialise(self):        
@@ -83,9 +96,42 @@ class dt5742bEUDAQ(pyeudaq.Producer):
             'ChannelDCOffset' : int(confDict['ChannelDCOffset'], 16)
         }
         print("dt5742bConfiguration", dt5742bConfiguration)
+        
+        # Optional preallocated ring buffer replacing the per-event dicts on the readout queue
+        readoutRingSize = int(confDict.get('ReadoutRingSize', '0'))
+        if readoutRingSize > 0:
+            self.eventsReadout = X742_eventRing(readoutRingSize, dt5742bConfiguration['GroupEnableMask'], dt5742bConfiguration['RecordLength'], confDict.get('ReadoutRingPolicy', 'drop_newest'))
+        elif int(confDict.get('ReadoutQueueSize', '0')) > 0:
+            # Bounded queue: back-pressure, drops or spill to disk when the producer falls behind
+            self.eventsReadout = eventQueue(int(confDict['ReadoutQueueSize']), confDict.get('ReadoutQueuePolicy', 'block'), confDict.get('ReadoutSpillPath') or None, int(float(confDict.get('ReadoutSpillMaxBytes', '0'))))
+        else:
+            self.eventsReadout = queue.Queue()
+        # Optional hand-off of whole readout blocks (X742_eventBatch) instead of single events
+        batchReadout = bool(int(confDict.get('BatchReadout', '0')))
+        # Pulse features (baseline, peak, integral, CFD time) of every channel, sent in the payload next to the rows
+        self.pulseFeatures = None
+        if int(confDict.get('PulseFeatures', '0')):
+            window = lambda key, default: tuple(int(value) for value in confDict.get(key, default).split(':'))
+            self.pulseFeatures = pulseFeatureExtractor(window('PulseBaselineWindow', '0:100'), window('PulseIntegralWindow', '0:1024'), int(confDict.get('PulsePolarity', '-1')), float(confDict.get('PulseCFDFraction', '0.5')))
+            if not batchReadout and int(confDict.get('DecodeWorkers', '0')) == 0: pyeudaq.EUDAQ_WARN("Pulse features are computed only with the batch readout or the decode workers")
+        featureChannels = 9 * X742_groupsNb(dt5742bConfiguration['GroupEnableMask']) if self.pulseFeatures is not None else 0
+        # Events packed in a single EUDAQ event (up to EventsPerPayload, sent at most PayloadTimeBudget_s after the first one)
+        self.payload = payloadBuilder(int(confDict.get('EventsPerPayload', '1')), float(confDict.get('PayloadTimeBudget_s', '0')), featureChannels)
+        # Polling strategy of the readout loop
+        polling = CAENDT5742B.pollingPolicy(mode = confDict.get('PollingMode', 'fixed'), maxSleep_s = float(confDict.get('PollingMaxSleep_s', '0.040')))
 
+        # Simulated digitizer (off-beam tests): synthetic waveforms or replay of a recorded run
+        simulationSource = confDict.get('SimulationSource', '')
+        backend = None
+        if simulationSource:
+            source = syntheticSource() if simulationSource == 'synthetic' else replaySource(simulationSource)
+            backend = simulatedDigitizer(source, triggerRate_Hz = float(confDict.get('SimulationTriggerRate_Hz', '0')))
+            pyeudaq.EUDAQ_WARN(f"Simulated digitizer in use ({simulationSource})")
+        
         # # Instance the CAENDT5742B controller class
-        self.dgt = CAENDT5742B(usbLinkID = usbLinkID, evtReadoutQueue = self.eventsReadout, eventCutoff=25)
+        self.dgt = CAENDT5742B(usbLinkID = usbLinkID, evtReadoutQueue = self.eventsReadout, eventCutoff=25, batchReadout = batchReadout, polling = polling, libX742DecodeBlock_path = confDict.get('libX742DecodeBlock_path'), decodeOnline = bool(int(confDict.get('DecodeOnline', '1'))), backend = backend, decodeWorkers = int(confDict.get('DecodeWorkers', '0')))
+        # Raw recording of the readout blocks (a .raw/.idx pair per run)
+        self.rawRecordingPath = confDict.get('RawRecordingPath', '')
         try:
             self.dgt.open()
         except Exception as e:
@@ -94,6 +140,29 @@ class dt5742bEUDAQ(pyeudaq.Producer):
             else:
                 raise e
         self.dgt.setup_DT5742B(**dt5742bConfiguration)
+        # DRS4 corrections of the decoded blocks (tables read once per board and frequency, or from DRS4CorrectionFile)
+        self.dgt.loadDRS4Correction(int(confDict.get('DRS4Correction', '0'), 0), confDict.get('DRS4CorrectionFile') or None)
+        # Software zero suppression, region of interest and decimation of the decoded blocks (X742 boards have none in hardware)
+        zeroSuppressionThreshold = float(confDict.get('ZeroSuppressionThreshold', '0'))
+        zeroSuppressionROI = confDict.get('ZeroSuppressionROI', '')
+        decimation = int(confDict.get('DecimationFactor', '1'))
+        self.dgt.zeroSuppression = None
+        if zeroSuppressionThreshold > 0 or zeroSuppressionROI or decimation > 1:
+            self.dgt.zeroSuppression = zeroSuppressor(zeroSuppressionThreshold, dropEvents = bool(int(confDict.get('ZeroSuppressionDropEvents', '1'))),
+                                                      roi = tuple(int(value) for value in zeroSuppressionROI.split(':')) if zeroSuppressionROI else None, decimation = decimation)
+            if not batchReadout and self.dgt.decodeWorkers == 0: pyeudaq.EUDAQ_WARN("Zero suppression is applied only with the batch readout or the decode workers")
+        # ADC -> V -> nC of the payload, same tables as rootconverter (calibration.BERGOZ_CLEAR_CAL)
+        self.dgt.calibration = waveformCalibration.fromDT5742B(self.dgt.dacFSR, self.dgt.ChannelDCOffset_V, int(confDict.get('BergozGain', '32')))
+        # The decode workers also reduce the blocks to the payload rows (calibration of the current setup)
+        if self.pulseFeatures is not None: self.pulseFeatures.SamplingPeriod_ns = self.dgt.SamplingPeriod_s * 1e9
+        self.dgt.decodeReducer = batchReducer(self.dgt.calibration, self.pulseFeatures)
+        # Shared memory fan-out of the decoded events to local readers (online monitors)
+        sharedRingName = confDict.get('SharedRingName', '')
+        previous = self.dgt.setSharedRing(sharedRingWriter(sharedRingName, int(confDict.get('SharedRingSize', '4096')), dt5742bConfiguration['GroupEnableMask'], dt5742bConfiguration['RecordLength']) if sharedRingName else None)
+        if previous is not None: previous.close()
+        if sharedRingName and self.dgt.decodeWorkers > 0: pyeudaq.EUDAQ_WARN("The shared ring is not filled when decoding in worker processes")
+        if (zeroSuppressionROI or decimation > 1) and (not sharedRingName or self.dgt.decodeWorkers > 0):
+            pyeudaq.EUDAQ_WARN("ZeroSuppressionROI and DecimationFactor apply only to the shared ring, the payload is computed on whole records")
         # Run the acquisition loop thread
         self.dgtHWLoopThread = threading.Thread(target=self.dgt.acquireLoop, args=(), daemon=True)
         self.dgtHWLoopThread.start()
@@ -109,12 +178,28 @@ class dt5742bEUDAQ(pyeudaq.Producer):
         dt5742bStruct['run'] = self.GetRunNumber()
         dt5742bStruct['runTime'] = time.time()
         
+        # Start the raw recording of the run
+        if self.rawRecordingPath:
+            fname = f"{self.rawRecordingPath.rstrip('/')}/dt5742b_run{int(dt5742bStruct['run'][0]):06d}_{time.strftime('%y%m%d%H%M%S')}"
+            self.dgt.setRawRecorder(rawRecorder(fname))
+            pyeudaq.EUDAQ_INFO(f"Raw recording to {fname}.raw")
+        
         
     @exception_handler
     def DoStopRun(self):
         pyeudaq.EUDAQ_INFO('DoStopRun')
         self.is_running = 0
         self.dgt.setDaqLoop(False)
+        recorder = self.dgt.setRawRecorder(None)
+        if recorder is not None:
+            recorder.close()
+            pyeudaq.EUDAQ_INFO(f"Raw recording closed: {recorder.blocksNb} blocks, {recorder.eventsNb} events, {recorder.offset} bytes")
+        if isinstance(self.eventsReadout, eventRing):
+            pyeudaq.EUDAQ_INFO(f"Readout ring stats: {self.eventsReadout.getStats()}")
+        elif isinstance(self.eventsReadout, eventQueue):
+            pyeudaq.EUDAQ_INFO(f"Readout queue stats: {self.eventsReadout.getStats()}")
+        if hasattr(self.dgt, 'stats'):
+            pyeudaq.EUDAQ_INFO(f"Readout poll rate: {self.dgt.stats.getPollRate():.1f} Hz")
         print("DoStopRun")
 
 
@@ -138,10 +223,6 @@ class dt5742bEUDAQ(pyeudaq.Producer):
         return 0
 
 
-    def bergozMap_toCharge(self, voltage):
-        return voltage * 50.0
-
-
     def processEvent(self, event: int, dgtEventItem: dict):
         if 'data' not in dgtEventItem: return
         
@@ -154,37 +235,86 @@ class dt5742bEUDAQ(pyeudaq.Producer):
         dt5742bStruct['dgt_trgtime'] = dgtEventItem['TrgInfo'].EventCounter
         dt5742bStruct['dgt_evtsize'] = len(waveformData)
         
-        # Calculate the average value over the last 100 samples (dirty)
-        dt5742bStruct['avg'] = np.mean(waveformData[:-100])
-        dt5742bStruct['std'] = np.std(waveformData[:-100])
-        dt5742bStruct['ptNb'] = 100
-        dt5742bStruct['avgV'] = self.dgt.calibrated(dt5742bStruct['avg'])
-        dt5742bStruct['stdV'] = self.dgt.calibrated(dt5742bStruct['std'])
+        # Average, std, calibrated voltage and charge (block of a single event)
+        processWaveforms(waveformData[None, :], self.dgt.calibration, out = dt5742bStruct)
+
+
+    def processEventRing(self, event: int, slot: int):
+        header = self.eventsReadout.header[slot]
+        waveformData = self.eventsReadout.samples[slot, 0, 0, :header['ChSize'][0, 0]]
+        
+        dt5742bStruct['event'] = event
+        dt5742bStruct['timestamp'] = header['GroupTriggerTimeTag'][0]
+        dt5742bStruct['dgt_evt'] = header['EventCounter']
+        dt5742bStruct['dgt_trgtime'] = header['EventCounter']
+        dt5742bStruct['dgt_evtsize'] = len(waveformData)
         
-        dt5742bStruct['avgQ'] = self.bergozMap_toCharge(dt5742bStruct['avgV'])
+        # Average, std, calibrated voltage and charge (block of a single event)
+        processWaveforms(waveformData[None, :], self.dgt.calibration, out = dt5742bStruct)
+
+
+    def processEventBatch(self, event: int, batch: X742_eventBatch) -> np.ndarray:
+        # Channel 0 of the first enabled group for all the events of the block
+        dt5742bBatch = processBatch(batch, self.dgt.calibration, firstEvent = event)
+        dt5742bBatch['run'] = dt5742bStruct['run']
+        dt5742bBatch['runTime'] = dt5742bStruct['runTime']
+        return dt5742bBatch
+
+
+    # Send a payload of processed events as a single EUDAQ event
+    def sendPayload(self, payload: tuple):
+        if payload is None: return
+        rows, triggers, beginTime_ns, endTime_ns, features = payload
+        # The basler is used in the DataCollector to tag the Event payload as coming from the camera
+        ev = pyeudaq.Event("RawEvent", "dt5742b")
+        ev.SetTriggerN(int(triggers[0]))
+        ev.SetTimestamp(beginTime_ns, endTime_ns)
+        # Block 0: contiguous rows of dt5742b_dtypes, block 1: trigger number of every row (uint32)
+        ev.AddBlock(0, rows.tobytes())
+        ev.AddBlock(1, triggers.tobytes())
+        # Block 2: pulse features (PULSE_FEATURES_dtype) of the 9 channels of every enabled group of every row, if enabled
+        if features is not None: ev.AddBlock(2, features.tobytes())
+        self.SendEvent(ev)
 
 
     @exception_handler
     def RunLoop(self):
         pyeudaq.EUDAQ_INFO("Start of RunLoop in dt5742bEUDAQ")
         trigger_n = 0
+        ringMode = isinstance(self.eventsReadout, eventRing)
         while(self.is_running):
-            # Get an event from the queue
+            # Get an event from the queue (or its slot in the ring buffer), waiting at most until the pending payload is due
             preQueryTime = time.time_ns()
-            dgtEvent = self.eventsReadout.get()
+            try:
+                dgtEvent = self.eventsReadout.get(timeout = self.payload.timeLeft())
+            except queue.Empty:
+                self.sendPayload(self.payload.flush())
+                continue
             postQueryTime = time.time_ns()
             if dgtEvent is None: break
             
-            self.processEvent(trigger_n, dgtEvent)
-            
-            # The basler is used in the DataCollector to tag the Event payload as coming from the camera
-            ev = pyeudaq.Event("RawEvent", "dt5742b")
-            ev.SetTriggerN(trigger_n)
-            ev.SetTimestamp(preQueryTime, postQueryTime)
-            ev.AddBlock(0, dt5742bStruct.tobytes())
-            self.SendEvent(ev)
+            features = None
+            if isinstance(dgtEvent, X742_eventBatch):
+                dt5742bRows = self.processEventBatch(trigger_n, dgtEvent)
+                if self.pulseFeatures is not None: features = self.pulseFeatures.extractBatch(dgtEvent)
+            elif isinstance(dgtEvent, (np.ndarray, tuple)):
+                # Rows (and pulse features) already reduced by the decode workers
+                dt5742bRows, features = dgtEvent if isinstance(dgtEvent, tuple) else (dgtEvent, None)
+                dt5742bRows['run'] = dt5742bStruct['run']
+                dt5742bRows['runTime'] = dt5742bStruct['runTime']
+                dt5742bRows['event'] = np.arange(trigger_n, trigger_n + len(dt5742bRows))
+            elif ringMode:
+                self.processEventRing(trigger_n, dgtEvent)
+                self.eventsReadout.release(dgtEvent)
+                dt5742bRows = dt5742bStruct
+            else:
+                self.processEvent(trigger_n, dgtEvent)
+                dt5742bRows = dt5742bStruct
             
-            trigger_n += 1
+            for payload in self.payload.add(dt5742bRows, trigger_n, preQueryTime, postQueryTime, features):
+                self.sendPayload(payload)
+            trigger_n += len(dt5742bRows)
+        self.sendPayload(self.payload.flush())
         pyeudaq.EUDAQ_INFO("End of RunLoop in dt5742bEUDAQ")
 
 
@@ -198,6 +328,8 @@ class dt5742bEUDAQ(pyeudaq.Producer):
             self.dgt.lock.release()
             self.dgtHWLoopThread.join()
             (self.dgt).close()
+            sharedRing = self.dgt.setSharedRing(None)
+            if sharedRing is not None: sharedRing.close()
             self.eventsReadout.put(None)
             del self.dgtHWLoopThread
 
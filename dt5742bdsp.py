@@ -0,0 +1,164 @@
+#################################################################################################
+# @info Online DSP of the DT5742B producer: payload datatype and block processing of waveforms  #
+#       All the events of a block (N, samples) are reduced with a single set of numpy calls,    #
+#       so the python cost per block does not grow with the number of events. Several events    #
+#       can be packed in a single EUDAQ payload by payloadBuilder.                              #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+from pulsefeatures import PULSE_FEATURES_dtype
+import numpy as np
+import time
+
+## DT5742B datatype
+dt5742b_dtypes = [('run',np.uint32),('runTime',np.float64),('event',np.uint32),('timestamp',np.float64),('dgt_evt',np.uint32),('dgt_trgtime',np.uint64),('dgt_evtsize',np.uint32),('avg',np.float64),('std',np.float64),('ptNb',np.uint32),('avgV',np.float64),('stdV',np.float64),('avgQ',np.float64)]
+
+# Samples at the end of the waveform excluded from the average
+DT5742B_TAIL_SAMPLES = 100
+
+
+# Average, standard deviation, calibrated voltage and charge of a block of waveforms
+def processWaveforms(waveforms: np.ndarray, calibration, out: np.ndarray = None, channel: int = 0) -> np.ndarray:
+    """
+    Fill the DSP fields of the payload rows for a block of waveforms
+
+    Parameters
+    ----------
+        waveforms (np.ndarray) : (N, samples) waveforms of the block [ADC counts]
+        calibration (calibration.waveformCalibration) : ADC counts -> V -> nC (CAENDT5742B.calibration)
+        out (np.ndarray) : (N,) array of dt5742b_dtypes to be filled, allocated if None
+        channel (int) : channel of the waveforms in the calibration tables
+
+    Returns
+    -------
+        out (np.ndarray) : (N,) array of dt5742b_dtypes with avg, std, ptNb, avgV, stdV, avgQ filled
+    """
+    waveforms = np.atleast_2d(waveforms)
+    if out is None: out = np.zeros(len(waveforms), dtype=dt5742b_dtypes)
+    window = waveforms[:, :-DT5742B_TAIL_SAMPLES]
+
+    # Calculate the average value over the last 100 samples (dirty), all the events at once
+    out['avg'] = np.mean(window, axis=1, dtype=np.float64)
+    out['std'] = np.std(window, axis=1, dtype=np.float64)
+    out['ptNb'] = DT5742B_TAIL_SAMPLES
+    out['avgV'] = calibration.toVolt(out['avg'], channel)
+    # Spread in V: the std scaled by the slope only (before the shared calibration the offset was added too)
+    out['stdV'] = calibration.toVoltSpread(out['std'], channel)
+
+    # Charge from the Bergoz sensitivity of the set gain (before the shared calibration: avgV x 50)
+    out['avgQ'] = calibration.toCharge(out['avgV'], channel)
+    return out
+
+
+# Payload rows of a block of decoded events
+def processBatch(batch, calibration, firstEvent: int = 0) -> np.ndarray:
+    """
+    Payload rows of all the events of a X742_eventBatch (channel 0 of the first enabled group).
+    The run fields are left to the caller.
+
+    Parameters
+    ----------
+        batch (X742_eventBatch) : decoded events
+        calibration (calibration.waveformCalibration) : ADC counts -> V -> nC
+        firstEvent (int) : event number of the first event of the batch
+
+    Returns
+    -------
+        rows (np.ndarray) : (N,) array of dt5742b_dtypes
+    """
+    # Common length of the events (channels zero-suppressed in some events keep their samples in the block)
+    ChSizes = batch.header['ChSize'][:, 0, 0]
+    ChSize = int(ChSizes[ChSizes > 0].min()) if ChSizes.any() else batch.samples.shape[-1]
+    waveformData = batch.samples[:, 0, 0, :ChSize]
+    
+    rows = np.zeros(len(batch), dtype=dt5742b_dtypes)
+    rows['event'] = np.arange(firstEvent, firstEvent + len(batch))
+    rows['timestamp'] = batch.header['GroupTriggerTimeTag'][:, 0]
+    rows['dgt_evt'] = batch.header['EventCounter']
+    rows['dgt_trgtime'] = batch.header['EventCounter']
+    rows['dgt_evtsize'] = ChSize
+    
+    # Average, std, calibrated voltage and charge of all the events at once
+    return processWaveforms(waveformData, calibration, out = rows)
+
+
+# Picklable reduction of a X742_eventBatch to its payload rows (decode workers in other processes)
+class batchReducer():
+    def __init__(self, calibration, pulseFeatures = None) -> None:
+        # Same calibration.waveformCalibration as the producer (CAENDT5742B.calibration)
+        self.calibration = calibration
+        # Optional pulsefeatures.pulseFeatureExtractor of all the channels: (rows, features) are returned
+        self.pulseFeatures = pulseFeatures
+
+    def __call__(self, batch):
+        rows = processBatch(batch, self.calibration)
+        if self.pulseFeatures is None: return rows
+        return rows, self.pulseFeatures.extractBatch(batch)
+
+
+# Aggregation of the payload rows of several events into a single EUDAQ event
+class payloadBuilder():
+    def __init__(self, eventsPerPayload: int = 1, timeBudget_s: float = 0, featureChannels: int = 0) -> None:
+        """
+        Accumulate the rows of dt5742b_dtypes of consecutive events in a preallocated payload
+
+        Parameters
+        ----------
+            eventsPerPayload (int) : maximum number of events in a payload (1: one EUDAQ event per trigger)
+            timeBudget_s (float) : maximum time a row waits in the payload before it is sent [s] (0: no limit)
+            featureChannels (int) : channels of the pulse features of every event (PULSE_FEATURES_dtype), 0: no features
+        """
+        if eventsPerPayload < 1: raise ValueError(f"Events per payload must be positive ({eventsPerPayload})")
+        self.eventsPerPayload = eventsPerPayload
+        self.timeBudget_s = timeBudget_s
+        self.rows = np.zeros(eventsPerPayload, dtype=dt5742b_dtypes)
+        self.triggers = np.zeros(eventsPerPayload, dtype=np.uint32)
+        self.features = np.zeros((eventsPerPayload, featureChannels), dtype=PULSE_FEATURES_dtype) if featureChannels > 0 else None
+        self.eventsNb = 0
+        self._startTime = 0.0
+        self._beginTime_ns = 0
+        self._endTime_ns = 0
+
+    # Time before the pending rows have to be sent [s], None if there is no deadline
+    def timeLeft(self):
+        if self.eventsNb == 0 or self.timeBudget_s <= 0: return None
+        return max(0.0, self.timeBudget_s - (time.monotonic() - self._startTime))
+
+    # Append the rows of consecutive events
+    def add(self, rows: np.ndarray, firstTrigger: int, beginTime_ns: int, endTime_ns: int, features: np.ndarray = None):
+        """
+        Append the rows of consecutive events, yielding every payload completed in the meanwhile.
+        The payloads are views of the internal buffers: they have to be sent before the next iteration.
+
+        Parameters
+        ----------
+            rows (np.ndarray) : (N,) array of dt5742b_dtypes
+            firstTrigger (int) : trigger number of the first row
+            beginTime_ns, endTime_ns (int) : host time interval of the readout of the rows [ns]
+            features (np.ndarray) : (N, featureChannels) pulse features of the rows (zeros in the payload if None)
+
+        Yields
+        ------
+            payload (tuple) : rows, trigger numbers, begin and end time [ns], pulse features (None without features) of the payload
+        """
+        done = 0
+        while done < len(rows):
+            if self.eventsNb == 0:
+                self._startTime = time.monotonic()
+                self._beginTime_ns = beginTime_ns
+            chunk = min(len(rows) - done, self.eventsPerPayload - self.eventsNb)
+            self.rows[self.eventsNb : self.eventsNb + chunk] = rows[done : done + chunk]
+            self.triggers[self.eventsNb : self.eventsNb + chunk] = np.arange(firstTrigger + done, firstTrigger + done + chunk)
+            if self.features is not None:
+                self.features[self.eventsNb : self.eventsNb + chunk] = features[done : done + chunk] if features is not None else 0
+            self.eventsNb += chunk
+            self._endTime_ns = endTime_ns
+            done += chunk
+            if self.eventsNb == self.eventsPerPayload or self.timeLeft() == 0.0:
+                yield self.flush()
+
+    # Payload of the pending rows (None if empty), emptying the builder
+    def flush(self):
+        if self.eventsNb == 0: return None
+        eventsNb, self.eventsNb = self.eventsNb, 0
+        features = self.features[:eventsNb] if self.features is not None else None
+        return self.rows[:eventsNb], self.triggers[:eventsNb], self._beginTime_ns, self._endTime_ns, features
@@ -0,0 +1,226 @@
+#################################################################################################
+# @info Bounded event queue between the digitizer readout thread and the EUDAQ producer         #
+#       Drop-in replacement of queue.Queue with a selectable overflow policy, so that the       #
+#       memory held by the readout stays bounded when the consumer stalls:                      #
+#         - block:       the readout thread waits for a free place (back-pressure)              #
+#         - drop_oldest: the oldest queued item is discarded                                    #
+#         - drop_newest: the incoming item is discarded                                         #
+#         - spill:       the items overflow to a temporary file and are read back in order      #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+import collections
+import threading
+import tempfile
+import pickle
+import queue
+import time
+
+
+class eventQueue():
+    # Overflow policies when the consumer falls behind
+    OVERFLOW_BLOCK = 'block'                # the producer waits for a free place
+    OVERFLOW_DROP_NEWEST = 'drop_newest'    # the incoming item is discarded
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'    # the oldest queued item is discarded
+    OVERFLOW_SPILL = 'spill'                # the items overflow to a file on the local disk
+    # The spill file is compacted once the bytes already read exceed this size and the bytes still pending
+    SPILL_COMPACT_BYTES = 64 << 20
+    SPILL_COPY_BYTES = 16 << 20             # chunk of the compaction copy
+
+    def __init__(self, maxsize: int, overflowPolicy: str = 'block', spillPath: str = None, spillMaxBytes: int = 0) -> None:
+        """
+        Create the queue
+
+        Parameters
+        ----------
+            maxsize (int) : maximum number of items held in memory
+            overflowPolicy (str) : block, drop_oldest, drop_newest or spill
+            spillPath (str) : directory of the spill file (system temporary directory if None)
+            spillMaxBytes (int) : maximum size of the spilled items not read yet, items are dropped beyond it [bytes] (0: no limit)
+        """
+        if maxsize < 1: raise ValueError(f"Queue size must be positive ({maxsize})")
+        if overflowPolicy not in (self.OVERFLOW_BLOCK, self.OVERFLOW_DROP_NEWEST, self.OVERFLOW_DROP_OLDEST, self.OVERFLOW_SPILL):
+            raise ValueError(f"Unknown overflow policy {overflowPolicy}")
+
+        self.maxsize = maxsize
+        self.overflowPolicy = overflowPolicy
+        self.spillPath = spillPath
+        self.spillMaxBytes = spillMaxBytes
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+        # Spill file: items are appended at _spillWrite and read back from _spillRead
+        self._spillFile = None
+        self._spillRead = 0
+        self._spillWrite = 0
+        self._spillPending = 0
+
+        # Counters
+        self.written = 0
+        self.droppedNewest = 0
+        self.droppedOldest = 0
+        self.highWater = 0
+        self.spilled = 0
+        self.spillBytes = 0
+        self.spillHighWater = 0
+        self.spillCompactions = 0
+
+    # Number of queued items (in memory and spilled)
+    def qsize(self) -> int:
+        return len(self._items) + self._spillPending
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        return len(self._items) >= self.maxsize
+
+    # Append an item to the spill file
+    def _spill(self, item, force: bool = False) -> bool:
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        if not force and self.spillMaxBytes > 0 and self._spillWrite - self._spillRead + len(data) > self.spillMaxBytes:
+            return False
+        if self._spillFile is None:
+            self._spillFile = tempfile.TemporaryFile(prefix='dt5742b_spill_', dir=self.spillPath)
+        self._spillFile.seek(self._spillWrite)
+        self._spillFile.write(data)
+        self._spillWrite += len(data)
+        self._spillPending += 1
+        self.spilled += 1
+        self.spillBytes += len(data)
+        self.spillHighWater = max(self.spillHighWater, self._spillWrite - self._spillRead)
+        return True
+
+    # Read back the oldest spilled item
+    def _unspill(self):
+        self._spillFile.seek(self._spillRead)
+        item = pickle.load(self._spillFile)
+        self._spillRead = self._spillFile.tell()
+        self._spillPending -= 1
+        # Rewind the file once it has been read completely, compact it when most of it has been read
+        if self._spillPending == 0:
+            self._spillFile.truncate(0)
+            self._spillRead = self._spillWrite = 0
+        elif self._spillRead >= self.SPILL_COMPACT_BYTES and self._spillRead >= self._spillWrite - self._spillRead:
+            self._compactSpill()
+        return item
+
+    # Move the pending items to the start of the spill file (copy forward in chunks: the regions never overlap within a chunk)
+    def _compactSpill(self):
+        pendingBytes = self._spillWrite - self._spillRead
+        copied = 0
+        while copied < pendingBytes:
+            self._spillFile.seek(self._spillRead + copied)
+            chunk = self._spillFile.read(min(self.SPILL_COPY_BYTES, pendingBytes - copied))
+            self._spillFile.seek(copied)
+            self._spillFile.write(chunk)
+            copied += len(chunk)
+        self._spillFile.truncate(pendingBytes)
+        self._spillRead, self._spillWrite = 0, pendingBytes
+        self.spillCompactions += 1
+
+    # Queue an item (producer side)
+    def put(self, item, block: bool = True, timeout: float = None):
+        """
+        Queue an item, applying the overflow policy if the queue is full. A None (end of data) is
+        always queued.
+
+        Parameters
+        ----------
+            item : item to be queued
+            block (bool) : wait for a free place (block policy only)
+            timeout (float) : maximum waiting time in seconds (None waits forever)
+
+        Raises
+        ------
+            queue.Full : no free place within the timeout (block policy only)
+        """
+        with self._cond:
+            # Once items are spilled, the following ones go to the file too, to preserve the order
+            if self._spillPending > 0:
+                if self._spill(item, force = item is None):
+                    self.written += 1
+                    self._cond.notify_all()
+                else:
+                    self.droppedNewest += 1
+                return
+            if item is not None and len(self._items) >= self.maxsize:
+                if self.overflowPolicy == self.OVERFLOW_BLOCK:
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                    while len(self._items) >= self.maxsize:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if not block or (remaining is not None and remaining <= 0): raise queue.Full
+                        self._cond.wait(remaining)
+                elif self.overflowPolicy == self.OVERFLOW_DROP_OLDEST:
+                    self._items.popleft()
+                    self.droppedOldest += 1
+                elif self.overflowPolicy == self.OVERFLOW_SPILL and self._spill(item):
+                    self.written += 1
+                    self._cond.notify_all()
+                    return
+                else:
+                    self.droppedNewest += 1
+                    return
+            self._items.append(item)
+            self.written += 1
+            self.highWater = max(self.highWater, len(self._items))
+            self._cond.notify_all()
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    # Get the oldest item (consumer side)
+    def get(self, block: bool = True, timeout: float = None):
+        """
+        Get the oldest item
+
+        Parameters
+        ----------
+            block (bool) : wait for an item if the queue is empty
+            timeout (float) : maximum waiting time in seconds (None waits forever)
+
+        Raises
+        ------
+            queue.Empty : no item available within the timeout
+        """
+        with self._cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                if self._items:
+                    item = self._items.popleft()
+                    self._cond.notify_all()
+                    return item
+                if self._spillPending > 0:
+                    return self._unspill()
+                if not block: raise queue.Empty
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: raise queue.Empty
+                    self._cond.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    # Counters of the queue
+    def getStats(self) -> dict:
+        return {
+            'maxsize'           : self.maxsize,
+            'written'           : self.written,
+            'droppedNewest'     : self.droppedNewest,
+            'droppedOldest'     : self.droppedOldest,
+            'highWater'         : self.highWater,
+            'spilled'           : self.spilled,
+            'spillBytes'        : self.spillBytes,
+            'spillHighWater'    : self.spillHighWater,
+            'spillCompactions'  : self.spillCompactions,
+            'pending'           : self.qsize()
+        }
+
+    # Remove the spill file
+    def close(self):
+        with self._cond:
+            if self._spillFile is not None:
+                self._spillFile.close()
+                self._spillFile = None
+                self._spillRead = self._spillWrite = self._spillPending = 0
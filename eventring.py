@@ -0,0 +1,151 @@
+#################################################################################################
+# @info Fixed-capacity ring buffer of events between the digitizer readout thread and a         #
+#       consumer. Headers are stored in a structured array and samples in a preallocated         #
+#       float32 block, so that no memory is allocated per event.                                #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#                                                                                               #
+# Usage (single producer, single consumer)                                                      #
+#   producer: slot = ring.reserve(); fill ring.header[slot], ring.samples[slot]; ring.commit()  #
+#   consumer: slot = ring.get(); read ring.header[slot], ring.samples[slot]; ring.release(slot) #
+#################################################################################################
+import numpy as np
+import threading
+import queue
+import time
+
+
+class eventRing():
+    # Overflow policies when the consumer falls behind
+    OVERFLOW_BLOCK = 'block'                # the producer waits for a free slot
+    OVERFLOW_DROP_NEWEST = 'drop_newest'    # the incoming event is discarded
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'    # the oldest unread event is overwritten
+
+    def __init__(self, capacity: int, headerDtype: np.dtype, samplesShape: tuple, overflowPolicy: str = 'drop_newest') -> None:
+        """
+        Allocate the ring buffer
+
+        Parameters
+        ----------
+            capacity (int) : number of event slots
+            headerDtype (np.dtype) : structured dtype of the event header
+            samplesShape (tuple) : shape of the samples block of one event, e.g. (groups, 9, RecordLength)
+            overflowPolicy (str) : block, drop_newest or drop_oldest
+        """
+        if capacity < 1: raise ValueError(f"Ring capacity must be positive ({capacity})")
+        if overflowPolicy not in (self.OVERFLOW_BLOCK, self.OVERFLOW_DROP_NEWEST, self.OVERFLOW_DROP_OLDEST):
+            raise ValueError(f"Unknown overflow policy {overflowPolicy}")
+
+        self.capacity = capacity
+        self.overflowPolicy = overflowPolicy
+        self.header = np.zeros(capacity, dtype=headerDtype)
+        self.samples = np.zeros((capacity,) + tuple(samplesShape), dtype=np.float32)
+
+        # Sequence numbers (slot = seq % capacity)
+        self._head = 0                      # next sequence to be written
+        self._tail = 0                      # next sequence to be read
+        self._released = 0                  # oldest sequence still held by the consumer
+        self._sentinels = []                # sequence numbers after which a None is delivered
+        self._cond = threading.Condition()
+
+        # Counters
+        self.written = 0
+        self.droppedNewest = 0
+        self.droppedOldest = 0
+        self.highWater = 0
+
+    # Number of committed events not yet read
+    def qsize(self) -> int:
+        return self._head - self._tail
+
+    # Reserve the slot for the next event (producer side)
+    def reserve(self):
+        """
+        Reserve the slot for the next event. The slot is published to the consumer by commit()
+
+        Returns
+        -------
+            slot (int | None) : slot index, None if the event has to be discarded (drop_newest)
+        """
+        with self._cond:
+            while self._head - self._released >= self.capacity:
+                if self.overflowPolicy == self.OVERFLOW_BLOCK:
+                    self._cond.wait()
+                elif self.overflowPolicy == self.OVERFLOW_DROP_OLDEST and self._released == self._tail and self._tail < self._head:
+                    # The consumer holds no slot: the oldest unread event can be overwritten
+                    self._tail += 1
+                    self._released += 1
+                    self.droppedOldest += 1
+                else:
+                    self.droppedNewest += 1
+                    return None
+            return self._head % self.capacity
+
+    # Publish the reserved slot to the consumer (producer side)
+    def commit(self):
+        with self._cond:
+            self._head += 1
+            self.written += 1
+            self.highWater = max(self.highWater, self._head - self._released)
+            self._cond.notify_all()
+
+    # Queue-like end of data signal: the consumer will get a None
+    def put(self, item = None):
+        if item is not None: raise TypeError("eventRing slots are written with reserve()/commit()")
+        with self._cond:
+            self._sentinels.append(self._head)
+            self._cond.notify_all()
+
+    # Get the slot of the next event (consumer side)
+    def get(self, block: bool = True, timeout: float = None):
+        """
+        Get the slot of the next event. Any slot still held by the consumer is released.
+
+        Parameters
+        ----------
+            block (bool) : wait for an event if the ring is empty
+            timeout (float) : maximum waiting time in seconds (None waits forever)
+
+        Returns
+        -------
+            slot (int | None) : slot index, None if the end of data was signalled
+
+        Raises
+        ------
+            queue.Empty : no event available within the timeout
+        """
+        with self._cond:
+            self._released = self._tail
+            self._cond.notify_all()
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                if self._sentinels and self._sentinels[0] <= self._tail:
+                    self._sentinels.pop(0)
+                    return None
+                if self._tail < self._head:
+                    slot = self._tail % self.capacity
+                    self._tail += 1
+                    return slot
+                if not block: raise queue.Empty
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: raise queue.Empty
+                    self._cond.wait(remaining)
+
+    # Give the slot back to the producer (consumer side)
+    def release(self, slot: int = None):
+        with self._cond:
+            self._released = self._tail
+            self._cond.notify_all()
+
+    # Counters of the ring
+    def getStats(self) -> dict:
+        return {
+            'capacity'      : self.capacity,
+            'written'       : self.written,
+            'droppedNewest' : self.droppedNewest,
+            'droppedOldest' : self.droppedOldest,
+            'highWater'     : self.highWater,
+            'pending'       : self.qsize()
+        }
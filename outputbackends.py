@@ -0,0 +1,669 @@
+#################################################################################################
+# @info Output backends of rootconverter                                                        #
+#       rootconverter does the DSP and hands the processed ntuple, the setup entries and the    #
+#       raw waveforms to an output backend:                                                     #
+#         - rootBackend:    DT5730setup, DT5730, DT5730raw and DT5730rawTime trees (PyROOT)     #
+#         - parquetBackend: one Parquet file per table (pyarrow), readable by pandas/polars     #
+#         - hdf5Backend:    every waveform in a chunked (events, channels, samples) dataset     #
+#       The heavy dependencies (ROOT, pyarrow, h5py) are imported only by the backend in use.   #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+from abc import ABC, abstractmethod
+from array import array
+from logger import create_logger
+import numpy as np
+import os
+
+logging = create_logger("outputbackends")
+
+# Columns of the DT5730 processed data ntuple (TNtuple leaves, float32)
+DT5730_NTUPLE_COLUMNS = ["run", "runTime", "event", "dgt_evt", "dgt_trgtime", "dgt_evtsize", "avg", "std", "ptNb", "avgV", "stdV", "avgQ", "trgtime"]
+
+# Types of the ntuple columns in the backends that are not limited to float32 (Parquet)
+DT5730_NTUPLE_dtype = np.dtype([
+    ('run',         np.int32),
+    ('runTime',     np.uint64),
+    ('event',       np.int64),
+    ('dgt_evt',     np.uint32),
+    ('dgt_trgtime', np.uint32),
+    ('dgt_evtsize', np.uint32),
+    ('avg',         np.float64),
+    ('std',         np.float64),
+    ('ptNb',        np.int32),
+    ('avgV',        np.float64),
+    ('stdV',        np.float64),
+    ('avgQ',        np.float64),
+    ('trgtime',     np.float64)
+])
+
+# Header of the raw waveforms (DT5730raw)
+DT5730_RAW_dtype = np.dtype([
+    ('run',             np.int32),
+    ('runTime',         np.uint64),
+    ('event',           np.int64),
+    ('timestamp',       np.float64),
+    ('TrgTstamp_us',    np.float64),
+    ('TrgID',           np.int32),
+    ('waveformSize',    np.int32)
+])
+
+
+##############################################################
+######## Columnar ntuple writer ##############################
+##############################################################
+# Bulk fill of a TNtuple from a (N, columns) float32 block, compiled once by cling
+_FILL_NTUPLE_BLOCK = """
+#include "TNtuple.h"
+void columnarNtuple_fillBlock(TNtuple *ntuple, const float *rows, long long n, int columns) {
+    for (long long i = 0; i < n; ++i) ntuple->Fill(rows + i * columns);
+}
+"""
+
+# Events accumulated in a numpy basket and filled in bulk, in place of one TNtuple.Fill per event from Python
+class columnarNtuple():
+    def __init__(self, ntuple, columns: list, basketEvents: int = 10000) -> None:
+        """
+        Row buffer of a float32 TNtuple, written to the tree of the open file every basketEvents events
+
+        Parameters
+        ----------
+            ntuple (ROOT.TNtuple) : ntuple of the open file, with the leaves in the order of columns
+            columns (list) : names of the leaves
+            basketEvents (int) : events per basket (rows buffered before a bulk fill, TTree auto-flush)
+        """
+        import ROOT
+        if not hasattr(ROOT, 'columnarNtuple_fillBlock'): ROOT.gInterpreter.Declare(_FILL_NTUPLE_BLOCK)
+        self._fillBlock = ROOT.columnarNtuple_fillBlock
+        self.ntuple = ntuple
+        self.ntuple.SetAutoFlush(basketEvents)
+        self.columns = list(columns)
+        self.basketEvents = basketEvents
+        self._basket = np.zeros((basketEvents, len(self.columns)), dtype=np.float32)
+        self._rows = 0
+        self.entries = 0
+
+    # Append one event (values in the order of the columns)
+    def Fill(self, *values):
+        self._basket[self._rows] = values
+        self._rows += 1
+        self.entries += 1
+        if self._rows == self.basketEvents: self.flush()
+
+    # Append a block of events: (N, columns) array, filled at once
+    def fillBlock(self, block: np.ndarray):
+        self.flush()
+        block = np.ascontiguousarray(block, dtype=np.float32)
+        self._fillBlock(self.ntuple, block, len(block), len(self.columns))
+        self.entries += len(block)
+
+    # Fill the buffered rows in the ntuple
+    def flush(self):
+        if self._rows == 0: return
+        self._fillBlock(self.ntuple, self._basket, self._rows, len(self.columns))
+        self._rows = 0
+
+
+# Waveforms padded or truncated to the stored shape (trailing dimensions), and number of valid samples
+def _fitWaveforms(waveforms: np.ndarray, shape: tuple, dtype) -> tuple:
+    samplesNb = min(waveforms.shape[-1], shape[-1])
+    if waveforms.shape[1:] == shape and waveforms.dtype == dtype: return waveforms, samplesNb
+    fitted = np.zeros(waveforms.shape[:1] + shape, dtype=dtype)
+    valid = tuple(slice(0, min(have, want)) for have, want in zip(waveforms.shape[1:], shape))
+    fitted[(slice(None),) + valid] = waveforms[(slice(None),) + valid]
+    return fitted, samplesNb
+
+
+##############################################################
+######## Backend interface ###################################
+##############################################################
+class outputBackend(ABC):
+    # Extension of the files written by the backend
+    extension = ""
+
+    def __init__(self, waveformSamples: int = 1024, waveformDtype = np.float32) -> None:
+        """
+        Parameters
+        ----------
+            waveformSamples (int) : samples of the fixed-size raw waveform column
+            waveformDtype (np.dtype) : type of the stored raw samples (np.float32 or np.int16)
+        """
+        self.waveformSamples = waveformSamples
+        self.waveformDtype = np.dtype(waveformDtype)
+        # Sample-time axis of the waveforms, stored once per file (sample index by default)
+        self.waveformTime = np.arange(waveformSamples, dtype=np.float32)
+
+    # Set the sample-time axis of the raw waveforms
+    def setWaveformTime(self, waveformTime: np.ndarray):
+        samplesNb = min(len(waveformTime), self.waveformSamples)
+        self.waveformTime[:samplesNb] = waveformTime[:samplesNb]
+
+    # Open the output of a run (path of the file, descriptions of the ntuple columns)
+    @abstractmethod
+    def open(self, path: str, descriptions: dict):
+        pass
+
+    # Append the setup of the run: list of (parName, parValue, parDescr)
+    @abstractmethod
+    def fillSetup(self, run: int, parameters: list):
+        pass
+
+    # Append one event to the processed ntuple (values in the order of DT5730_NTUPLE_COLUMNS)
+    @abstractmethod
+    def fillData(self, *values):
+        pass
+
+    # Append a block of events to the processed ntuple: (N, columns) array
+    def fillDataBlock(self, block: np.ndarray):
+        for row in block: self.fillData(*row)
+
+    # Append a raw waveform
+    @abstractmethod
+    def fillRaw(self, run: int, runTime: int, event: int, timestamp, TrgTstamp_us, TrgID: int, waveform: np.ndarray):
+        pass
+
+    # Append a block of raw waveforms: (N,) DT5730_RAW_dtype header (waveformSize is set by the backend), (N, samples) waveforms
+    def fillRawBlock(self, header: np.ndarray, waveforms: np.ndarray):
+        for row, waveform in zip(header, waveforms):
+            self.fillRaw(row['run'], row['runTime'], row['event'], row['timestamp'], row['TrgTstamp_us'], row['TrgID'], waveform)
+
+    # Write and close the output of the run
+    @abstractmethod
+    def close(self):
+        pass
+
+    # Release the memory held by the backend
+    def clear(self):
+        pass
+
+    # Prepare the backend to be closed by another thread than the one filling it
+    def enableThreads(self):
+        pass
+
+
+##############################################################
+######## ROOT backend ########################################
+##############################################################
+class rootBackend(outputBackend):
+    extension = ".root"
+
+    def __init__(self, basketEvents: int = 0, compression: int = 101, waveformSamples: int = 1024, waveformDtype = np.float32) -> None:
+        """
+        Parameters
+        ----------
+            basketEvents (int) : processed data written in bulk every basketEvents events (0: one TNtuple.Fill per event)
+            compression (int) : ROOT compression setting, 100 * algorithm + level
+            waveformSamples (int) : samples of the fixed-size waveform branch
+            waveformDtype (np.dtype) : type of the waveform branch, np.float32 ('F') or np.int16 ('S')
+        """
+        super().__init__(waveformSamples, waveformDtype)
+        import ROOT
+        self.ROOT = ROOT
+        self.basketEvents = basketEvents
+        self.compression = compression
+        self.fname = ""
+        self.rfile = None               # pointer to the ROOT TFile
+        self.runSetupTree = None        # setup ttree
+        self.runDataTree = None         # data ttree
+        self.runDataTreeRaw = None      # raw data ttree
+        self.runDataNtuple = None       # columnar ntuple (basketEvents > 0)
+        # TTree: setup
+        self.vrunIDs = ROOT.vector('int')()
+        self.vparName = ROOT.vector('string')()
+        self.vparValue = ROOT.vector('string')()
+        self.vparDescr = ROOT.vector('string')()
+        # TTree: dataRaw
+        self.irun = array("i", [-1])
+        self.irunTime = array("Q", [0])
+        self.ievent = array("i", [-1])
+        self.ftimestamp = array("d", [-1])
+        self.fTrgTstamp_us = array("d", [-1])
+        self.iTrgID = array("i", [-1])
+        # Raw waveform: fixed-size array branch filled with a single numpy copy
+        self.awaveform = np.zeros(waveformSamples, dtype=self.waveformDtype)
+        self.iwaveformSize = array("i", [0])
+
+    # Set description (better readibility)
+    def _utils_mkRootTtreeHumanDescrFromDict(self, tree, descriptions: dict):
+        # If a branch name is not compatible with ROOT name conventions, the
+        # name is first sanified and then a branch with that name is created.
+        # For example 'myname2.' cannot exist
+        # A naive comparison like
+        # for entry in tree_nametypes:
+        #     tree.GetBranch(entry[0]).SetTitle(entry[3])
+        # would fail since the GetBranch for 'myname2.' would return nullpointer
+
+        # WARNING: using GetLeaf works but it produces a bug in the generated ROOT output
+        # file such that the Data is not displayed when using sca. With the traditional TBrowser
+        # it won't work either while with the web ROOT interface it works.
+        for name, descr in descriptions.items():
+                try:
+                    branch = tree.GetBranch(name)
+                    branch.SetTitle(descr)
+                except ReferenceError:
+                    logging.error(f"Branch {name} not found. This is nullptr")
+
+    def open(self, path: str, descriptions: dict):
+        ROOT = self.ROOT
+        self.fname = path
+        self.rfile = ROOT.TFile.Open(path, "RECREATE")
+        self.rfile.SetCompressionSettings(self.compression)
+        # Create TTree to store run setup data
+        self.runSetupTree = ROOT.TTree('DT5730setup', 'TTree with run DT5730 setup settings')
+        self.runSetupTree.Branch("run", self.vrunIDs)
+        self.runSetupTree.Branch("parName", self.vparName)
+        self.runSetupTree.Branch("parValue", self.vparValue)
+        self.runSetupTree.Branch("parDescr", self.vparDescr)
+        logging.debug(self.runSetupTree)
+        # Create TTree to store run datapoints
+        self.runDataTree = ROOT.TNtuple("DT5730", "DT5730 processed data", ":".join(DT5730_NTUPLE_COLUMNS))
+        # Description for the various entries
+        self._utils_mkRootTtreeHumanDescrFromDict(self.runDataTree, descriptions)
+        # Columnar mode: the rows are buffered in numpy and filled in bulk every basketEvents events
+        self.runDataNtuple = columnarNtuple(self.runDataTree, DT5730_NTUPLE_COLUMNS, self.basketEvents) if self.basketEvents > 0 else None
+        # Raw waveforms (saved only some times)
+        self.runDataTreeRaw = ROOT.TTree("DT5730raw", "DT5730 raw values")
+        self.runDataTreeRaw.Branch("run",          self.irun            , "run/I")
+        self.runDataTreeRaw.Branch("runTime",      self.irunTime        , "runTime/I")
+        self.runDataTreeRaw.Branch("event",        self.ievent          , "event/I")
+        self.runDataTreeRaw.Branch("timestamp",    self.ftimestamp      , "timestamp/I")
+        self.runDataTreeRaw.Branch("TrgTstamp_us", self.fTrgTstamp_us   , "TrgTstamp_us/I")
+        self.runDataTreeRaw.Branch("TrgID",        self.iTrgID          , "TrgID/I")
+        self.runDataTreeRaw.Branch("waveformSize", self.iwaveformSize   , "waveformSize/I")
+        self.runDataTreeRaw.Branch("waveform",     self.awaveform       , f"waveform[{self.waveformSamples}]/{'S' if self.waveformDtype == np.int16 else 'F'}")
+        logging.debug(self.runDataTreeRaw)
+        # Clear runSetup vectors
+        self.clear()
+
+    def fillSetup(self, run: int, parameters: list):
+        for parName, parValue, parDescr in parameters:
+            self.vrunIDs.push_back(run)
+            self.vparName.push_back(parName)
+            self.vparValue.push_back(parValue)
+            self.vparDescr.push_back(parDescr)
+        # Fill the data on the TTree
+        self.runSetupTree.Fill()
+
+    def fillData(self, *values):
+        (self.runDataNtuple or self.runDataTree).Fill(*values)
+
+    def fillDataBlock(self, block: np.ndarray):
+        if self.runDataNtuple is not None:
+            self.runDataNtuple.fillBlock(block)
+        else:
+            for row in block: self.runDataTree.Fill(*row)
+
+    def fillRaw(self, run: int, runTime: int, event: int, timestamp, TrgTstamp_us, TrgID: int, waveform: np.ndarray):
+        self.irun[0] = run
+        self.irunTime[0] = runTime
+        self.ievent[0] = event
+        self.ftimestamp[0] = timestamp
+        self.fTrgTstamp_us[0] = TrgTstamp_us
+        self.iTrgID[0] = TrgID
+        samplesNb = min(len(waveform), self.waveformSamples)
+        self.iwaveformSize[0] = samplesNb
+        self.awaveform[:samplesNb] = waveform[:samplesNb]
+        self.awaveform[samplesNb:] = 0
+        self.runDataTreeRaw.Fill()
+
+    def close(self):
+        ROOT = self.ROOT
+        # gDirectory is thread-local with thread safety enabled (close on the writer thread): the trees are written in the file
+        self.rfile.cd()
+        self.runSetupTree.Write()
+        if self.runDataNtuple is not None: self.runDataNtuple.flush()
+        self.runDataTree.Write()
+        self.runDataTreeRaw.Write()
+        # Sample-time axis of the raw waveforms, once per run
+        runDataTreeRawTime = ROOT.TTree("DT5730rawTime", "DT5730 sample-time axis of the raw waveforms")
+        runDataTreeRawTime.Branch("waveformTime", self.waveformTime, f"waveformTime[{self.waveformSamples}]/F")
+        runDataTreeRawTime.Fill()
+        runDataTreeRawTime.Write()
+        self.rfile.Close()
+        self.runDataNtuple = None
+
+    # ROOT has to be thread-safe for a file to be closed while the next one is filled
+    def enableThreads(self):
+        self.ROOT.EnableThreadSafety()
+
+    def clear(self):
+        self.vrunIDs.clear()
+        self.vparName.clear()
+        self.vparValue.clear()
+        self.vparDescr.clear()
+        self.awaveform[:] = 0
+        self.iwaveformSize[0] = 0
+
+
+##############################################################
+######## Parquet backend #####################################
+##############################################################
+class parquetBackend(outputBackend):
+    extension = ".parquet"
+
+    def __init__(self, rowGroupEvents: int = 65536, compression: str = 'zstd', compressionLevel: int = 3, useDictionary: bool = True, waveformSamples: int = 1024, waveformDtype = np.float32) -> None:
+        """
+        Every table of the run goes in its own file, <name>_<table>.parquet, with the table being
+        DT5730 (processed ntuple), DT5730setup, DT5730raw (waveforms as a fixed-size list column)
+        and DT5730rawTime (sample-time axis, one row).
+
+        Parameters
+        ----------
+            rowGroupEvents (int) : events per row group (rows buffered before a write)
+            compression (str) : Parquet codec (zstd, lz4, snappy, gzip, none)
+            compressionLevel (int) : level of the codec, applied to every table (None: codec default, ignored by none and snappy)
+            useDictionary (bool) : dictionary encoding of the low-cardinality columns (run, ptNb, TrgID, setup)
+            waveformSamples (int) : samples of the fixed-size waveform column
+            waveformDtype (np.dtype) : type of the stored samples (np.float32 or np.int16)
+        """
+        super().__init__(waveformSamples, waveformDtype)
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.rowGroupEvents = rowGroupEvents
+        self.compression = compression
+        self.compressionLevel = compressionLevel
+        self.useDictionary = useDictionary
+        self.stem = ""
+        self._dataWriter = None
+        self._rawWriter = None
+        self._setup = []
+        # Row buffers of the processed ntuple and of the raw waveforms
+        self._data = np.zeros(rowGroupEvents, dtype=DT5730_NTUPLE_dtype)
+        self._dataRows = 0
+        self._raw = np.zeros(rowGroupEvents, dtype=DT5730_RAW_dtype)
+        self._rawWaveforms = np.zeros((rowGroupEvents, waveformSamples), dtype=self.waveformDtype)
+        self._rawRows = 0
+
+    # Codec arguments of every table: the level only with a codec that has levels (not none, snappy)
+    def _compressionArgs(self) -> dict:
+        if self.compression in (None, 'none') or self.compressionLevel is None or not self.pa.Codec.supports_compression_level(self.compression):
+            return {'compression': self.compression}
+        return {'compression': self.compression, 'compression_level': self.compressionLevel}
+
+    # Writer of a table of the run
+    def _writer(self, table: str, schema, dictionaryColumns):
+        return self.pq.ParquetWriter(f"{self.stem}_{table}{self.extension}", schema, **self._compressionArgs(),
+                                     use_dictionary=dictionaryColumns if self.useDictionary else False)
+
+    def open(self, path: str, descriptions: dict):
+        pa = self.pa
+        self.stem = os.path.splitext(path)[0]
+        self._setup = []
+        self._dataRows = self._rawRows = 0
+        dataSchema = pa.schema([pa.field(name, pa.from_numpy_dtype(DT5730_NTUPLE_dtype[name]), metadata={'description': descriptions.get(name, "")}) for name in DT5730_NTUPLE_dtype.names])
+        self._dataWriter = self._writer("DT5730", dataSchema, ['run', 'ptNb', 'dgt_evtsize'])
+        rawSchema = pa.schema([pa.field(name, pa.from_numpy_dtype(DT5730_RAW_dtype[name])) for name in DT5730_RAW_dtype.names] +
+                              [pa.field('waveform', pa.list_(pa.from_numpy_dtype(self.waveformDtype), self.waveformSamples))])
+        self._rawWriter = self._writer("DT5730raw", rawSchema, ['run', 'TrgID', 'waveformSize'])
+
+    def fillSetup(self, run: int, parameters: list):
+        self._setup.extend((run, parName, parValue, parDescr) for parName, parValue, parDescr in parameters)
+
+    # Write the buffered rows of the processed ntuple as a row group
+    def _flushData(self):
+        if self._dataRows == 0: return
+        self._writeData(self._data[:self._dataRows])
+        self._dataRows = 0
+
+    def _writeData(self, rows: np.ndarray):
+        pa = self.pa
+        self._dataWriter.write_table(pa.table({name: rows[name] for name in DT5730_NTUPLE_dtype.names}, schema=self._dataWriter.schema), row_group_size=self.rowGroupEvents)
+
+    def fillData(self, *values):
+        self._data[self._dataRows] = values
+        self._dataRows += 1
+        if self._dataRows == self.rowGroupEvents: self._flushData()
+
+    def fillDataBlock(self, block: np.ndarray):
+        self._flushData()
+        rows = np.empty(len(block), dtype=DT5730_NTUPLE_dtype)
+        for i, name in enumerate(DT5730_NTUPLE_dtype.names): rows[name] = block[:, i]
+        for start in range(0, len(rows), self.rowGroupEvents):
+            self._writeData(rows[start:start + self.rowGroupEvents])
+
+    # Write the buffered raw waveforms as a row group
+    def _flushRaw(self):
+        if self._rawRows == 0: return
+        pa = self.pa
+        rows, waveforms = self._raw[:self._rawRows], self._rawWaveforms[:self._rawRows]
+        columns = {name: rows[name] for name in DT5730_RAW_dtype.names}
+        columns['waveform'] = pa.FixedSizeListArray.from_arrays(pa.array(waveforms.ravel()), self.waveformSamples)
+        self._rawWriter.write_table(pa.table(columns, schema=self._rawWriter.schema))
+        self._rawRows = 0
+
+    def fillRaw(self, run: int, runTime: int, event: int, timestamp, TrgTstamp_us, TrgID: int, waveform: np.ndarray):
+        samplesNb = min(len(waveform), self.waveformSamples)
+        self._raw[self._rawRows] = (run, runTime, event, timestamp, TrgTstamp_us, TrgID, samplesNb)
+        self._rawWaveforms[self._rawRows, :samplesNb] = waveform[:samplesNb]
+        self._rawWaveforms[self._rawRows, samplesNb:] = 0
+        self._rawRows += 1
+        if self._rawRows == self.rowGroupEvents: self._flushRaw()
+
+    def fillRawBlock(self, header: np.ndarray, waveforms: np.ndarray):
+        pa = self.pa
+        self._flushRaw()
+        waveforms, samplesNb = _fitWaveforms(waveforms, (self.waveformSamples,), self.waveformDtype)
+        for start in range(0, len(header), self.rowGroupEvents):
+            rows = header[start:start + self.rowGroupEvents]
+            columns = {name: rows[name] for name in DT5730_RAW_dtype.names}
+            columns['waveformSize'] = np.full(len(rows), samplesNb, dtype=np.int32)
+            columns['waveform'] = pa.FixedSizeListArray.from_arrays(pa.array(waveforms[start:start + self.rowGroupEvents].ravel()), self.waveformSamples)
+            self._rawWriter.write_table(pa.table(columns, schema=self._rawWriter.schema))
+
+    def close(self):
+        pa = self.pa
+        self._flushData()
+        self._flushRaw()
+        self._dataWriter.close()
+        self._rawWriter.close()
+        self._dataWriter = self._rawWriter = None
+        # Setup entries and sample-time axis: small tables written at once
+        run, parName, parValue, parDescr = zip(*self._setup) if self._setup else ((), (), (), ())
+        setup = pa.table({'run': pa.array(run, pa.int32()), 'parName': pa.array(parName, pa.string()), 'parValue': pa.array(parValue, pa.string()), 'parDescr': pa.array(parDescr, pa.string())})
+        self.pq.write_table(setup, f"{self.stem}_DT5730setup{self.extension}", **self._compressionArgs(), use_dictionary=self.useDictionary)
+        waveformTime = pa.table({'waveformTime': pa.FixedSizeListArray.from_arrays(pa.array(self.waveformTime), self.waveformSamples)})
+        self.pq.write_table(waveformTime, f"{self.stem}_DT5730rawTime{self.extension}", **self._compressionArgs())
+        self._setup = []
+
+    def clear(self):
+        self._setup = []
+        self._dataRows = self._rawRows = 0
+
+
+##############################################################
+######## HDF5 backend ########################################
+##############################################################
+# Keyword arguments of h5py create_dataset for a compression (blosc and lz4 need hdf5plugin)
+def _hdf5Compression(compression: str, compressionLevel: int) -> dict:
+    if compression is None or compression == 'none':
+        return {}
+    if compression.startswith('blosc') or compression == 'lz4':
+        try:
+            import hdf5plugin
+        except ImportError:
+            logging.warning(f"hdf5plugin not available, {compression} replaced by lzf")
+            return {'compression': 'lzf', 'shuffle': True}
+        if compression == 'lz4':
+            return dict(hdf5plugin.LZ4())
+        cname = compression.partition('-')[2] or 'lz4'
+        return dict(hdf5plugin.Blosc(cname=cname, clevel=compressionLevel, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': compressionLevel, 'shuffle': True}
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    raise ValueError(f"Unknown HDF5 compression {compression}")
+
+class hdf5Backend(outputBackend):
+    extension = ".h5"
+
+    def __init__(self, channels: int = 1, chunkEvents: int = 64, compression: str = 'blosc-lz4', compressionLevel: int = 5, append: bool = False, waveformSamples: int = 1024, waveformDtype = np.float32) -> None:
+        """
+        All the tables of the run in one HDF5 file, <name>.h5, meant to keep every waveform: the raw
+        waveforms are a chunked (events, channels, samples) dataset written with one bulk copy per block,
+        the header and ntuple columns are separate 1D datasets.
+
+        Parameters
+        ----------
+            channels (int) : channels of every raw event (e.g. 9 * enabled groups for full X742 events)
+            chunkEvents (int) : events per chunk of the waveform dataset (chunk shape (chunkEvents, channels, samples))
+            compression (str) : blosc-lz4, blosc-zstd, lz4 (hdf5plugin), lzf, gzip or none (lossless, shuffled)
+            compressionLevel (int) : level of blosc and gzip
+            append (bool) : an existing file is extended instead of overwritten (e.g. to continue after a rotation)
+            waveformSamples (int) : samples per channel of the waveform dataset
+            waveformDtype (np.dtype) : type of the stored samples (np.float32 or np.int16)
+        """
+        super().__init__(waveformSamples, waveformDtype)
+        import h5py
+        self.h5py = h5py
+        self.channels = channels
+        self.chunkEvents = chunkEvents
+        self.compression = compression
+        self.compressionLevel = compressionLevel
+        self.append = append
+        self.h5file = None
+        self._setup = []
+        # Row buffers of the processed ntuple and of the raw waveforms (per-event fills)
+        self._dataChunk = max(chunkEvents, 4096)
+        self._data = np.zeros(self._dataChunk, dtype=DT5730_NTUPLE_dtype)
+        self._dataRows = 0
+        self._raw = np.zeros(chunkEvents, dtype=DT5730_RAW_dtype)
+        self._rawWaveforms = np.zeros((chunkEvents, channels, waveformSamples), dtype=self.waveformDtype)
+        self._rawRows = 0
+
+    # Extendable dataset of the group, created if missing
+    def _dataset(self, group, name: str, shape: tuple, dtype, chunkRows: int, description: str = "", **kwargs):
+        if name in group: return group[name]
+        dataset = group.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype, chunks=(chunkRows,) + shape, **kwargs)
+        if description: dataset.attrs['description'] = description
+        return dataset
+
+    # Append rows to extendable datasets
+    def _appendColumns(self, group, rows: np.ndarray):
+        for name in rows.dtype.names:
+            dataset = group[name]
+            size = dataset.shape[0]
+            dataset.resize(size + len(rows), axis=0)
+            dataset[size:] = rows[name]
+
+    def open(self, path: str, descriptions: dict):
+        h5py = self.h5py
+        self.h5file = h5py.File(os.path.splitext(path)[0] + self.extension, 'a' if self.append else 'w')
+        self._setup = []
+        self._dataRows = self._rawRows = 0
+        data = self.h5file.require_group("DT5730")
+        data.attrs['title'] = "DT5730 processed data"
+        for name in DT5730_NTUPLE_dtype.names:
+            self._dataset(data, name, (), DT5730_NTUPLE_dtype[name], self._dataChunk, descriptions.get(name, ""), compression='lzf')
+        raw = self.h5file.require_group("DT5730raw")
+        raw.attrs['title'] = "DT5730 raw values"
+        for name in DT5730_RAW_dtype.names:
+            self._dataset(raw, name, (), DT5730_RAW_dtype[name], max(self.chunkEvents, 1024), compression='lzf')
+        self._dataset(raw, "waveform", (self.channels, self.waveformSamples), self.waveformDtype, self.chunkEvents, "Waveforms (events, channels, samples)",
+                      **_hdf5Compression(self.compression, self.compressionLevel))
+        setup = self.h5file.require_group("DT5730setup")
+        setup.attrs['title'] = "DT5730 setup settings"
+        self._dataset(setup, "run", (), np.int32, 256)
+        for name in ("parName", "parValue", "parDescr"):
+            self._dataset(setup, name, (), h5py.string_dtype(), 256)
+
+    def fillSetup(self, run: int, parameters: list):
+        self._setup.extend((run, parName, parValue, parDescr) for parName, parValue, parDescr in parameters)
+
+    # Write the buffered rows of the processed ntuple
+    def _flushData(self):
+        if self._dataRows == 0: return
+        self._appendColumns(self.h5file["DT5730"], self._data[:self._dataRows])
+        self._dataRows = 0
+
+    def fillData(self, *values):
+        self._data[self._dataRows] = values
+        self._dataRows += 1
+        if self._dataRows == self._dataChunk: self._flushData()
+
+    def fillDataBlock(self, block: np.ndarray):
+        self._flushData()
+        rows = np.empty(len(block), dtype=DT5730_NTUPLE_dtype)
+        for i, name in enumerate(DT5730_NTUPLE_dtype.names): rows[name] = block[:, i]
+        self._appendColumns(self.h5file["DT5730"], rows)
+
+    # Append header and waveforms of a block to the raw datasets
+    def _writeRaw(self, header: np.ndarray, waveforms: np.ndarray):
+        raw = self.h5file["DT5730raw"]
+        self._appendColumns(raw, header)
+        dataset = raw["waveform"]
+        size = dataset.shape[0]
+        dataset.resize(size + len(waveforms), axis=0)
+        dataset[size:] = waveforms
+
+    # Write the buffered raw waveforms
+    def _flushRaw(self):
+        if self._rawRows == 0: return
+        self._writeRaw(self._raw[:self._rawRows], self._rawWaveforms[:self._rawRows])
+        self._rawRows = 0
+
+    def fillRaw(self, run: int, runTime: int, event: int, timestamp, TrgTstamp_us, TrgID: int, waveform: np.ndarray):
+        waveform = np.reshape(waveform, (-1, np.shape(waveform)[-1]))
+        channelsNb, samplesNb = min(len(waveform), self.channels), min(waveform.shape[-1], self.waveformSamples)
+        self._raw[self._rawRows] = (run, runTime, event, timestamp, TrgTstamp_us, TrgID, samplesNb)
+        self._rawWaveforms[self._rawRows] = 0
+        self._rawWaveforms[self._rawRows, :channelsNb, :samplesNb] = waveform[:channelsNb, :samplesNb]
+        self._rawRows += 1
+        if self._rawRows == self.chunkEvents: self._flushRaw()
+
+    def fillRawBlock(self, header: np.ndarray, waveforms: np.ndarray):
+        """
+        Append a block of raw events. The writes are aligned to the chunks: small blocks are gathered
+        in a chunk buffer, the whole chunks of large blocks are written with a single copy per dataset
+
+        Parameters
+        ----------
+            header (np.ndarray) : (N,) DT5730_RAW_dtype, waveformSize is set here
+            waveforms (np.ndarray) : (N, samples) or (N, channels, samples) waveforms (e.g. X742_eventBatch.samples reshaped to (N, 9 * groups, RecordLength))
+        """
+        if waveforms.ndim == 2: waveforms = waveforms[:, None, :]
+        waveforms, samplesNb = _fitWaveforms(waveforms, (self.channels, self.waveformSamples), self.waveformDtype)
+        eventsNb, done = len(header), 0
+        while done < eventsNb:
+            if self._rawRows == 0 and eventsNb - done >= self.chunkEvents:
+                # Whole chunks straight from the block
+                chunk = (eventsNb - done) // self.chunkEvents * self.chunkEvents
+                rows = header[done:done + chunk].copy()
+                rows['waveformSize'] = samplesNb
+                self._writeRaw(rows, waveforms[done:done + chunk])
+            else:
+                # Fill the chunk buffer
+                chunk = min(eventsNb - done, self.chunkEvents - self._rawRows)
+                self._raw[self._rawRows:self._rawRows + chunk] = header[done:done + chunk]
+                self._raw['waveformSize'][self._rawRows:self._rawRows + chunk] = samplesNb
+                self._rawWaveforms[self._rawRows:self._rawRows + chunk] = waveforms[done:done + chunk]
+                self._rawRows += chunk
+                if self._rawRows == self.chunkEvents: self._flushRaw()
+            done += chunk
+
+    def close(self):
+        self._flushData()
+        self._flushRaw()
+        if self._setup:
+            run, parName, parValue, parDescr = zip(*self._setup)
+            setup = np.empty(len(self._setup), dtype=[('run', np.int32), ('parName', object), ('parValue', object), ('parDescr', object)])
+            setup['run'], setup['parName'], setup['parValue'], setup['parDescr'] = run, parName, parValue, parDescr
+            self._appendColumns(self.h5file["DT5730setup"], setup)
+        # Sample-time axis of the raw waveforms, once per file
+        if "DT5730rawTime" in self.h5file: del self.h5file["DT5730rawTime"]
+        self.h5file.create_dataset("DT5730rawTime", data=self.waveformTime)
+        self.h5file.close()
+        self.h5file = None
+        self._setup = []
+
+    def clear(self):
+        self._setup = []
+        self._dataRows = self._rawRows = 0
+
+
+# Backend from its name
+OUTPUT_BACKENDS = {
+    'root'      : rootBackend,
+    'parquet'   : parquetBackend,
+    'hdf5'      : hdf5Backend
+}
@@ -0,0 +1,233 @@
+#################################################################################################
+# @info Raw recording of the DT5742B readout blocks                                             #
+#       Every CAEN_DGTZ_ReadData block is appended unmodified to <name>.raw and described by    #
+#       a fixed-width record in the sidecar index <name>.idx, so that decoding can be deferred  #
+#       to offline and runs can be replayed exactly. Every event is described by a fixed-width  #
+#       record in <name>.evt, used by rawRunReader for random access in O(log n).               #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+from x742decoder import X742_eventOffsets, X742_parseBuffer, X742_eventBatch
+import numpy as np
+import ctypes
+import mmap
+import os
+import time
+
+# Record of the block index (<name>.idx)
+RAW_BLOCK_INDEX_dtype = np.dtype([
+    ('offset',              np.uint64),     # position of the block in the .raw file [bytes]
+    ('size',                np.uint32),     # size of the block [bytes]
+    ('eventsNb',            np.uint32),     # number of events in the block
+    ('firstEventCounter',   np.uint32),     # EventCounter of the first event
+    ('lastEventCounter',    np.uint32),     # EventCounter of the last event
+    ('hostTimestamp',       np.float64)     # posix time of the readout on the host
+])
+
+# Record of the event index (<name>.evt)
+RAW_EVENT_INDEX_dtype = np.dtype([
+    ('offset',              np.uint64),     # position of the event in the .raw file [bytes]
+    ('size',                np.uint32),     # size of the event [bytes]
+    ('block',               np.uint32),     # block number (row of the .idx file)
+    ('EventCounter',        np.uint32),     # 22-bit event counter of the digitizer
+    ('TriggerTimeTag',      np.uint32),     # 32-bit trigger time tag of the digitizer
+    ('eventNumber',         np.uint64),     # EventCounter unwrapped over its rollovers (monotonic)
+    ('triggerTime',         np.uint64),     # TriggerTimeTag unwrapped over its rollovers (monotonic)
+    ('hostTimestamp',       np.float64)     # posix time of the readout of the block on the host
+])
+
+
+# Unwrap a counter of the given bit width, continuing from the last unwrapped value
+def _unwrapCounter(values: np.ndarray, bits: int, last: int) -> np.ndarray:
+    full = np.empty(len(values) + 1, dtype=np.int64)
+    full[0] = last
+    full[1:] = values
+    steps = np.diff(full) % (1 << bits)
+    return last + np.cumsum(steps)
+
+
+class rawRecorder():
+    def __init__(self, fname: str, bufferSize: int = 16 * 1024 * 1024) -> None:
+        """
+        Open the raw data file <fname>.raw, its block index <fname>.idx and event index <fname>.evt
+
+        Parameters
+        ----------
+            fname (str) : path of the run files without extension
+            bufferSize (int) : size of the write buffer of the data file [bytes]. Large buffers turn the
+                               block appends into few large sequential writes
+        """
+        self.fname = fname
+        self.rawFile = open(fname + '.raw', 'wb', buffering=bufferSize)
+        self.idxFile = open(fname + '.idx', 'wb', buffering=1024 * RAW_BLOCK_INDEX_dtype.itemsize)
+        self.evtFile = open(fname + '.evt', 'wb', buffering=65536 * RAW_EVENT_INDEX_dtype.itemsize)
+        self._lastEventNumber = None
+        self._lastTriggerTime = None
+        self.offset = 0
+        self.blocksNb = 0
+        self.eventsNb = 0
+        self._record = np.zeros(1, dtype=RAW_BLOCK_INDEX_dtype)
+
+    # Append a readout block
+    def writeBlock(self, buffer, bsize: int, eventsNb: int, hostTimestamp: float = None):
+        """
+        Append a readout block to the data file and its record to the index
+
+        Parameters
+        ----------
+            buffer (ctypes.POINTER(ctypes.c_char) | bytes-like) : readout buffer (CAEN_DGTZ_ReadData)
+            bsize (int) : size of the block [bytes]
+            eventsNb (int) : number of events in the block
+            hostTimestamp (float) : posix time of the readout (time.time() if None)
+        """
+        if bsize == 0: return
+        if isinstance(buffer, (bytes, bytearray, memoryview, np.ndarray)):
+            block = memoryview(buffer).cast('B')[:bsize]
+        else:
+            block = memoryview((ctypes.c_char * bsize).from_address(ctypes.cast(buffer, ctypes.c_void_p).value)).cast('B')
+        self.rawFile.write(block)
+
+        # Event counters and time tags from the event headers
+        hostTimestamp = time.time() if hostTimestamp is None else hostTimestamp
+        words = np.frombuffer(block, dtype=np.uint32)
+        offsets, sizes = X742_eventOffsets(words)
+        EventCounter = words[offsets + 2] & 0x3FFFFF
+        TriggerTimeTag = words[offsets + 3]
+        
+        record = self._record
+        record['offset'] = self.offset
+        record['size'] = bsize
+        record['eventsNb'] = eventsNb
+        record['firstEventCounter'] = EventCounter[0]
+        record['lastEventCounter'] = EventCounter[-1]
+        record['hostTimestamp'] = hostTimestamp
+        self.idxFile.write(record.tobytes())
+
+        # Event index, with the counters unwrapped to keep them monotonic along the run
+        if self._lastEventNumber is None:
+            self._lastEventNumber = int(EventCounter[0]) - 1
+            self._lastTriggerTime = int(TriggerTimeTag[0])
+        events = np.empty(len(offsets), dtype=RAW_EVENT_INDEX_dtype)
+        events['offset'] = self.offset + 4 * offsets
+        events['size'] = 4 * sizes
+        events['block'] = self.blocksNb
+        events['EventCounter'] = EventCounter
+        events['TriggerTimeTag'] = TriggerTimeTag
+        events['eventNumber'] = _unwrapCounter(EventCounter, 22, self._lastEventNumber)
+        events['triggerTime'] = _unwrapCounter(TriggerTimeTag, 32, self._lastTriggerTime)
+        events['hostTimestamp'] = hostTimestamp
+        self.evtFile.write(events.tobytes())
+        self._lastEventNumber = int(events['eventNumber'][-1])
+        self._lastTriggerTime = int(events['triggerTime'][-1])
+
+        self.offset += bsize
+        self.blocksNb += 1
+        self.eventsNb += eventsNb
+
+    # Flush and close the files
+    def close(self):
+        if self.rawFile.closed: return
+        self.rawFile.close()
+        self.idxFile.close()
+        self.evtFile.close()
+
+
+# Read the block index of a recorded run
+def readBlockIndex(fname: str) -> np.ndarray:
+    return np.fromfile(fname + '.idx', dtype=RAW_BLOCK_INDEX_dtype)
+
+
+
+# Random access reader of a recorded run
+class rawRunReader():
+    def __init__(self, fname: str, GroupEnableMask: int = 0b1, RecordLength: int = 1024) -> None:
+        """
+        Memory-map the data file <fname>.raw and the event index <fname>.evt of a recorded run.
+        Nothing is loaded in memory until events are requested.
+
+        Parameters
+        ----------
+            fname (str) : path of the run files without extension
+            GroupEnableMask (int) : groups to be decoded
+            RecordLength (int) : number of samples per channel
+        """
+        self.fname = fname
+        self.GroupEnableMask = GroupEnableMask
+        self.RecordLength = RecordLength
+        self._rawFile = open(fname + '.raw', 'rb')
+        # A run without recorded blocks has empty files, which cannot be memory-mapped: zero events
+        if os.fstat(self._rawFile.fileno()).st_size == 0:
+            self._mmap = None
+            self.raw = np.empty(0, dtype=np.uint8)
+        else:
+            self._mmap = mmap.mmap(self._rawFile.fileno(), 0, access=mmap.ACCESS_READ)
+            self.raw = np.frombuffer(self._mmap, dtype=np.uint8)
+        if os.path.getsize(fname + '.evt') == 0: self.index = np.empty(0, dtype=RAW_EVENT_INDEX_dtype)
+        else: self.index = np.memmap(fname + '.evt', dtype=RAW_EVENT_INDEX_dtype, mode='r')
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    # Position in the run of the event with the given (unwrapped) event number
+    def findEvent(self, eventNumber: int) -> int:
+        """
+        Binary search of the event by its number (EventCounter unwrapped over the 22-bit rollovers;
+        equal to EventCounter for the first 4194304 events)
+
+        Returns
+        -------
+            i (int) : position of the event in the run
+
+        Raises
+        ------
+            KeyError : the event is not in the run
+        """
+        i = int(np.searchsorted(self.index['eventNumber'], eventNumber))
+        if i == len(self.index) or self.index['eventNumber'][i] != eventNumber: raise KeyError(f"Event {eventNumber} not in {self.fname}")
+        return i
+
+    # Position in the run of the first event at or after the given (unwrapped) trigger time
+    def findTime(self, triggerTime: int) -> int:
+        return int(np.searchsorted(self.index['triggerTime'], triggerTime))
+
+    # Raw bytes of events start:stop (a view of the memory-mapped file: events are contiguous on disk)
+    def rawEvents(self, start: int, stop: int) -> np.ndarray:
+        if stop <= start: return self.raw[:0]
+        first, last = self.index[start], self.index[stop - 1]
+        return self.raw[int(first['offset']) : int(last['offset']) + int(last['size'])]
+
+    # Decode events start:stop
+    def getEvents(self, start: int, stop: int) -> X742_eventBatch:
+        """
+        Decode a contiguous range of events. Only the pages of the requested events are read from disk.
+
+        Parameters
+        ----------
+            start, stop (int) : range of the event positions in the run
+
+        Returns
+        -------
+            batch (X742_eventBatch) : decoded events, blockTimestamp is the host time of their readout
+        """
+        start, stop = max(start, 0), min(stop, len(self.index))
+        batch = X742_parseBuffer(self.rawEvents(start, stop), self.GroupEnableMask, self.RecordLength)
+        batch.header['blockTimestamp'] = self.index['hostTimestamp'][start:stop]
+        return batch
+
+    # Decode the events at arbitrary positions of the run
+    def takeEvents(self, positions: np.ndarray) -> X742_eventBatch:
+        positions = np.asarray(positions, dtype=np.int64)
+        raw = np.concatenate([self.rawEvents(i, i + 1) for i in positions]) if len(positions) else self.raw[:0]
+        batch = X742_parseBuffer(raw, self.GroupEnableMask, self.RecordLength)
+        batch.header['blockTimestamp'] = self.index['hostTimestamp'][positions]
+        return batch
+
+    # Decode the events with the given (unwrapped) event numbers
+    def getEventsByNumber(self, eventNumbers: np.ndarray) -> X742_eventBatch:
+        return self.takeEvents([self.findEvent(n) for n in np.atleast_1d(eventNumbers)])
+
+    # Unmap the files
+    def close(self):
+        del self.raw
+        del self.index
+        if self._mmap is not None: self._mmap.close()
+        self._rawFile.close()
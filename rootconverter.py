@@ -1,19 +1,35 @@
-from array import array
-from logger import *
+from outputbackends import outputBackend, OUTPUT_BACKENDS, DT5730_NTUPLE_COLUMNS, DT5730_RAW_dtype
+from calibration import waveformCalibration
+from caendt5742b import CAEN_DGTZ_BoardInfo_t
+from logger import create_logger
 import numpy as np
-import ROOT
+import threading
+import atexit
+import queue
 import time
 
-from caendt5730 import CAENDT5730
-CAEN_DGTZ_BoardInfo_t = CAENDT5730.CAEN_DGTZ_BoardInfo_t
-del CAENDT5730
-
+logging = create_logger("rootconverter")
 
 ##############################################################
 ######## rootconverter class #################################
 ##############################################################
 class rootconverter():
-    def __init__(self, path = "/home/pietro/work/CLEAR_March/DT5730/clear/", jobEvents=1000, dgtCalibration = [0.00012782984648295086,-1.0470712607404515], bgzGain = 32, periodTrg=20) -> None:
+    def __init__(self, path = "/home/pietro/work/CLEAR_March/DT5730/clear/", jobEvents=1000, dgtCalibration = [0.00012782984648295086,-1.0470712607404515], bgzGain = 32, periodTrg=20, basketEvents: int = 0, compression: int = 101, waveformSamples: int = 1024, waveformDtype = np.float32, backend = 'root',
+                 rotateEvents: int = 0, rotateBytes: int = 0, rotateTime_s: float = 0, backgroundWriter: bool = False, fileNameFormat: str = "DT5730_run{run}_{seq:04d}", calibration: waveformCalibration = None) -> None:
+        """
+        Parameters
+        ----------
+            backend (str | outputBackend | callable) : output format, 'root', 'parquet' or 'hdf5' (backends with default options
+                                            from basketEvents, compression, waveformSamples and waveformDtype),
+                                            a configured outputbackends.outputBackend instance or a function returning one
+            rotateEvents (int) : a new file is started every rotateEvents events (0: no rotation on the events)
+            rotateBytes (int) : a new file is started once rotateBytes bytes have been stored (uncompressed, 0: no limit)
+            rotateTime_s (float) : a new file is started after rotateTime_s seconds, checked at every store (0: no limit)
+            backgroundWriter (bool) : the files are written and closed by a background thread (needs a backend
+                                      name or function, to open the next file while the previous one is closed)
+            fileNameFormat (str) : name of the files without extension, with the run and seq (sequence in the run) fields
+            calibration (waveformCalibration) : ADC -> V -> nC conversion, built from dgtCalibration and bgzGain if None
+        """
         logging.debug(f"rootlogger. Output dir: {path}. Run is made of {jobEvents} events.")
         self.fname = ""
         self.outputROOTdirectory = path
@@ -33,44 +49,52 @@ class rootconverter():
         #
         self.parseLineData_prev = []
         self.strData_prev = ["-1" for i in range(6)]
-        # Global variables for ROOT filesaving
-        self.rfile = None               # pointer to the ROOT TFile
-        self.runSetupTree = None        # setup ttree
-        self.runDataTree = None         # data ttree
-        self.runDataTreeRaw = None      # raw data ttree
+        # Output backend (ROOT, pyarrow or h5py are imported only by the backend in use)
+        self.backendFactory = None
+        if isinstance(backend, outputBackend):
+            self.backend = backend
+        elif callable(backend):
+            self.backendFactory = backend
+        elif backend == 'root':
+            self.backendFactory = lambda: OUTPUT_BACKENDS['root'](basketEvents, compression, waveformSamples, waveformDtype)
+        elif backend == 'parquet':
+            self.backendFactory = lambda: OUTPUT_BACKENDS['parquet'](rowGroupEvents = basketEvents or 65536, waveformSamples = waveformSamples, waveformDtype = waveformDtype)
+        elif backend == 'hdf5':
+            self.backendFactory = lambda: OUTPUT_BACKENDS['hdf5'](waveformSamples = waveformSamples, waveformDtype = waveformDtype)
+        else:
+            raise ValueError(f"Unknown output backend {backend}")
+        if self.backendFactory is not None: self.backend = self.backendFactory()
         self.rFileOpen = False 
-        # TTree: setup
-        self.vrunIDs = ROOT.vector('int')()
-        self.vparName = ROOT.vector('string')()
-        self.vparValue = ROOT.vector('string')()
-        self.vparDescr = ROOT.vector('string')()
-        # TTree: dataRaw
-        self.irun = array("i", [-1])
-        self.irunTime = array("Q", [0])
-        self.ievent = array("i", [-1])
-        self.ftimestamp = array("d", [-1])
-        self.fTrgTstamp_us = array("d", [-1])
-        self.iTrgID = array("i", [-1])
-        self.vwaveform = ROOT.vector('int')()
-        self.vwaveformTime = ROOT.vector('int')()
+
+        # Rotation of the output files
+        self.rotateEvents = rotateEvents
+        self.rotateBytes = rotateBytes
+        self.rotateTime_s = rotateTime_s
+        self.fileNameFormat = fileNameFormat
+        self.fileSeq = 0
+        self.fileEvents = 0
+        self.fileBytes = 0
+        self.fileOpenTime = 0.0
+        self.nextFilePending = False
+        self.runSetup = []
+        # Background writer: the closing files are queued to a thread, the next file is opened at once
+        self.writerQueue = None
+        self.closedFilesNb = 0
+        self.closeTime_s = 0.0
+        self.writerErrorsNb = 0
+        if backgroundWriter:
+            if self.backendFactory is None:
+                logging.warning("[rootconverter] Background writer needs a backend name or function: files are closed in the data path")
+            else:
+                self.backend.enableThreads()
+                self.writerQueue = queue.Queue()
+                self.writerThread = threading.Thread(target=self._writerLoop, daemon=True)
+                self.writerThread.start()
+                # The queued files are closed before the interpreter exits
+                atexit.register(self.stopWriter)
         
-        # Digitizer calibration data (ADC to volt)
-        self.cal_m = dgtCalibration[0] 
-        self.cal_q = dgtCalibration[1] 
-        # Bergoz calibration data
-        # Table is 6,12...dB and it contains V/nC
-        bgzCLEARCal = {
-           #6  : 2.085,
-           #12 : 4.180,
-           #18 : 8.350,
-           #20 : 10.42,
-           #26 : 20.95,
-            32 : 4.190#/2.0,
-            #40 : 105.0
-            } 
-        # storing the actual one
-        self.bgz_m = bgzCLEARCal[bgzGain]
-        self.bgz_q = 0
+        # Digitizer (ADC to volt) and Bergoz (volt to nC, calibration.BERGOZ_CLEAR_CAL) calibration, same as the producer
+        self.calibration = calibration if calibration is not None else waveformCalibration.fromLinear(dgtCalibration, bgzGain)
         # The calculated average charge [in nC]
         self.avgQ = 0
         self.avgV = 0
@@ -79,9 +103,10 @@ class rootconverter():
         self.periodTrg = periodTrg
 
     def __del__(self):
-        self.clear_runSetupTreeVectors()
-        self.clear_runDataTreeRawVectors()
-        logging.info("[rootconverter] Memory cleared")
+        # The backend may be missing if its construction failed (e.g. ROOT not available)
+        if not hasattr(self, 'backend'): return
+        self.backend.clear()
+        logging.debug("[rootconverter] Memory cleared")
 
     # Set the output directory of the ROOT files
     def setOutputROOTDir(self, path: str):
@@ -104,9 +129,9 @@ class rootconverter():
     
     # Apply the calibration to convert from ADC value to absolute voltage
     def _dsp_applyCalibration(self, prcWavOut : tuple):
-        avgV = prcWavOut[0] * self.cal_m + self.cal_q
-        stdV = prcWavOut[1]
-        self.avgQ = avgV/self.bgz_m + self.bgz_q 
+        avgV = self.calibration.toVolt(prcWavOut[0])
+        stdV = self.calibration.toVoltSpread(prcWavOut[1])
+        self.avgQ = self.calibration.toCharge(avgV)
         return (avgV, stdV, self.avgQ)
     
 
@@ -127,6 +152,7 @@ class rootconverter():
         dgt_evt = evtInfo["EventCounter"]
         dgt_trgtime = evtInfo["TriggerTimeTag"]
         dgt_evtsize = evtInfo["EventSize"]      
+        if self.nextFilePending: self._openNextFile()
 
         # Calculate the average value, standard deviation and number of points in the average. Based on raw values (samples)
         avg, std, ptNb = self._dsp_processWaveform(waveform)
@@ -136,83 +162,86 @@ class rootconverter():
         trgtime = trg0Time #to be calculated
         runTime = time.time_ns()
         # If this flag is enable, then store the entire waveform in the dedicated TTree
-        if self.waveformTimer():
-            # TODO implement
-            # Generate timetags
-            #timetags = np.linspace(0, evtInfo["EventSize"])
-            # Dump waveform on the TTree
-            self.irun[0] = self.runID
-            self.irunTime[0] = runTime
-            self.ievent[0] = self.eventID
-            self.ftimestamp[0] = trgtime
-            self.fTrgTstamp_us[0] = dgt_trgtime
-            self.iTrgID[0] = 0
-            for i, adc in enumerate(waveform):
-                self.vwaveformTime.push_back(int(i))
-                self.vwaveform.push_back(int(adc)) 
-            self.runDataTreeRaw.Fill()
-            self.clear_runDataTreeRawVectors()
-            #
+        storeWaveform = self.waveformTimer()
+        if storeWaveform:
+            self._storeWaveformROOT(self.eventID, runTime, trgtime, dgt_trgtime, waveform)
         
         # Data object
         if self.rFileOpen:
-            self.runDataTree.Fill(self.runID, runTime, self.eventID, dgt_evt, dgt_trgtime, dgt_evtsize, avg, std, ptNb, self.avgV, stdV, self.avgQ, trgtime)
+            self.backend.fillData(self.runID, runTime, self.eventID, dgt_evt, dgt_trgtime, dgt_evtsize, avg, std, ptNb, self.avgV, stdV, self.avgQ, trgtime)
             self.eventID += 1
+            self.fileEvents += 1
+            self.fileBytes += 4 * len(DT5730_NTUPLE_COLUMNS) + (np.asarray(waveform).nbytes if storeWaveform else 0)
+            if self._rotationDue(): self.rotate()
         return 0
 
-    # Clear rundataRaw vectors
-    def clear_runDataTreeRawVectors(self):
-        self.vwaveform.clear()
-        self.vwaveformTime.clear()
-    # Clear setup vectors
-    def clear_runSetupTreeVectors(self):
-        self.vrunIDs.clear()
-        self.vparName.clear()
-        self.vparValue.clear()
-        self.vparDescr.clear()
+    # Dump a waveform on the raw output
+    def _storeWaveformROOT(self, event: int, runTime: int, trgtime, dgt_trgtime, waveform: np.ndarray):
+        self.backend.fillRaw(self.runID, runTime, event, trgtime, dgt_trgtime, 0, waveform)
 
-    # Create the "a:b:c" string that describes the root data structure of say a TTree
-    def _utils_mkRootTtreeDefineFromDict(self, input: dict) -> str:
-        result = ""
-        for item in list(input.keys()):
-            result += f"{item}:"
-        return result[:-1]
-    # Set description (better readibility)
-    def _utils_mkRootTtreeHumanDescrFromDict(self, tree, tree_nametypes):
-        # If a branch name is not compatible with ROOT name conventions, the
-        # name is first sanified and then a branch with that name is created.
-        # For example 'myname2.' cannot exist
-        # A naive comparison like 
-        # for entry in tree_nametypes:
-        #     tree.GetBranch(entry[0]).SetTitle(entry[3])
-        # would fail since the GetBranch for 'myname2.' would return nullpointer
+    # Set the sample-time axis of the waveforms (e.g. CAENDT5742B.waveformtime), stored once per run
+    def setWaveformTime(self, waveformTime: np.ndarray):
+        self.backend.setWaveformTime(waveformTime)
 
-        # WARNING: using GetLeaf works but it produces a bug in the generated ROOT output
-        # file such that the Data is not displayed when using sca. With the traditional TBrowser
-        # it won't work either while with the web ROOT interface it works.
-
-        for entry in tree_nametypes:
-                try:
-                    branch = tree.GetBranch(entry[0])
-                    branch.SetTitle(entry[3])
-                except ReferenceError:
-                    (self.logging).error(f"Branch {entry[0]} not found. This is nullptr")
+    # Process and store a block of events at once (columnar mode)
+    def _dsp_storeBlockROOT(self, info: np.ndarray, waveforms: np.ndarray, trg0Time):
+        """
+        Process and store a block of events with numpy operations on the whole block
 
+        Parameters
+        ----------
+            info (np.ndarray) : (N,) structured array with the EventCounter, TriggerTimeTag and EventSize fields (e.g. X742_eventBatch.header)
+            waveforms (np.ndarray) : (N, samples) waveforms
+            trg0Time : trigger time stored in the trgtime column
+        """
+        eventsNb = len(waveforms)
+        if not self.rFileOpen or eventsNb == 0: return 0
+        if self.nextFilePending: self._openNextFile()
+        # Block across a rotation on the events: the first part completes the current file
+        if self.rotateEvents > 0 and 0 < self.rotateEvents - self.fileEvents < eventsNb:
+            split = self.rotateEvents - self.fileEvents
+            self._dsp_storeBlockROOT(info[:split], waveforms[:split], trg0Time)
+            return self._dsp_storeBlockROOT(info[split:], waveforms[split:], trg0Time)
+        # Average, standard deviation and number of points in the window. Based on raw values (samples)
+        gateWindow = waveforms[:, self.avgWindow[0]:self.avgWindow[1]]
+        avg = gateWindow.mean(axis=1)
+        std = gateWindow.std(axis=1)
+        ptNb = self.avgWindow[1]-self.avgWindow[0]
+        # Get calibrated values in V
+        avgV, stdV, avgQ = self._dsp_applyCalibration((avg, std, ptNb))
+        self.avgV, self.avgQ = avgV[-1], avgQ[-1]
+        runTime = time.time_ns()
+        
+        events = self.eventID + np.arange(eventsNb)
+        # Waveforms of the events selected by the waveform timer (all of them with periodTrg = 1), in one block
+        if self.periodTrg > 0:
+            selected = np.flatnonzero(events % self.periodTrg == 0)
+            raw = np.zeros(len(selected), dtype=DT5730_RAW_dtype)
+            raw['run'], raw['runTime'], raw['event'], raw['timestamp'] = self.runID, runTime, events[selected], trg0Time
+            raw['TrgTstamp_us'] = info['TriggerTimeTag'][selected]
+            self.backend.fillRawBlock(raw, waveforms[selected])
+            self.fileBytes += raw.nbytes + waveforms[selected].nbytes
+        block = np.column_stack([np.full(eventsNb, self.runID), np.full(eventsNb, runTime), events, info['EventCounter'], info['TriggerTimeTag'], info['EventSize'],
+                                 avg, std, np.full(eventsNb, ptNb), avgV, stdV, avgQ, np.full(eventsNb, trg0Time)])
+        self.backend.fillDataBlock(block)
+        self.eventID += eventsNb
+        self.fileEvents += eventsNb
+        self.fileBytes += 4 * block.size
+        if self._rotationDue(): self.rotate()
+        return 0
 
+    # Name of the current file of the run
+    def fileName(self) -> str:
+        return self.fileNameFormat.format(run=self.runID, seq=self.fileSeq) + self.backend.extension
 
     # Prepare the ROOT file
-    def prepareROOT(self, fname: str):
-        # Set filename
-        self.fname = fname
-        #
-        self.rfile = ROOT.TFile.Open(self.outputROOTdirectory+self.fname, "RECREATE")
-        # Create TTree to store run setup data
-        self.runSetupTree = ROOT.TTree('DT5730setup', 'TTree with run DT5730 setup settings')
-        self.runSetupTree.Branch("run", self.vrunIDs)
-        self.runSetupTree.Branch("parName", self.vparName)
-        self.runSetupTree.Branch("parValue", self.vparValue)
-        self.runSetupTree.Branch("parDescr", self.vparDescr)
-        logging.debug(self.runSetupTree)
+    def prepareROOT(self, fname: str = None):
+        # Set filename (generated from the run ID and the file sequence if None)
+        self.fname = fname if fname is not None else self.fileName()
+        self.fileEvents = 0
+        self.fileBytes = 0
+        self.fileOpenTime = time.monotonic()
+        self.nextFilePending = False
         # Create TTree to store run datapoints (TrgTstamp_us, TrgID, avg, std, ptNb, avgV, stdV, avgQ)
         setupEntries = {
             "run"         : "Run id number",
@@ -229,50 +258,103 @@ class rootconverter():
             "avgQ"        : "Average cal. charge in the window [nC]",
             "trgtime"     : "Dgt trg counter converted in time using runTime as T0 start"
         }
-        self.runDataTree = ROOT.TNtuple("DT5730", "DT5730 processed data", self._utils_mkRootTtreeDefineFromDict(setupEntries))
-        # Description for the various entries
-        self._utils_mkRootTtreeHumanDescrFromDict(self.runDataTree, setupEntries)
-        # Raw waveforms (saved only some times)
-        self.runDataTreeRaw = ROOT.TTree("DT5730raw", "DT5730 raw values")
-        self.runDataTreeRaw.Branch("run",          self.irun            , "run/I")
-        self.runDataTreeRaw.Branch("runTime",      self.irunTime        , "runTime/I")
-        self.runDataTreeRaw.Branch("event",        self.ievent          , "event/I")
-        self.runDataTreeRaw.Branch("timestamp",    self.ftimestamp      , "timestamp/I")
-        self.runDataTreeRaw.Branch("TrgTstamp_us", self.fTrgTstamp_us   , "TrgTstamp_us/I")
-        self.runDataTreeRaw.Branch("TrgID",        self.iTrgID          , "TrgID/I")
-        self.runDataTreeRaw.Branch("waveform",     self.vwaveform)
-        self.runDataTreeRaw.Branch("waveformTime", self.vwaveformTime)
-        logging.debug(self.runDataTreeRaw)
-        # Clear runSetup vectors
-        self.clear_runSetupTreeVectors()
+        self.backend.open(self.outputROOTdirectory+self.fname, setupEntries)
         # Set the ROOT file status to open
         self.rFileOpen = True
 
     # Close the instance of the ROOT file currently open
     def closeROOT(self):
         if self.rFileOpen:
-            self.runSetupTree.Write()
-            self.runDataTree.Write()
-            self.runDataTreeRaw.Write()
-            self.rfile.Close()
+            # After a rotation without further events the next file has not been opened: nothing to close
+            if not self.nextFilePending: self._closeBackend()
             self.rFileOpen = False
+            self.nextFilePending = False
             self.eventID = 0
+            self.fileSeq = 0
+            self.runSetup = []
         logging.debug("closeROOT")
 
+    # Close the output of the backend, on the writer thread if enabled (a new backend takes over)
+    def _closeBackend(self):
+        if self.writerQueue is None:
+            self.backend.close()
+            self.closedFilesNb += 1
+            return
+        backend, self.backend = self.backend, self.backendFactory()
+        self.backend.enableThreads()
+        self.backend.setWaveformTime(backend.waveformTime)
+        self.writerQueue.put(backend)
+
+    # Check the rotation conditions of the current file
+    def _rotationDue(self) -> bool:
+        if self.rotateEvents > 0 and self.fileEvents >= self.rotateEvents: return True
+        if self.rotateBytes > 0 and self.fileBytes >= self.rotateBytes: return True
+        if self.rotateTime_s > 0 and time.monotonic() - self.fileOpenTime >= self.rotateTime_s: return True
+        return False
+
+    # Close the current file and continue the run in the next one (events are never split nor repeated)
+    def rotate(self):
+        if not self.rFileOpen: return
+        logging.info(f"[rootconverter] Rotating {self.fname}: {self.fileEvents} events, {self.fileBytes} bytes")
+        self._closeBackend()
+        self.fileSeq += 1
+        # The next file is opened by the first event stored after the rotation (no empty file at the end of the run)
+        self.nextFilePending = True
+
+    # Open the next file of the run after a rotation
+    def _openNextFile(self):
+        self.prepareROOT()
+        # Setup of the run repeated in every file
+        if self.runSetup: self.backend.fillSetup(self.runID, self.runSetup)
+
+    # Writer thread: close the queued backends
+    def _writerLoop(self):
+        while True:
+            backend = self.writerQueue.get()
+            try:
+                if backend is None: break
+                startTime = time.perf_counter()
+                backend.close()
+                self.closeTime_s += time.perf_counter() - startTime
+                self.closedFilesNb += 1
+            except Exception as e:
+                self.writerErrorsNb += 1
+                logging.error(f"[rootconverter] Closing of an output file failed: {e}")
+            finally:
+                self.writerQueue.task_done()
+
+    # Wait for the queued files to be closed
+    def waitWriter(self):
+        if self.writerQueue is not None: self.writerQueue.join()
+
+    # Close the queued files and stop the writer thread
+    def stopWriter(self):
+        if self.writerQueue is None: return
+        self.writerQueue.put(None)
+        self.writerThread.join()
+        self.writerQueue = None
+
+    # Counters of the output files
+    def getStats(self) -> dict:
+        return {
+            'fileSeq'       : self.fileSeq,
+            'fileEvents'    : self.fileEvents,
+            'fileBytes'     : self.fileBytes,
+            'closedFiles'   : self.closedFilesNb,
+            'pendingCloses' : self.writerQueue.unfinished_tasks if self.writerQueue is not None else 0,
+            'closeTime_s'   : self.closeTime_s,
+            'writerErrors'  : self.writerErrorsNb
+        }
+
     # Get run info parsing
     def processRunInfo(self, stream: CAEN_DGTZ_BoardInfo_t):
         if stream is None:
             logging.warning("processRunInfo is None")
             return
-        # Fill the self.runInfo var
-        for item in stream.getBrdInfo():
-            # For ROOT
-            self.vrunIDs.push_back(self.runID)
-            self.vparName.push_back(item[0])
-            self.vparValue.push_back(item[1])
-            self.vparDescr.push_back("")
-        # Fill the data on the TTree
-        self.runSetupTree.Fill()
+        # Fill the setup of the run
+        self.runSetup = [(item[0], item[1], "") for item in stream.getBrdInfo()]
+        # Pending file after a rotation: the setup is filled when it is opened
+        if not self.nextFilePending: self.backend.fillSetup(self.runID, self.runSetup)
         logging.info(f"ROOT file {self.fname} saved")
        
 
@@ -284,6 +366,7 @@ class rootconverter():
             return False
 
     def updateRunID(self, id):
+        if id != self.runID: self.fileSeq = 0
         self.runID = id       
 ##############################################################
 ######## / rootconverter class ###############################
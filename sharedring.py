@@ -0,0 +1,237 @@
+#################################################################################################
+# @info Shared-memory fan-out ring of the decoded DT5742B events                                #
+#       The acquisition side writes every event in a multiprocessing.shared_memory ring; any    #
+#       number of local processes (online monitor, producer, ...) attach to it by name and      #
+#       read with their own cursor. The writer never waits: a reader falling behind more than   #
+#       the ring capacity loses the overwritten events, detected through a per-slot seqlock.    #
+#                                                                                               #
+# Shared memory layout                                                                          #
+#   control  [8]        uint64  magic, capacity, groups, RecordLength, head (next sequence)     #
+#   slotSeq  [capacity] uint64  2*seq+1 while the slot is written, 2*seq+2 once complete        #
+#   header   [capacity] X742_headerDtype(groups)                                                #
+#   samples  [capacity, groups, 9, RecordLength] float32                                        #
+#                                                                                               #
+# Usage                                                                                         #
+#   writer: ring = sharedRingWriter('dt5742b', 4096, 0b1, 1024); ring.writeBatch(batch)         #
+#   reader: ring = sharedRingReader('dt5742b'); batch = ring.readBatch(256)                     #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+from multiprocessing import shared_memory, resource_tracker
+from x742decoder import X742_headerDtype, X742_eventBatch, X742_groupsNb
+import numpy as np
+import time
+
+SHARED_RING_MAGIC = 0x5835374232524E47    # 'X57B2RNG'
+_CONTROL_WORDS = 8
+_HEAD = 4
+_createdRings = set()                       # rings created by the writers of this process
+
+
+# Views of the shared memory areas of a ring
+def _sharedRingLayout(shm: shared_memory.SharedMemory, capacity: int, groups: int, RecordLength: int) -> tuple:
+    headerDtype = X742_headerDtype(groups)
+    offset = 0
+    control = np.ndarray((_CONTROL_WORDS,), dtype=np.uint64, buffer=shm.buf, offset=offset)
+    offset += control.nbytes
+    slotSeq = np.ndarray((capacity,), dtype=np.uint64, buffer=shm.buf, offset=offset)
+    offset += slotSeq.nbytes
+    header = np.ndarray((capacity,), dtype=headerDtype, buffer=shm.buf, offset=offset)
+    offset += -(-header.nbytes // 64) * 64                  # samples aligned to 64 bytes
+    samples = np.ndarray((capacity, groups, 9, RecordLength), dtype=np.float32, buffer=shm.buf, offset=offset)
+    return control, slotSeq, header, samples
+
+# Attach to an existing shared memory without taking its ownership (the reader exit must not unlink it)
+def _attachSharedMemory(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)       # python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _createdRings: resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+# Size of the shared memory of a ring [bytes]
+def _sharedRingSize(capacity: int, groups: int, RecordLength: int) -> int:
+    headerBytes = capacity * X742_headerDtype(groups).itemsize
+    return 8 * (_CONTROL_WORDS + capacity) + -(-headerBytes // 64) * 64 + 4 * capacity * groups * 9 * RecordLength
+
+
+class sharedRingWriter():
+    def __init__(self, name: str, capacity: int, GroupEnableMask: int, RecordLength: int) -> None:
+        """
+        Create the shared memory ring
+
+        Parameters
+        ----------
+            name (str) : name of the shared memory block, used by the readers to attach
+            capacity (int) : number of event slots
+            GroupEnableMask (int) : enabled groups
+            RecordLength (int) : number of samples per channel
+        """
+        if capacity < 1: raise ValueError(f"Ring capacity must be positive ({capacity})")
+        self.name = name
+        self.capacity = capacity
+        groups = X742_groupsNb(GroupEnableMask)
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=_sharedRingSize(capacity, groups, RecordLength))
+        self._control, self._slotSeq, self.header, self.samples = _sharedRingLayout(self._shm, capacity, groups, RecordLength)
+        self._control[:] = 0
+        self._slotSeq[:] = 0
+        self._control[1], self._control[2], self._control[3] = capacity, groups, RecordLength
+        self._control[0] = SHARED_RING_MAGIC                # published last: the ring is ready
+        _createdRings.add(name)
+        self._head = 0
+        self._reserved = None
+
+    # Number of events written since the creation
+    @property
+    def written(self) -> int:
+        return self._head
+
+    # Reserve the slot of the next event (never blocks: the oldest event is overwritten)
+    def reserve(self) -> int:
+        slot = self._head % self.capacity
+        self._slotSeq[slot] = 2 * self._head + 1
+        self._reserved = slot
+        return slot
+
+    # Publish the reserved slot to the readers
+    def commit(self):
+        self._slotSeq[self._reserved] = 2 * self._head + 2
+        self._head += 1
+        self._control[_HEAD] = self._head
+        self._reserved = None
+
+    # Write all the events of a decoded block
+    def writeBatch(self, batch: X742_eventBatch):
+        header, samples = batch.header, batch.samples
+        if len(header) > self.capacity:                     # only the newest events fit in the ring
+            self._head += len(header) - self.capacity
+            header, samples = header[-self.capacity:], samples[-self.capacity:]
+        seq = self._head + np.arange(len(header), dtype=np.uint64)
+        slots = seq % self.capacity
+        self._slotSeq[slots] = 2 * seq + 1
+        self.header[slots] = header
+        self.samples[slots, ..., :samples.shape[-1]] = samples      # records shortened by the zero suppression: ChSize samples
+        self._slotSeq[slots] = 2 * seq + 2
+        self._head += len(header)
+        self._control[_HEAD] = self._head
+
+    # Detach and remove the shared memory
+    def close(self):
+        if self._shm is None: return
+        del self._control, self._slotSeq, self.header, self.samples
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+        _createdRings.discard(self.name)
+
+
+class sharedRingReader():
+    def __init__(self, name: str, fromOldest: bool = False, timeout: float = 0) -> None:
+        """
+        Attach to a shared memory ring created by sharedRingWriter
+
+        Parameters
+        ----------
+            name (str) : name of the shared memory block
+            fromOldest (bool) : start from the oldest event still in the ring instead of the next one
+            timeout (float) : time to wait for the writer to create the ring [s]
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._shm = _attachSharedMemory(name)
+                break
+            except FileNotFoundError:
+                if time.monotonic() >= deadline: raise
+                time.sleep(0.1)
+        control = np.ndarray((_CONTROL_WORDS,), dtype=np.uint64, buffer=self._shm.buf)
+        if control[0] != SHARED_RING_MAGIC: raise ValueError(f"{name} is not an initialized shared ring")
+        self.capacity, self.groups, self.RecordLength = int(control[1]), int(control[2]), int(control[3])
+        del control
+        self._control, self._slotSeq, self._header, self._samples = _sharedRingLayout(self._shm, self.capacity, self.groups, self.RecordLength)
+        head = int(self._control[_HEAD])
+        self.cursor = max(0, head - self.capacity) if fromOldest else head
+
+        # Counters
+        self.readNb = 0
+        self.lostNb = 0
+
+    # Number of events written and not yet read (including the ones already overwritten)
+    def pending(self) -> int:
+        return int(self._control[_HEAD]) - self.cursor
+
+    # Copy the next events (at most maxEvents) out of the ring
+    def readBatch(self, maxEvents: int = 1024) -> X742_eventBatch:
+        """
+        Copy the next available events. Events overwritten by the writer before or during the copy
+        are skipped and counted in lostNb.
+
+        Parameters
+        ----------
+            maxEvents (int) : maximum number of events returned
+
+        Returns
+        -------
+            batch (X742_eventBatch) : events read, in writing order (may be empty)
+        """
+        head = int(self._control[_HEAD])
+        # Skip what the writer already overwrote
+        if head - self.cursor > self.capacity:
+            self.lostNb += head - self.capacity - self.cursor
+            self.cursor = head - self.capacity
+        eventsNb = min(head - self.cursor, maxEvents)
+        seq = self.cursor + np.arange(eventsNb, dtype=np.uint64)
+        slots = seq % self.capacity
+
+        # Seqlock: the slot must be complete for this sequence before and after the copy
+        before = self._slotSeq[slots]
+        batch = X742_eventBatch.__new__(X742_eventBatch)
+        batch.header = self._header[slots]
+        batch.samples = self._samples[slots]
+        after = self._slotSeq[slots]
+        valid = (before == 2 * seq + 2) & (after == before)
+        if not valid.all():
+            batch.header, batch.samples = batch.header[valid], batch.samples[valid]
+            self.lostNb += int(eventsNb - valid.sum())
+
+        self.cursor += eventsNb
+        self.readNb += len(batch)
+        return batch
+
+    # Wait for at least one event and read the available ones
+    def waitBatch(self, maxEvents: int = 1024, timeout: float = 1.0, pollPeriod_s: float = 0.001) -> X742_eventBatch:
+        deadline = time.monotonic() + timeout
+        while self.pending() == 0 and time.monotonic() < deadline:
+            time.sleep(pollPeriod_s)
+        return self.readBatch(maxEvents)
+
+    # Counters of the reader
+    def getStats(self) -> dict:
+        return {
+            'read'      : self.readNb,
+            'lost'      : self.lostNb,
+            'pending'   : self.pending()
+        }
+
+    # Detach from the shared memory
+    def close(self):
+        if self._shm is None: return
+        del self._control, self._slotSeq, self._header, self._samples
+        self._shm.close()
+        self._shm = None
+
+
+# Minimal online monitor: rate and channel 0 baseline of the events in the ring
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Attach to the DT5742B shared ring and print the event rate")
+    parser.add_argument('name', nargs='?', default='dt5742b', help="name of the shared ring")
+    args = parser.parse_args()
+    reader = sharedRingReader(args.name, timeout = 30)
+    startTime, readNb = time.monotonic(), 0
+    while True:
+        batch = reader.waitBatch()
+        if time.monotonic() - startTime >= 1.0:
+            baseline = np.mean(batch.samples[:, 0, 0, :100]) if len(batch) else float('nan')
+            print(f"{(reader.readNb - readNb) / (time.monotonic() - startTime):10.1f} evt/s | lost {reader.lostNb} | baseline ch0 {baseline:8.1f}")
+            startTime, readNb = time.monotonic(), reader.readNb
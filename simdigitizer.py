@@ -0,0 +1,365 @@
+#################################################################################################
+# @info Simulated DT5742B digitizer backend                                                     #
+#       simulatedDigitizer is a drop-in replacement of libCAENDigitizer.so for CAENDT5742B:     #
+#       it exposes the CAEN_DGTZ_* functions used by the class with the same ctypes calling     #
+#       convention, and serves readout buffers from a synthetic waveform generator or from a    #
+#       recorded run (rawrecorder) at a controllable trigger rate.                              #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#                                                                                               #
+# Usage                                                                                         #
+#   backend = simulatedDigitizer(syntheticSource(), triggerRate_Hz = 1000)                      #
+#   dgt = CAENDT5742B(usbLinkID = 0, evtReadoutQueue = queue.Queue(), backend = backend)        #
+#################################################################################################
+from caendt5742b import CAEN_DGTZ_X742_EVENT_t, CAEN_DGTZ_BoardInfo_t, CAEN_DGTZ_EventInfo_t
+from x742decoder import X742_encodeBuffer, X742_eventOffsets, X742_parseBuffer, X742_groupsNb
+from rawrecorder import rawRunReader
+from drs4correction import DRS4_CELLS, DRS4_CHANNELS, DRS4_FREQUENCY_Hz
+from logger import create_logger
+import numpy as np
+import ctypes
+import time
+
+logging = create_logger("simdigitizer")
+
+# Error codes returned by the simulated functions
+CAEN_DGTZ_Success = 0
+CAEN_DGTZ_Timeout = -18
+CAEN_DGTZ_InvalidBuffer = -19
+CAEN_DGTZ_InvalidEvent = -21
+
+
+# Write an address into a ctypes pointer object
+def _setPointer(pointer, address: int):
+    ctypes.c_void_p.from_address(ctypes.addressof(pointer)).value = address
+
+# Underlying ctypes object of an argument passed by reference (ctypes.byref) or as a pointer
+def _deref(arg):
+    return arg._obj if hasattr(arg, '_obj') else arg
+
+# Integer value of an argument passed as a ctypes scalar or as a python int
+def _value(arg) -> int:
+    return arg.value if hasattr(arg, 'value') else int(arg)
+
+
+
+# Synthetic events: pedestal + noise + a negative exponential pulse of random amplitude
+class syntheticSource():
+    def __init__(self, baseline: float = 3000.0, noise: float = 4.0, amplitude: tuple = (200.0, 1500.0), pulsePosition: float = 0.3, pulseTau: float = 20.0, triggerChannel: bool = True, seed: int = 0) -> None:
+        """
+        Generator of synthetic X742 events
+
+        Parameters
+        ----------
+            baseline (float) : pedestal [ADC]
+            noise (float) : gaussian noise rms [ADC]
+            amplitude (tuple) : range of the uniformly distributed pulse amplitude [ADC]
+            pulsePosition (float) : position of the pulse in the record (fraction of RecordLength)
+            pulseTau (float) : decay time of the pulse [samples]
+            triggerChannel (bool) : digitize the trigger channel (channel 8) of each group
+            seed (int) : random generator seed
+        """
+        self.baseline = baseline
+        self.noise = noise
+        self.amplitude = amplitude
+        self.pulsePosition = pulsePosition
+        self.pulseTau = pulseTau
+        self.triggerChannel = triggerChannel
+        self.rng = np.random.default_rng(seed)
+        self._shapes = {}
+
+    # Raw buffer of the next eventsNb events
+    def readEvents(self, eventsNb: int, firstEventCounter: int, triggerTimeTags: np.ndarray, GroupEnableMask: int, RecordLength: int) -> bytes:
+        groups = X742_groupsNb(GroupEnableMask)
+        if RecordLength not in self._shapes:
+            t = np.arange(RecordLength) - self.pulsePosition * RecordLength
+            self._shapes[RecordLength] = np.where(t >= 0, np.exp(-np.clip(t, 0, None) / self.pulseTau), 0.0)
+        shape = self._shapes[RecordLength]
+        amplitude = self.rng.uniform(*self.amplitude, size=(eventsNb, groups, 9, 1))
+        samples = self.baseline - amplitude * shape + self.rng.normal(0, self.noise, size=(eventsNb, groups, 9, RecordLength))
+        samples = np.clip(np.rint(samples), 0, 4095)
+        EventCounter = (firstEventCounter + np.arange(eventsNb)) & 0x3FFFFF
+        StartIndexCell = self.rng.integers(0, 1024, size=(eventsNb, groups))
+        return X742_encodeBuffer(samples, GroupEnableMask, EventCounter, triggerTimeTags, StartIndexCell, self.triggerChannel)
+
+
+# Events of a recorded run (rawrecorder), served in order and optionally looped
+class replaySource():
+    def __init__(self, fname: str, loop: bool = True) -> None:
+        """
+        Replay of a recorded run
+
+        Parameters
+        ----------
+            fname (str) : path of the run files without extension (<fname>.raw, <fname>.evt)
+            loop (bool) : restart from the first event at the end of the run
+        """
+        self.reader = rawRunReader(fname)
+        self.loop = loop
+        self.position = 0
+        if len(self.reader) == 0: raise ValueError(f"Run {fname} has no events")
+
+    # Raw buffer of the next eventsNb events (the recorded counters and time tags are kept)
+    def readEvents(self, eventsNb: int, firstEventCounter: int, triggerTimeTags: np.ndarray, GroupEnableMask: int, RecordLength: int) -> bytes:
+        chunks = []
+        while eventsNb > 0:
+            if self.position == len(self.reader):
+                if not self.loop: break
+                self.position = 0
+            stop = min(self.position + eventsNb, len(self.reader))
+            chunks.append(self.reader.rawEvents(self.position, stop).tobytes())
+            eventsNb -= stop - self.position
+            self.position = stop
+        return b''.join(chunks)
+
+
+# Events of a raw readout buffer held in memory, served cyclically (benchmarks)
+class bufferSource():
+    def __init__(self, buffer: bytes) -> None:
+        words = np.frombuffer(buffer, dtype=np.uint32)
+        offsets, sizes = X742_eventOffsets(words)
+        self.buffer = bytes(buffer)
+        self.offsets = np.append(4 * offsets, len(self.buffer))
+        self.position = 0
+
+    # Raw buffer of the next eventsNb events (the stored counters and time tags are kept)
+    def readEvents(self, eventsNb: int, firstEventCounter: int, triggerTimeTags: np.ndarray, GroupEnableMask: int, RecordLength: int) -> bytes:
+        chunks = []
+        eventsTot = len(self.offsets) - 1
+        while eventsNb > 0:
+            stop = min(self.position + eventsNb, eventsTot)
+            chunks.append(self.buffer[self.offsets[self.position] : self.offsets[stop]])
+            eventsNb -= stop - self.position
+            self.position = stop % eventsTot
+        return b''.join(chunks)
+
+
+# Drop-in replacement of libCAENDigitizer.so
+class simulatedDigitizer():
+    def __init__(self, source = None, triggerRate_Hz: float = 0, maxEventsPerRead: int = 128, TTTfrequency_Hz: float = 58.59375e6) -> None:
+        """
+        Simulated DT5742B
+
+        Parameters
+        ----------
+            source (syntheticSource | replaySource) : source of the events (syntheticSource() if None)
+            triggerRate_Hz (float) : trigger rate, 0 means as fast as possible (every read returns maxEventsPerRead events)
+            maxEventsPerRead (int) : maximum number of events returned by a CAEN_DGTZ_ReadData (board memory)
+            TTTfrequency_Hz (float) : frequency of the trigger time tag counter
+        """
+        self.source = source if source is not None else syntheticSource()
+        self.triggerRate_Hz = triggerRate_Hz
+        self.maxEventsPerRead = maxEventsPerRead
+        self.TTTfrequency_Hz = TTTfrequency_Hz
+        # Digitizer settings (name of the CAEN_DGTZ_Set*/Get* function without prefix -> value)
+        self.settings = {'GroupEnableMask': 0b1, 'RecordLength': 1024, 'PostTriggerSize': 100}
+        self.running = False
+        self.startTime = 0
+        self.eventsServed = 0
+        self._buffers = {}          # keep alive the memory handed to the caller
+        self._offsets = (None, None)
+
+    # Generic CAEN_DGTZ_Set*/CAEN_DGTZ_Get* functions: store/return the last argument
+    def __getattr__(self, name: str):
+        if name.startswith('CAEN_DGTZ_Set'):
+            key = name[len('CAEN_DGTZ_Set'):]
+            def setter(handle, *args):
+                self.settings[key] = _value(args[-1])
+                return CAEN_DGTZ_Success
+            return setter
+        if name.startswith('CAEN_DGTZ_Get'):
+            key = name[len('CAEN_DGTZ_Get'):]
+            def getter(handle, *args):
+                _deref(args[-1]).value = self.settings.get(key, 0)
+                return CAEN_DGTZ_Success
+            return getter
+        raise AttributeError(name)
+
+    ### Connection
+    def CAEN_DGTZ_OpenDigitizer(self, linkType, linkNum, conetNode, VMEBaseAddress, handle):
+        _deref(handle).value = 1
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_CloseDigitizer(self, handle):
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_GetInfo(self, handle, boardInfo):
+        info = _deref(boardInfo)
+        info.ModelName = b"DT5742B"
+        info.Channels = 16
+        info.FamilyCode = 6                 # CAEN_DGTZ_XX742_FAMILY_CODE
+        info.ROC_FirmwareRel = b"simulated"
+        info.AMC_FirmwareRel = b"simulated"
+        info.ADC_NBits = 12
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_Reset(self, handle):
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_WriteRegister(self, handle, address, data):
+        return CAEN_DGTZ_Success
+
+    # Synthetic DRS4 correction tables of the 4 groups (fixed seed: the same tables at every call)
+    def CAEN_DGTZ_GetCorrectionTables(self, handle, frequency, CTable):
+        rng = np.random.default_rng(_value(frequency))
+        SamplingPeriod_ns = 1e9 / DRS4_FREQUENCY_Hz[_value(frequency)]
+        for table in _deref(CTable):
+            np.ctypeslib.as_array(table.cell)[:] = rng.normal(0, 8, size=(DRS4_CHANNELS, DRS4_CELLS))
+            np.ctypeslib.as_array(table.nsample)[:] = rng.normal(0, 2, size=(DRS4_CHANNELS, DRS4_CELLS))
+            # Cell steps around the ring summing to a whole turn (DRS4_CELLS sampling periods), the first cell at 0
+            step = rng.uniform(0.9, 1.1, size=DRS4_CELLS)
+            step *= SamplingPeriod_ns * DRS4_CELLS / step.sum()
+            np.ctypeslib.as_array(table.time)[:] = np.concatenate([[0.0], np.cumsum(step[:-1])])
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_SetInterruptConfig(self, handle, state, level, status_id, event_number, mode):
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_IRQWait(self, handle, timeout_ms):
+        # Events are ready when the trigger clock has produced at least one event not yet read
+        deadline = time.perf_counter() + _value(timeout_ms) * 1e-3
+        while time.perf_counter() < deadline:
+            if self._eventsAvailable() > 0: return CAEN_DGTZ_Success
+            time.sleep(1e-3)
+        return CAEN_DGTZ_Timeout
+
+    ### Acquisition
+    # Largest event of the configured groups and record length [bytes] (trigger channel included)
+    def _eventSize(self) -> int:
+        groups = X742_groupsNb(self.settings['GroupEnableMask'])
+        return 4 * (4 + groups * (2 + 3 * self.settings['RecordLength'] + 3 * self.settings['RecordLength'] // 8))
+
+    def CAEN_DGTZ_MallocReadoutBuffer(self, handle, buffer, size):
+        allocated = ctypes.create_string_buffer(max(self._eventSize() * self.maxEventsPerRead, 1 << 20))
+        self._buffers['readout'] = allocated
+        _setPointer(_deref(buffer), ctypes.addressof(allocated))
+        _deref(size).value = len(allocated)
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_FreeReadoutBuffer(self, buffer):
+        self._buffers.pop('readout', None)
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_SWStartAcquisition(self, handle):
+        self.running = True
+        self.startTime = time.perf_counter()
+        self.eventsServed = 0
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_SWStopAcquisition(self, handle):
+        self.running = False
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_SendSWtrigger(self, handle):
+        return CAEN_DGTZ_Success
+
+    # Number of triggers produced and not read yet
+    def _eventsAvailable(self) -> int:
+        if not self.running: return 0
+        if self.triggerRate_Hz <= 0: return self.maxEventsPerRead
+        triggered = int((time.perf_counter() - self.startTime) * self.triggerRate_Hz)
+        return min(triggered - self.eventsServed, self.maxEventsPerRead)
+
+    def CAEN_DGTZ_ReadData(self, handle, mode, buffer, bufferSize):
+        eventsNb = self._eventsAvailable()
+        raw = b''
+        if eventsNb > 0:
+            if self.triggerRate_Hz > 0:
+                triggerTime = (self.eventsServed + np.arange(eventsNb)) / self.triggerRate_Hz
+            else:
+                triggerTime = np.full(eventsNb, time.perf_counter() - self.startTime)
+            triggerTimeTags = (triggerTime * self.TTTfrequency_Hz).astype(np.uint64) & 0xFFFFFFFF
+            raw = self.source.readEvents(eventsNb, self.eventsServed, triggerTimeTags, self.settings['GroupEnableMask'], self.settings['RecordLength'])
+            # Events larger than the configuration (e.g. a run recorded with more groups or longer records) overflow the readout buffer
+            offsets, sizes = X742_eventOffsets(np.frombuffer(raw, dtype=np.uint32))
+            capacity = len(self._buffers['readout']) if 'readout' in self._buffers else 0
+            # Error code as the library (nothing is copied nor served), the acquisition thread handles it
+            if len(sizes) and 4 * int(sizes.max()) > self._eventSize() or len(raw) > capacity:
+                logging.error(f"Events of {4 * int(sizes.max()) if len(sizes) else 0} bytes ({len(raw)} bytes read) do not fit the configuration "
+                              f"(GroupEnableMask {self.settings['GroupEnableMask']:#b}, RecordLength {self.settings['RecordLength']}: {self._eventSize()} bytes per event, {capacity} bytes buffer)")
+                _deref(bufferSize).value = 0
+                return CAEN_DGTZ_InvalidEvent
+            ctypes.memmove(buffer, raw, len(raw))
+            # Events actually served (a replay without loop ends), offsets cached for GetNumEvents/GetEventInfo
+            self.eventsServed += len(offsets)
+            if len(raw): self._offsets = ((ctypes.cast(buffer, ctypes.c_void_p).value, len(raw)), (offsets, sizes))
+        _deref(bufferSize).value = len(raw)
+        return CAEN_DGTZ_Success
+
+    # Event offsets of the buffer, cached for the GetEventInfo calls that follow GetNumEvents
+    def _eventOffsets(self, buffer, bufferSize: int):
+        address = ctypes.cast(buffer, ctypes.c_void_p).value
+        if self._offsets[0] != (address, bufferSize):
+            words = np.frombuffer((ctypes.c_char * bufferSize).from_address(address), dtype=np.uint32)
+            self._offsets = ((address, bufferSize), X742_eventOffsets(words))
+        return address, self._offsets[1]
+
+    def CAEN_DGTZ_GetNumEvents(self, handle, buffer, bufferSize, numEvents):
+        bufferSize = _value(bufferSize)
+        if bufferSize == 0:
+            _deref(numEvents).value = 0
+            return CAEN_DGTZ_Success
+        try:
+            _, (offsets, _) = self._eventOffsets(buffer, bufferSize)
+        except ValueError:
+            return CAEN_DGTZ_InvalidBuffer
+        _deref(numEvents).value = len(offsets)
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_GetEventInfo(self, handle, buffer, bufferSize, numEvent, eventInfo, eventPtr):
+        address, (offsets, sizes) = self._eventOffsets(buffer, _value(bufferSize))
+        i = _value(numEvent)
+        if i >= len(offsets): return CAEN_DGTZ_InvalidEvent
+        words = (ctypes.c_uint32 * 4).from_address(address + 4 * int(offsets[i]))
+        info = _deref(eventInfo)
+        info.EventSize = 4 * int(sizes[i])
+        info.BoardId = (words[1] >> 27) & 0x1F
+        info.Pattern = (words[1] >> 8) & 0xFFFF
+        info.ChannelMask = words[1] & 0xF
+        info.EventCounter = words[2] & 0x3FFFFF
+        info.TriggerTimeTag = words[3]
+        _setPointer(_deref(eventPtr), address + 4 * int(offsets[i]))
+        return CAEN_DGTZ_Success
+
+    ### Event decoding
+    def CAEN_DGTZ_AllocateEvent(self, handle, Evt):
+        event = CAEN_DGTZ_X742_EVENT_t()
+        channels = []
+        # Channels of the configured record length, as the library
+        for group in range(4):
+            for ch in range(9):
+                channel = (ctypes.c_float * self.settings['RecordLength'])()
+                channels.append(channel)
+                event.DataGroup[group].DataChannel[ch] = ctypes.cast(channel, ctypes.POINTER(ctypes.c_float))
+        self._buffers['event'] = (event, channels)
+        _setPointer(_deref(Evt), ctypes.addressof(event))
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_FreeEvent(self, handle, Evt):
+        self._buffers.pop('event', None)
+        return CAEN_DGTZ_Success
+
+    def CAEN_DGTZ_DecodeEvent(self, handle, eventPtr, Evt):
+        address = ctypes.cast(eventPtr, ctypes.c_void_p).value
+        size = 4 * (ctypes.c_uint32.from_address(address).value & 0x0FFFFFFF)
+        raw = (ctypes.c_char * size).from_address(address)
+        GroupEnableMask = self.settings['GroupEnableMask']
+        try:
+            batch = X742_parseBuffer(raw, GroupEnableMask, self.settings['RecordLength'])
+        except ValueError:
+            return CAEN_DGTZ_InvalidEvent
+        event = _deref(Evt).contents
+        header = batch.header[0]
+        for group in range(4):
+            # Row of the group among the enabled ones
+            g = X742_groupsNb(GroupEnableMask & ((1 << group) - 1))
+            present = bool((GroupEnableMask >> group) & 1) and header['ChSize'][g].any()
+            event.GrPresent[group] = int(present)
+            if not present: continue
+            EvtGroup = event.DataGroup[group]
+            EvtGroup.TriggerTimeTag = int(header['GroupTriggerTimeTag'][g])
+            EvtGroup.StartIndexCell = int(header['StartIndexCell'][g])
+            for ch in range(9):
+                ChSize_ch = int(header['ChSize'][g, ch])
+                EvtGroup.ChSize[ch] = ChSize_ch
+                if ChSize_ch: ctypes.memmove(EvtGroup.DataChannel[ch], batch.samples[0, g, ch].ctypes.data, 4 * ChSize_ch)
+        return CAEN_DGTZ_Success
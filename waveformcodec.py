@@ -0,0 +1,201 @@
+#################################################################################################
+# @info Lossless compact codec of blocks of waveforms (DRS4 samples of the DT5742B)             #
+#       The decoded samples are float32 although the ADC is 12-bit: a block is turned back     #
+#       into integers, delta-encoded along the time axis, zigzag-mapped to unsigned values and  #
+#       bit-packed with the width of the largest delta of every waveform. Waveforms of the      #
+#       same width are packed together as bit planes, so the whole block is encoded with a few  #
+#       numpy passes per width (at most 16), no per-event loop. Round trip is exact: blocks     #
+#       that are not integral (e.g. after the DRS4 time correction) are stored as float32,      #
+#       unless rounding to the ADC unit is requested.                                           #
+#                                                                                               #
+#   encoded block: header (WAVEFORM_CODEC_HEADER_dtype)                                         #
+#                  active mask (1 bit per waveform)                                             #
+#                  PACKED: first sample (int16) and width (uint8) of the active waveforms,      #
+#                          bit planes of the zigzag deltas, by increasing width                 #
+#                  RAW:    float32 samples of the active waveforms                              #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+import numpy as np
+
+WAVEFORM_CODEC_MAGIC = 0x31434657           # 'WFC1'
+WAVEFORM_CODEC_PACKED = 0
+WAVEFORM_CODEC_RAW = 1
+## Header of an encoded block, shape of the block padded to 4 dimensions
+WAVEFORM_CODEC_HEADER_dtype = np.dtype([('magic', '<u4'), ('mode', 'u1'), ('ndim', 'u1'), ('reserved', 'u1', (2,)), ('shape', '<u4', (4,))])
+
+
+class waveformCodec():
+    # Integral samples are packed if they fit in +-2**14 (12-bit ADC plus the DRS4 offset corrections): the deltas fit in 16 bits
+    INTEGER_RANGE = (-(1 << 14), 1 << 14)
+    # Bit widths of the unsigned deltas: width(v) = number of powers of two <= v
+    _POWERS = 1 << np.arange(16, dtype=np.uint32)
+
+    def __init__(self, rounding: bool = False) -> None:
+        """
+        Encoder/decoder of blocks of waveforms
+
+        Parameters
+        ----------
+            rounding (bool) : round the samples to integer ADC counts before packing (lossy by less than half an ADC count,
+                              for blocks resampled by the DRS4 time correction); if False non-integral blocks are stored as float32
+        """
+        self.rounding = rounding
+        # Counters
+        self.blocksNb = 0
+        self.rawBlocksNb = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    ### Encoding
+    # Encode a block of waveforms
+    def encode(self, samples: np.ndarray, active: np.ndarray = None) -> bytes:
+        """
+        Encode a block of waveforms
+
+        Parameters
+        ----------
+            samples (np.ndarray) : (..., samples) waveforms [ADC counts], e.g. X742_eventBatch.samples (N, groups, 9, RecordLength)
+            active (np.ndarray) : samples.shape[:-1] boolean mask of the waveforms to be stored (e.g. ChSize > 0), all if None;
+                                  the other waveforms are decoded as zeros
+
+        Returns
+        -------
+            data (bytes) : encoded block
+        """
+        if samples.ndim < 1 or samples.ndim > 4: raise ValueError(f"Blocks of 1 to 4 dimensions only ({samples.shape})")
+        samplesNb = samples.shape[-1]
+        rows = samples.reshape(int(np.prod(samples.shape[:-1], dtype=np.int64)), samplesNb)
+        mask = np.ones(len(rows), dtype=np.bool_) if active is None else np.asarray(active, dtype=np.bool_).reshape(-1)
+        if len(mask) != len(rows): raise ValueError(f"Active mask of {len(mask)} waveforms for {len(rows)} waveforms")
+        selected = rows if mask.all() else rows[mask]
+
+        header = np.zeros(1, dtype=WAVEFORM_CODEC_HEADER_dtype)
+        header['magic'] = WAVEFORM_CODEC_MAGIC
+        header['ndim'] = samples.ndim
+        header['shape'][0, :samples.ndim] = samples.shape
+        values = self._integers(selected)
+        if values is None:
+            header['mode'] = WAVEFORM_CODEC_RAW
+            body = [selected.astype('<f4', copy=False).tobytes()]
+            self.rawBlocksNb += 1
+        else:
+            header['mode'] = WAVEFORM_CODEC_PACKED
+            body = self._pack(values)
+
+        data = b''.join([header.tobytes(), np.packbits(mask, bitorder='little').tobytes()] + body)
+        self.blocksNb += 1
+        self.bytesIn += samples.nbytes
+        self.bytesOut += len(data)
+        return data
+
+    __call__ = encode
+
+    # Waveforms of a X742_eventBatch, without the zero-suppressed channels (ChSize = 0)
+    def encodeBatch(self, batch) -> bytes:
+        return self.encode(batch.samples, batch.header['ChSize'] > 0)
+
+    # Integer samples (int32) of the rows, None if they cannot be packed without losses
+    def _integers(self, rows: np.ndarray):
+        if self.rounding:
+            values = np.rint(rows).astype(np.int32)
+        else:
+            values = rows.astype(np.int32)
+            if not np.array_equal(values, rows): return None
+        if values.size and (values.min() < self.INTEGER_RANGE[0] or values.max() >= self.INTEGER_RANGE[1]): return None
+        return values
+
+    # First samples, widths and bit planes of the zigzag deltas of the rows
+    def _pack(self, values: np.ndarray) -> list:
+        if values.shape[-1] == 0: return []
+        deltas = np.diff(values, axis=-1)
+        zigzag = ((deltas << 1) ^ (deltas >> 31)).astype(np.uint16)
+        widths = np.searchsorted(self._POWERS, zigzag.max(axis=-1, initial=0), side='right').astype(np.uint8)
+        parts = [values[:, 0].astype('<i2').tobytes(), widths.tobytes()]
+        for width in np.unique(widths):
+            if width == 0: continue
+            group = zigzag[widths == width].reshape(-1)
+            planes = np.empty((width, (group.size + 7) // 8), dtype=np.uint8)
+            bit = np.empty_like(group)
+            for b in range(width):
+                np.bitwise_and(group, 1 << b, out=bit)
+                planes[b] = np.packbits(bit.astype(np.bool_), bitorder='little')
+            parts.append(planes.tobytes())
+        return parts
+
+    ### Decoding
+    # Decode a block of waveforms
+    def decode(self, data: bytes) -> tuple:
+        """
+        Decode a block of waveforms
+
+        Parameters
+        ----------
+            data (bytes) : block encoded by encode
+
+        Returns
+        -------
+            samples (np.ndarray) : float32 waveforms with the shape of the encoded block (zeros if not active)
+            active (np.ndarray) : samples.shape[:-1] boolean mask of the stored waveforms
+        """
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        header = buffer[:WAVEFORM_CODEC_HEADER_dtype.itemsize].view(WAVEFORM_CODEC_HEADER_dtype)[0]
+        if header['magic'] != WAVEFORM_CODEC_MAGIC: raise ValueError(f"Not an encoded block of waveforms (magic {header['magic']:#x})")
+        shape = tuple(int(dim) for dim in header['shape'][:header['ndim']])
+        samplesNb = shape[-1]
+        rowsNb = int(np.prod(shape[:-1], dtype=np.int64))
+        offset = WAVEFORM_CODEC_HEADER_dtype.itemsize
+
+        maskBytes = (rowsNb + 7) // 8
+        mask = np.unpackbits(buffer[offset : offset + maskBytes], count=rowsNb, bitorder='little').astype(np.bool_)
+        offset += maskBytes
+        activeNb = int(mask.sum())
+
+        if header['mode'] == WAVEFORM_CODEC_RAW:
+            selected = buffer[offset : offset + 4 * activeNb * samplesNb].view('<f4').reshape(activeNb, samplesNb)
+        elif header['mode'] == WAVEFORM_CODEC_PACKED:
+            selected = self._unpack(buffer[offset:], activeNb, samplesNb)
+        else:
+            raise ValueError(f"Unknown encoding mode {header['mode']}")
+
+        samples = np.zeros((rowsNb, samplesNb), dtype=np.float32)
+        if activeNb == rowsNb: samples[...] = selected
+        else: samples[mask] = selected
+        return samples.reshape(shape), mask.reshape(shape[:-1])
+
+    # Integer rows from the first samples, widths and bit planes
+    def _unpack(self, buffer: np.ndarray, activeNb: int, samplesNb: int) -> np.ndarray:
+        if samplesNb == 0: return np.zeros((activeNb, 0), dtype=np.int32)
+        first = buffer[:2 * activeNb].view('<i2')
+        widths = buffer[2 * activeNb : 3 * activeNb]
+        offset = 3 * activeNb
+        zigzag = np.zeros((activeNb, samplesNb - 1), dtype=np.uint16)
+        for width in np.unique(widths):
+            if width == 0: continue
+            selected = widths == width
+            size = int(selected.sum()) * (samplesNb - 1)
+            planeBytes = (size + 7) // 8
+            planes = buffer[offset : offset + int(width) * planeBytes].reshape(width, planeBytes)
+            offset += int(width) * planeBytes
+            group = np.zeros(size, dtype=np.uint16)
+            bit = np.empty(size, dtype=np.uint16)
+            for b in range(width):
+                bit[...] = np.unpackbits(planes[b], count=size, bitorder='little')
+                bit <<= b
+                group |= bit
+            zigzag[selected] = group.reshape(-1, samplesNb - 1)
+        values = np.empty((activeNb, samplesNb), dtype=np.int32)
+        values[:, 0] = first
+        deltas = (zigzag >> 1).astype(np.int32) ^ -(zigzag & 1).astype(np.int32)
+        np.cumsum(deltas, axis=-1, out=values[:, 1:])
+        values[:, 1:] += values[:, :1]
+        return values
+
+    # Counters of the codec
+    def getStats(self) -> dict:
+        return {
+            'blocks'   : self.blocksNb,
+            'rawBlocks': self.rawBlocksNb,
+            'bytesIn'  : self.bytesIn,
+            'bytesOut' : self.bytesOut,
+            'ratio'    : self.bytesIn / self.bytesOut if self.bytesOut else 0.0
+        }
@@ -0,0 +1,437 @@
+#################################################################################################
+# @info Data layout and decoders of the X742 (DT5742B) readout buffers                          #
+#       - X742_headerDtype/X742_eventBatch: structured header + float32 samples of N events     #
+#       - X742_blockDecoder: bulk decode of a whole CAEN_DGTZ_ReadData buffer in a single       #
+#         foreign call (libX742DecodeBlock.so, built from X742DecodeBlock.c)                    #
+#       - X742_parseBuffer/X742_encodeBuffer: pure numpy decoder/encoder of the raw buffers,     #
+#         reference for offline reprocessing and benchmarks without libCAENDigitizer.so         #
+#                                                                                               #
+# Event layout (32-bit little endian words)                                                     #
+#   header[0]  [31:28] 0xA             [27:0] event size (words, header included)               #
+#   header[1]  [31:27] board id        [23:8] pattern        [3:0] group mask                   #
+#   header[2]  [21:0]  event counter                                                            #
+#   header[3]  [31:0]  event trigger time tag                                                   #
+#   for every group present in the group mask                                                  #
+#     group[0] [29:20] start index cell  [17:16] frequency  [12] TR present  [11:0] size (words) #
+#     size words of channel data: 3 words = 8 channels x 12 bit of the same time sample         #
+#     size/8 words of trigger channel data if TR present: 3 words = 8 consecutive TR samples    #
+#     group trigger time tag [29:0]                                                             #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+import numpy as np
+import functools
+import ctypes
+import time
+
+# CAEN_DGTZ_EventInfo_t fields, in the order of the structure
+X742_EVENTINFO_FIELDS = ('EventSize', 'BoardId', 'Pattern', 'ChannelMask', 'EventCounter', 'TriggerTimeTag')
+
+
+# Number of enabled groups of a group mask
+def X742_groupsNb(GroupEnableMask: int) -> int:
+    return bin(GroupEnableMask & 0xF).count('1')
+
+# Structured header of a decoded X742 event (CAEN_DGTZ_EventInfo_t + info of the enabled groups)
+@functools.lru_cache
+def X742_headerDtype(groups: int) -> np.dtype:
+    """
+    Structured dtype holding the CAEN_DGTZ_EventInfo_t fields of an event plus the per-group
+    information of its enabled groups (in ascending group order)
+
+    Parameters
+    ----------
+        groups (int) : number of enabled groups
+
+    Returns
+    -------
+        dtype (np.dtype) : header dtype
+    """
+    return np.dtype([(name, np.uint32) for name in X742_EVENTINFO_FIELDS] + [
+        ('blockTimestamp',      np.float64),
+        ('GroupTriggerTimeTag', np.uint32, (groups,)),
+        ('StartIndexCell',      np.uint16, (groups,)),
+        ('ChSize',              np.uint32, (groups, 9)),
+        ('FirstSample',         np.uint16, (groups,))       # first sample of the record kept by the zero suppression (0: whole record)
+    ])
+
+# Block of events decoded from a single CAEN_DGTZ_ReadData buffer
+class X742_eventBatch():
+    """
+    Contiguous container of the events of a readout block, handed over to the consumer as a single object
+
+    Attributes
+    ----------
+        header (np.ndarray) : (events,) X742_headerDtype structured array
+        samples (np.ndarray) : (events, groups, 9, RecordLength) float32 samples
+    """
+    def __init__(self, eventsNb: int, groups: int, RecordLength: int) -> None:
+        self.header = np.zeros(eventsNb, dtype=X742_headerDtype(groups))
+        self.samples = np.zeros((eventsNb, groups, 9, RecordLength), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.header)
+
+
+
+# Bulk decoder of the readout buffers (libX742DecodeBlock.so)
+class X742_blockDecoder():
+    """
+    Decode all the events of a readout buffer in a single call to libX742DecodeBlock.so.
+    Build the library with: gcc -O3 -shared -fPIC -o libX742DecodeBlock.so X742DecodeBlock.c
+
+    Parameters
+    ----------
+        libX742DecodeBlock_path (str) : path of the shared library
+    """
+    def __init__(self, libX742DecodeBlock_path: str = './libX742DecodeBlock.so') -> None:
+        self.lib = ctypes.cdll.LoadLibrary(libX742DecodeBlock_path)
+
+        self.lib.X742_BlockNumEvents.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint32)]
+        self.lib.X742_BlockNumEvents.restype = ctypes.c_int32
+        self.lib.X742_DecodeBlock.argtypes = [
+            ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32,
+            np.ctypeslib.ndpointer(np.uint32, flags='C_CONTIGUOUS'),
+            np.ctypeslib.ndpointer(np.uint32, flags='C_CONTIGUOUS'),
+            np.ctypeslib.ndpointer(np.uint16, flags='C_CONTIGUOUS'),
+            np.ctypeslib.ndpointer(np.uint32, flags='C_CONTIGUOUS'),
+            np.ctypeslib.ndpointer(np.float32, flags='C_CONTIGUOUS'),
+            ctypes.POINTER(ctypes.c_uint32)]
+        self.lib.X742_DecodeBlock.restype = ctypes.c_int32
+        self._decoded = ctypes.c_uint32()
+        # Header columns filled by the library, reused across the blocks (grown to the largest block)
+        self._columns = None
+
+    # Address and size of a readout buffer given as a ctypes pointer or as a bytes-like object
+    @staticmethod
+    def _bufferAddress(buffer, bsize: int = None):
+        if isinstance(buffer, int):
+            return buffer, bsize
+        if isinstance(buffer, (bytes, bytearray, memoryview, np.ndarray)):
+            array = np.frombuffer(buffer, dtype=np.uint8)
+            return array.ctypes.data, array.nbytes if bsize is None else bsize
+        return ctypes.cast(buffer, ctypes.c_void_p).value, bsize
+
+    # Number of events of a readout buffer
+    def numEvents(self, buffer, bsize: int = None) -> int:
+        address, bsize = self._bufferAddress(buffer, bsize)
+        numEvents = ctypes.c_uint32()
+        ret = self.lib.X742_BlockNumEvents(address, bsize, ctypes.byref(numEvents))
+        if ret != 0: raise ValueError(f"Invalid X742 readout buffer ({ret})")
+        return numEvents.value
+
+    # Header columns of eventsNb events, views of the reused scratch arrays
+    def _headerColumns(self, eventsNb: int, groups: int) -> tuple:
+        if self._columns is None or len(self._columns[0]) < eventsNb or self._columns[1].shape[1] != groups:
+            self._columns = (np.empty((eventsNb, len(X742_EVENTINFO_FIELDS)), dtype=np.uint32), np.empty((eventsNb, groups), dtype=np.uint32),
+                             np.empty((eventsNb, groups), dtype=np.uint16), np.empty((eventsNb, groups, 9), dtype=np.uint32))
+        return tuple(column[:eventsNb] for column in self._columns)
+
+    # Decode the whole readout buffer
+    def decode(self, buffer, bsize: int = None, GroupEnableMask: int = 0b1, RecordLength: int = 1024, eventsNb: int = None, out: X742_eventBatch = None) -> X742_eventBatch:
+        """
+        Decode all the events of a readout buffer into a X742_eventBatch
+
+        Parameters
+        ----------
+            buffer (ctypes.POINTER(ctypes.c_char) | bytes-like) : readout buffer (CAEN_DGTZ_ReadData)
+            bsize (int) : size of the buffer in bytes (mandatory for ctypes pointers)
+            GroupEnableMask (int) : groups to be stored
+            RecordLength (int) : number of samples per channel
+            eventsNb (int) : number of events in the buffer (counted if None)
+            out (X742_eventBatch) : preallocated batch of at least eventsNb events of the same groups and RecordLength, decoded
+                                    in place (no allocation per block, the samples past ChSize are not cleared); new batch if None
+
+        Returns
+        -------
+            batch (X742_eventBatch) : decoded events (a view of the first rows of out if given)
+        """
+        address, bsize = self._bufferAddress(buffer, bsize)
+        if eventsNb is None: eventsNb = self.numEvents(address, bsize)
+        groups = X742_groupsNb(GroupEnableMask)
+
+        if out is None:
+            batch = X742_eventBatch(eventsNb, groups, RecordLength)
+        else:
+            if len(out) < eventsNb or out.samples.shape[1:] != (groups, 9, RecordLength):
+                raise ValueError(f"Output batch {out.samples.shape} too small for {eventsNb} events of {groups} groups and {RecordLength} samples")
+            batch = X742_eventBatch.__new__(X742_eventBatch)
+            batch.header, batch.samples = out.header[:eventsNb], out.samples[:eventsNb]
+        info, groupTTT, startCell, chSize = self._headerColumns(eventsNb, groups)
+
+        ret = self.lib.X742_DecodeBlock(address, bsize, eventsNb, GroupEnableMask, RecordLength, info, groupTTT, startCell, chSize, batch.samples, ctypes.byref(self._decoded))
+        if ret != 0: raise ValueError(f"Invalid X742 readout buffer ({ret})")
+        # Fewer events in the buffer than declared: the rows past the decoded ones are not initialized
+        decoded = self._decoded.value
+        if decoded < eventsNb:
+            batch.header, batch.samples = batch.header[:decoded], batch.samples[:decoded]
+            info, groupTTT, startCell, chSize = info[:decoded], groupTTT[:decoded], startCell[:decoded], chSize[:decoded]
+
+        header = batch.header
+        for i, name in enumerate(X742_EVENTINFO_FIELDS):
+            header[name] = info[:, i]
+        header['blockTimestamp'] = time.time()
+        header['GroupTriggerTimeTag'] = groupTTT
+        header['StartIndexCell'] = startCell
+        header['ChSize'] = chSize
+        return batch
+
+
+
+
+##############################################################
+######## Pure numpy decoder/encoder ##########################
+##############################################################
+# Unpack 8 12-bit values from each triplet of 32-bit words: (..., 3) uint32 -> (..., 8) uint32
+def X742_unpack12(words: np.ndarray) -> np.ndarray:
+    w0, w1, w2 = words[..., 0], words[..., 1], words[..., 2]
+    return np.stack([
+        w0 & 0xFFF,
+        (w0 >> 12) & 0xFFF,
+        (w0 >> 24) | ((w1 & 0xF) << 8),
+        (w1 >> 4) & 0xFFF,
+        (w1 >> 16) & 0xFFF,
+        (w1 >> 28) | ((w2 & 0xFF) << 4),
+        (w2 >> 8) & 0xFFF,
+        (w2 >> 20) & 0xFFF
+    ], axis=-1)
+
+# Pack 8 12-bit values in each triplet of 32-bit words: (..., 8) -> (..., 3) uint32
+def X742_pack12(values: np.ndarray) -> np.ndarray:
+    v = [values[..., k].astype(np.uint32) & 0xFFF for k in range(8)]
+    return np.stack([
+        v[0] | (v[1] << 12) | ((v[2] & 0xFF) << 24),
+        (v[2] >> 8) | (v[3] << 4) | (v[4] << 16) | ((v[5] & 0xF) << 28),
+        (v[5] >> 4) | (v[6] << 8) | (v[7] << 20)
+    ], axis=-1)
+
+# Offsets and sizes (in words) of the events of a readout buffer
+def X742_eventOffsets(words: np.ndarray) -> tuple:
+    """
+    Walk the event headers of a readout buffer
+
+    Parameters
+    ----------
+        words (np.ndarray) : readout buffer as uint32 words
+
+    Returns
+    -------
+        offsets, sizes (np.ndarray, np.ndarray) : start and size of each event in words
+    """
+    # Fast path: events of identical size
+    if len(words) >= 4 and (words[0] >> 28) == 0xA:
+        size = int(words[0] & 0x0FFFFFFF)
+        if size >= 4 and len(words) % size == 0:
+            headers = words[::size]
+            if np.all(headers == words[0]):
+                return np.arange(0, len(words), size), np.full(len(headers), size)
+    offsets, sizes = [], []
+    offset = 0
+    while offset < len(words):
+        size = int(words[offset] & 0x0FFFFFFF)
+        if (words[offset] >> 28) != 0xA or size < 4 or offset + size > len(words):
+            raise ValueError(f"Invalid X742 event header at word {offset}")
+        offsets.append(offset)
+        sizes.append(size)
+        offset += size
+    return np.array(offsets, dtype=np.int64), np.array(sizes, dtype=np.int64)
+
+# Decode events sharing the same layout: events is a (N, size) view of the buffer
+def _X742_parseEvents(events: np.ndarray, GroupEnableMask: int, header: np.ndarray, samples: np.ndarray):
+    RecordLength = samples.shape[-1]
+    header['EventSize'] = events[:, 0] & 0x0FFFFFFF
+    header['EventSize'] *= 4
+    header['BoardId'] = (events[:, 1] >> 27) & 0x1F
+    header['Pattern'] = (events[:, 1] >> 8) & 0xFFFF
+    header['ChannelMask'] = events[:, 1] & 0xF
+    header['EventCounter'] = events[:, 2] & 0x3FFFFF
+    header['TriggerTimeTag'] = events[:, 3]
+    header['ChSize'] = 0
+
+    evtGroupMask = int(events[0, 1] & 0xF)
+    offset, g = 4, 0
+    for group in range(4):
+        if not (evtGroupMask >> group) & 1:
+            if (GroupEnableMask >> group) & 1: g += 1
+            continue
+        grHeader = int(events[0, offset])
+        grSize = grHeader & 0xFFF
+        trPresent = (grHeader >> 12) & 0x1
+        nTR = grSize // 8 if trPresent else 0
+        if (GroupEnableMask >> group) & 1:
+            nSamples = min(grSize // 3, RecordLength)
+            header['StartIndexCell'][:, g] = (events[:, offset] >> 20) & 0x3FF
+            data = events[:, offset + 1 : offset + 1 + 3 * nSamples].reshape(len(events), nSamples, 3)
+            samples[:, g, :8, :nSamples] = X742_unpack12(data).transpose(0, 2, 1)
+            header['ChSize'][:, g, :8] = nSamples
+            if trPresent:
+                nTRSamples = min(nTR // 3 * 8, RecordLength)
+                trData = events[:, offset + 1 + grSize : offset + 1 + grSize + nTR // 3 * 3].reshape(len(events), -1, 3)
+                samples[:, g, 8, :nTRSamples] = X742_unpack12(trData).reshape(len(events), -1)[:, :nTRSamples]
+                header['ChSize'][:, g, 8] = nTRSamples
+            header['GroupTriggerTimeTag'][:, g] = events[:, offset + 1 + grSize + nTR] & 0x3FFFFFFF
+            g += 1
+        offset += 1 + grSize + nTR + 1
+
+# Decode a readout buffer with numpy only
+def X742_parseBuffer(buffer, GroupEnableMask: int = 0b1, RecordLength: int = 1024, blockTimestamp: float = None) -> X742_eventBatch:
+    """
+    Decode all the events of a raw readout buffer (as returned by CAEN_DGTZ_ReadData) without any
+    CAEN library. Events sharing the same layout (the usual case of a fixed record length and group
+    mask) are decoded all at once with vectorized bit operations.
+
+    Parameters
+    ----------
+        buffer (bytes-like | np.ndarray) : readout buffer
+        GroupEnableMask (int) : groups to be stored
+        RecordLength (int) : number of samples per channel
+        blockTimestamp (float) : host timestamp of the block (time.time() if None)
+
+    Returns
+    -------
+        batch (X742_eventBatch) : decoded events
+    """
+    words = np.frombuffer(buffer, dtype=np.uint32)
+    offsets, sizes = X742_eventOffsets(words)
+    batch = X742_eventBatch(len(offsets), X742_groupsNb(GroupEnableMask), RecordLength)
+    batch.header['blockTimestamp'] = time.time() if blockTimestamp is None else blockTimestamp
+    if len(offsets) == 0: return batch
+
+    # Uniform layout: a single (N, size) view of the buffer
+    events = _X742_uniformEvents(words, offsets, sizes)
+    if events is not None:
+        _X742_parseEvents(events, GroupEnableMask, batch.header, batch.samples)
+        return batch
+
+    # Mixed layouts: event by event
+    for i, (offset, size) in enumerate(zip(offsets, sizes)):
+        _X742_parseEvents(words[offset : offset + size].reshape(1, -1), GroupEnableMask, batch.header[i:i+1], batch.samples[i:i+1])
+    return batch
+
+# (N, size) view of the events of the buffer if they share the same layout, None otherwise
+def _X742_uniformEvents(words: np.ndarray, offsets: np.ndarray, sizes: np.ndarray):
+    size = int(sizes[0])
+    if not np.all(sizes == size): return None
+    events = words[offsets[0] : offsets[0] + size * len(offsets)].reshape(-1, size)
+    layout = events[:, 1] & 0xF
+    if not np.all(layout == layout[0]): return None
+    # Only the size and TR present bits of the group headers define the layout: the start index cell changes on every event
+    for col in _X742_groupHeaderColumns(events[0]):
+        if not np.all((events[:, col] & 0x1FFF) == (events[0, col] & 0x1FFF)): return None
+    return events
+
+# Columns of the group headers of an event (used to check that the events share the same layout)
+def _X742_groupHeaderColumns(event: np.ndarray) -> list:
+    columns, offset = [], 4
+    for group in range(4):
+        if not (int(event[1]) >> group) & 1: continue
+        if offset >= len(event): break
+        columns.append(offset)
+        grSize = int(event[offset]) & 0xFFF
+        nTR = grSize // 8 if (int(event[offset]) >> 12) & 0x1 else 0
+        offset += 1 + grSize + nTR + 1
+    return columns
+
+# Encode samples into a raw readout buffer (synthetic data for tests, benchmarks and simulation)
+def X742_encodeBuffer(samples: np.ndarray, GroupEnableMask: int = 0b1, EventCounter: np.ndarray = None, TriggerTimeTag: np.ndarray = None, StartIndexCell: np.ndarray = None, triggerChannel: bool = False, BoardId: int = 0, Pattern: int = 0) -> bytes:
+    """
+    Build the raw readout buffer of N events, the inverse of X742_parseBuffer
+
+    Parameters
+    ----------
+        samples (np.ndarray) : (N, groups, 9, RecordLength) samples in [0, 4095], RecordLength multiple of 8
+        GroupEnableMask (int) : group mask of the events (groups = number of bits set)
+        EventCounter (np.ndarray) : (N,) event counters (0..N-1 if None)
+        TriggerTimeTag (np.ndarray) : (N,) trigger time tags (also used for the groups, 0 if None)
+        StartIndexCell (np.ndarray) : (N, groups) DRS4 start index cells (0 if None)
+        triggerChannel (bool) : store the trigger channel (channel 8) of each group
+        BoardId (int) : board id
+        Pattern (int) : LVDS pattern
+
+    Returns
+    -------
+        buffer (bytes) : readout buffer
+    """
+    N, groups, _, RecordLength = samples.shape
+    if groups != X742_groupsNb(GroupEnableMask): raise ValueError("samples groups do not match GroupEnableMask")
+    if RecordLength % 8: raise ValueError("RecordLength must be a multiple of 8")
+    EventCounter = np.arange(N) if EventCounter is None else np.asarray(EventCounter)
+    TriggerTimeTag = np.zeros(N) if TriggerTimeTag is None else np.asarray(TriggerTimeTag)
+    StartIndexCell = np.zeros((N, groups)) if StartIndexCell is None else np.asarray(StartIndexCell)
+
+    grSize = 3 * RecordLength
+    nTR = grSize // 8 if triggerChannel else 0
+    groupWords = 1 + grSize + nTR + 1
+    size = 4 + groups * groupWords
+
+    events = np.empty((N, size), dtype=np.uint32)
+    events[:, 0] = 0xA0000000 | size
+    events[:, 1] = ((BoardId & 0x1F) << 27) | ((Pattern & 0xFFFF) << 8) | (GroupEnableMask & 0xF)
+    events[:, 2] = EventCounter.astype(np.uint32) & 0x3FFFFF
+    events[:, 3] = TriggerTimeTag.astype(np.uint32)
+    for g in range(groups):
+        offset = 4 + g * groupWords
+        events[:, offset] = (grSize | (int(triggerChannel) << 12)) | ((StartIndexCell[:, g].astype(np.uint32) & 0x3FF) << 20)
+        events[:, offset + 1 : offset + 1 + grSize] = X742_pack12(samples[:, g, :8, :].transpose(0, 2, 1)).reshape(N, -1)
+        if triggerChannel:
+            events[:, offset + 1 + grSize : offset + 1 + grSize + nTR] = X742_pack12(samples[:, g, 8, :].reshape(N, -1, 8)).reshape(N, -1)
+        events[:, offset + 1 + grSize + nTR] = TriggerTimeTag.astype(np.uint32) & 0x3FFFFFFF
+    return events.tobytes()
+
+# Compare X742_parseBuffer with the X742_DecodeEvent routine of libX742DecodeRoutines.so
+def X742_validateParser(buffer, libCAENX742DecodeRoutines_path: str = './libX742DecodeRoutines.so') -> bool:
+    """
+    Check byte-for-byte that the float32 samples of X742_parseBuffer match the output of
+    GetEventPtr + X742_DecodeEvent for every event and channel of the buffer
+
+    Parameters
+    ----------
+        buffer (bytes-like) : readout buffer
+        libCAENX742DecodeRoutines_path (str) : path of libX742DecodeRoutines.so
+
+    Returns
+    -------
+        match (bool) : True if all the samples and header fields match
+    """
+    from caendt5742b import CAEN_DGTZ_X742_EVENT_t
+    lib = ctypes.cdll.LoadLibrary(libCAENX742DecodeRoutines_path)
+    free = ctypes.CDLL(None).free
+    free.argtypes = [ctypes.c_void_p]
+    raw = ctypes.create_string_buffer(bytes(buffer), len(buffer))
+    # Samples per channel from the size of the first group of the first event
+    words = np.frombuffer(buffer, dtype='<u4')
+    RecordLength = (int(words[4]) & 0xFFF) // 3 if len(words) > 4 and words[1] & 0xF else 0
+    batch = X742_parseBuffer(buffer, GroupEnableMask=0xF, RecordLength=RecordLength)
+
+    numEvents = ctypes.c_uint32()
+    lib.GetNumEvents(raw, ctypes.c_uint32(len(buffer)), ctypes.byref(numEvents))
+    if numEvents.value != len(batch): return False
+    evtptr = ctypes.POINTER(ctypes.c_char)()
+    Evt = ctypes.POINTER(CAEN_DGTZ_X742_EVENT_t)()
+    for i in range(numEvents.value):
+        lib.GetEventPtr(raw, ctypes.c_uint32(len(buffer)), ctypes.c_int32(i), ctypes.byref(evtptr))
+        if lib.X742_DecodeEvent(evtptr, ctypes.byref(Evt)) != 0: return False
+        try:
+            if not _X742_matchEvent(Evt.contents, batch, i): return False
+        finally:
+            # X742_DecodeEvent allocates the event and the 9 channels of every group present
+            for group in range(4):
+                if not Evt.contents.GrPresent[group]: continue
+                for ch in range(9): free(Evt.contents.DataGroup[group].DataChannel[ch])
+            free(Evt)
+    return True
+
+# Compare an event decoded by X742_DecodeEvent with the event i of a batch parsed with GroupEnableMask=0xF
+def _X742_matchEvent(Event, batch: X742_eventBatch, i: int) -> bool:
+    from caendt5742b import X742_channelView
+    for group in range(4):
+        if not Event.GrPresent[group]: continue
+        EvtGroup = Event.DataGroup[group]
+        # The parser stores all the groups present (GroupEnableMask=0xF): find the row of this group
+        g = X742_groupsNb(0xF & ((1 << group) - 1))
+        if EvtGroup.StartIndexCell != batch.header['StartIndexCell'][i, g]: return False
+        if EvtGroup.TriggerTimeTag != batch.header['GroupTriggerTimeTag'][i, g]: return False
+        for ch in range(9):
+            ChSize_ch = EvtGroup.ChSize[ch]
+            if ChSize_ch != batch.header['ChSize'][i, g, ch]: return False
+            if X742_channelView(EvtGroup, ch).tobytes() != batch.samples[i, g, ch, :ChSize_ch].tobytes(): return False
+    return True
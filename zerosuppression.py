@@ -0,0 +1,172 @@
+#################################################################################################
+# @info Software zero suppression and decimation of the decoded DT5742B blocks                  #
+#       The X742 boards cannot zero-suppress (nor decimate) in hardware: every sample of every  #
+#       enabled channel is read out. This stage runs on the X742_eventBatch right after the     #
+#       decode, before the hand-off, with numpy reductions on the whole block:                  #
+#         - quiet channels (all samples within threshold of the baseline) get ChSize = 0        #
+#         - events without any active channel are dropped                                       #
+#         - region of interest: only the samples around the peak of every group are kept,       #
+#           FirstSample of the header is the position of the window in the record               #
+#         - decimation: average of consecutive samples                                          #
+#       select: quiet channels and events, the records of the kept events are untouched (whole  #
+#               records for the DSP of the payload); the samples of the quiet channels stay in  #
+#               the block, only ChSize marks them                                               #
+#       reduce: region of interest and decimation, a new and smaller block                      #
+#       The counters give the bytes of samples actually removed from the blocks.                #
+# @author   Pietro Grutta (pietro.grutta@pd.infn.it)                                            #
+#################################################################################################
+from x742decoder import X742_eventBatch
+import numpy as np
+
+
+class zeroSuppressor():
+    def __init__(self, threshold: float = 0, baselineWindow: tuple = (0, 100), dropEvents: bool = True, roi: tuple = None, decimation: int = 1) -> None:
+        """
+        Software zero suppression of the X742_eventBatch blocks
+
+        Parameters
+        ----------
+            threshold (float) : a channel is active if a sample deviates more than threshold from its baseline [ADC] (0: no suppression)
+            baselineWindow (tuple) : (start, stop) samples of the baseline window
+            dropEvents (bool) : drop the events without active channels (otherwise only their ChSize is set to 0)
+            roi (tuple) : (pre, post) samples kept before and after the peak of every group (None: the whole record)
+            decimation (int) : samples averaged into one (1: no decimation)
+        """
+        if decimation < 1: raise ValueError(f"Decimation factor must be positive ({decimation})")
+        self.threshold = threshold
+        self.baselineWindow = slice(*baselineWindow)
+        self.dropEvents = dropEvents
+        self.roi = roi
+        self.decimation = decimation
+
+        # Counters (bytes of the samples arrays: the samples of quiet channels stay in the block)
+        self.eventsNb = 0
+        self.eventsDroppedNb = 0
+        self.channelsSuppressedNb = 0
+        self.bytesIn = 0
+        self.bytesSaved = 0
+
+    # Largest deviation from the baseline of every channel, and where it is: (N, groups, 9) each
+    def _deviation(self, samples: np.ndarray) -> tuple:
+        baseline = samples[..., self.baselineWindow].mean(axis=-1, dtype=np.float32)[..., None]
+        high, low = samples.argmax(axis=-1)[..., None], samples.argmin(axis=-1)[..., None]
+        highDeviation = np.take_along_axis(samples, high, axis=-1) - baseline
+        lowDeviation = baseline - np.take_along_axis(samples, low, axis=-1)
+        return np.maximum(highDeviation, lowDeviation)[..., 0], np.where(highDeviation >= lowDeviation, high, low)[..., 0]
+
+    # Block of events from its arrays
+    @staticmethod
+    def _batch(header: np.ndarray, samples: np.ndarray) -> X742_eventBatch:
+        batch = X742_eventBatch.__new__(X742_eventBatch)
+        batch.header, batch.samples = header, samples
+        return batch
+
+    # Quiet channels and events without active channels
+    def select(self, batch: X742_eventBatch) -> X742_eventBatch:
+        """
+        Zero suppression of a block: the quiet channels get ChSize = 0 and the events without active channels
+        are dropped. The records of the kept events are untouched (whole records for the DSP of the payload)
+
+        Parameters
+        ----------
+            batch (X742_eventBatch) : decoded events, samples (N, groups, 9, RecordLength)
+
+        Returns
+        -------
+            batch (X742_eventBatch) : the kept events (the same object if none was dropped)
+        """
+        return self._select(batch, False)[0]
+
+    # Selected block, with the deviations and the peaks of its channels if computed (needed by the region of interest)
+    def _select(self, batch: X742_eventBatch, peaks: bool) -> tuple:
+        self.eventsNb += len(batch)
+        self.bytesIn += batch.samples.nbytes
+        if len(batch) == 0 or (self.threshold <= 0 and not (peaks and self.roi is not None)): return batch, None, None
+        header, samples = batch.header, batch.samples
+        deviation, peak = self._deviation(samples)
+        if self.threshold <= 0: return batch, deviation, peak
+
+        ChSize = header['ChSize']
+        quiet = (deviation <= self.threshold) & (ChSize > 0)
+        self.channelsSuppressedNb += int(quiet.sum())
+        ChSize[quiet] = 0
+        if self.dropEvents:
+            keep = ChSize.any(axis=(1, 2))
+            if not keep.all():
+                self.eventsDroppedNb += int(len(keep) - keep.sum())
+                self.bytesSaved += samples[0].nbytes * int(len(keep) - keep.sum())
+                batch = self._batch(header[keep], samples[keep])
+                deviation, peak = deviation[keep], peak[keep]
+        return batch, deviation, peak
+
+    # Region of interest and decimation
+    def reduce(self, batch: X742_eventBatch) -> X742_eventBatch:
+        """
+        Region of interest around the peak of every group and decimation of a block (a new, smaller block)
+
+        Parameters
+        ----------
+            batch (X742_eventBatch) : decoded events, samples (N, groups, 9, RecordLength)
+
+        Returns
+        -------
+            batch (X742_eventBatch) : the reduced block (the same object without region of interest and decimation)
+        """
+        return self._reduce(batch, *(self._deviation(batch.samples) if self.roi is not None and len(batch) else (None, None)))
+
+    def _reduce(self, batch: X742_eventBatch, deviation: np.ndarray, peak: np.ndarray) -> X742_eventBatch:
+        if len(batch) == 0 or (self.roi is None and self.decimation == 1): return batch
+        header, samples = batch.header.copy(), batch.samples
+        ChSize = header['ChSize']
+
+        # Region of interest around the sample of the largest deviation of every group
+        if self.roi is not None:
+            pre, post = self.roi
+            RecordLength = samples.shape[-1]
+            width = min(pre + post, RecordLength)
+            groupPeak = np.take_along_axis(peak, deviation.argmax(axis=-1)[..., None], axis=-1)[..., 0]
+            start = np.clip(groupPeak - pre, 0, RecordLength - width)
+            index = (start[..., None] + np.arange(width))[:, :, None, :]
+            samples = np.take_along_axis(samples, index, axis=-1)
+            header['FirstSample'] = start
+            ChSize[...] = np.clip(ChSize - start[..., None], 0, width)
+
+        # Decimation: average of consecutive samples (strided sums, faster than a mean over a short axis)
+        if self.decimation > 1:
+            stop = samples.shape[-1] // self.decimation * self.decimation
+            decimated = samples[..., 0:stop:self.decimation].copy()
+            for i in range(1, self.decimation): decimated += samples[..., i:stop:self.decimation]
+            decimated *= np.float32(1.0 / self.decimation)
+            samples = decimated
+            ChSize //= self.decimation
+
+        self.bytesSaved += batch.samples.nbytes - samples.nbytes
+        return self._batch(header, samples)
+
+    # Suppress a block of events
+    def apply(self, batch: X742_eventBatch) -> X742_eventBatch:
+        """
+        Zero suppression (select), then region of interest and decimation (reduce) of a block
+
+        Parameters
+        ----------
+            batch (X742_eventBatch) : decoded events, samples (N, groups, 9, RecordLength)
+
+        Returns
+        -------
+            batch (X742_eventBatch) : the suppressed block (the same object if nothing was removed)
+        """
+        return self._reduce(*self._select(batch, True))
+
+    __call__ = apply
+
+    # Counters of the suppression
+    def getStats(self) -> dict:
+        return {
+            'events'            : self.eventsNb,
+            'eventsDropped'     : self.eventsDroppedNb,
+            'channelsSuppressed': self.channelsSuppressedNb,
+            'bytesIn'           : self.bytesIn,
+            'bytesOut'          : self.bytesIn - self.bytesSaved,
+            'bytesSaved'        : self.bytesSaved
+        }